@@ -0,0 +1,399 @@
+import argparse
+import asyncio
+import concurrent.futures
+import collections
+import functools
+import json
+import os
+import time
+
+from starlette.applications import Starlette
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+# the labeling task store (and its configuration, including whether metrics are recorded)
+# is shared with the Flask server
+from server import task_store, thumbnail_cache, STREAM_TASK_MIN_DATAPOINTS, ATLAS_MAX_AGE, THUMBNAIL_MAX_AGE, \
+	get_dump_uncertainty_order, load_task_atlas_index, find_atlas_file, resolve_server_path
+import compression
+import metrics
+import taskwindows
+from thumbnails import THUMBNAIL_SIZES, get_thumbnail_size
+
+
+# An asyncio (ASGI) version of the labeling server in server.py, for serving many
+# concurrent labelers from a single process. It serves the same /labeling_api/*
+# routes, thumbnails (/thumbnail), atlases (/atlas) and static files as server.py. Run it with:
+#
+#    python async_server.py --port 5000
+#
+# (or with any ASGI server, e.g., "uvicorn async_server:app"). Requires the
+# starlette and uvicorn packages.
+#
+# Handlers never block the event loop on task store work (file I/O, json
+# parsing/serialization, sqlite queries): it runs in a fixed-size thread pool, so
+# a few slow saves can't stall other requests, and the number of threads doesn't
+# grow with the number of connections. Label updates to the same task are applied
+# one at a time, in the order they arrive.
+
+# number of threads running task store work
+ASYNC_SERVER_MAX_WORKERS = 16
+
+SERVER_ROOT = os.path.realpath('.')
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=ASYNC_SERVER_MAX_WORKERS)
+
+# per-task locks serializing label updates
+task_write_locks = collections.defaultdict(asyncio.Lock)
+
+
+# runs func(*args) in the executor
+async def run_blocking(func, *args):
+	return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+# iterates over a (blocking) iterable in the executor, for streaming responses
+async def iterate_blocking(iterable):
+	iterator = iter(iterable)
+	while True:
+		item = await run_blocking(next, iterator, None)
+		if item is None:
+			return
+		yield item
+
+def error_response(status_code, description):
+	return JSONResponse({ "error" : description }, status_code=status_code)
+
+def parse_json(body):
+	with metrics.TASK_SECONDS.time(operation="parse_request"):
+		return json.loads(body)
+
+async def get_json_body(request):
+	body = await request.body()
+	try:
+		return await run_blocking(parse_json, body)
+	except ValueError:
+		return None
+
+def get_response_encoding(request, encodings=None):
+	if encodings is None:
+		encodings = compression.get_encodings()
+	return compression.negotiate_encoding(request.headers.get('accept-encoding', ''), encodings)
+
+# true if the request's If-None-Match header matches etag (quoted)
+def etag_matches(request, etag):
+	header = request.headers.get('if-none-match')
+	if header is None:
+		return False
+	for tag in header.split(','):
+		tag = tag.strip()
+		if tag.startswith('W/'):
+			tag = tag[2:]
+		if tag == '*' or tag == etag:
+			return True
+	return False
+
+def not_modified_response(headers):
+	return Response(status_code=304, headers=headers)
+
+
+###############################################################
+# metrics (the same ones as server.py's, see weakdb/metrics.py)
+###############################################################
+
+REQUEST_SECONDS = metrics.histogram("weakdb_http_request_duration_seconds", "Time taken to handle requests", ["endpoint", "method"])
+REQUESTS = metrics.counter("weakdb_http_requests_total", "Requests handled", ["endpoint", "method", "status"])
+REQUEST_BYTES = metrics.counter("weakdb_http_request_bytes_total", "Bytes of request bodies received", ["endpoint"])
+RESPONSE_BYTES = metrics.counter("weakdb_http_response_bytes_total", "Bytes of response bodies sent", ["endpoint"])
+
+# wraps a route handler to record its latency and request/response sizes. Streamed
+# responses (of unknown length) are only recorded once their body has been sent
+def instrumented(handler):
+	@functools.wraps(handler)
+	async def wrapper(request):
+		start = time.perf_counter()
+		response = await handler(request)
+		endpoint = handler.__name__
+		REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+		REQUEST_BYTES.inc(int(request.headers.get('content-length', 0)), endpoint=endpoint)
+		if isinstance(response, StreamingResponse) and 'content-length' not in response.headers:
+			response.body_iterator = record_streamed_response(response.body_iterator, start, endpoint, request.method)
+			return response
+		REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+		RESPONSE_BYTES.inc(int(response.headers.get('content-length', 0)), endpoint=endpoint)
+		return response
+	return wrapper
+
+# yields the chunks of a streamed response's body, and records the request's latency and
+# the response's size once the body is sent (or the client goes away)
+async def record_streamed_response(body_iterator, start, endpoint, method):
+	num_bytes = 0
+	try:
+		async for chunk in body_iterator:
+			num_bytes += len(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+			yield chunk
+	finally:
+		if hasattr(body_iterator, 'aclose'):
+			await body_iterator.aclose()
+		REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, method=method)
+		RESPONSE_BYTES.inc(num_bytes, endpoint=endpoint)
+
+async def get_metrics(request):
+	return Response(await run_blocking(metrics.render), headers={ 'Content-Type' : metrics.CONTENT_TYPE })
+
+
+###############################################################
+# labeling API (see server.py for documentation of the routes)
+###############################################################
+
+async def check_task_exists(task_id):
+	return task_id is not None and await run_blocking(task_store.has_task, task_id)
+
+def task_not_found(task_id):
+	return error_response(404, "Task %s does not exist" % task_id)
+
+
+async def get_task(request):
+	task_id = request.query_params.get('task_id')
+	if not await check_task_exists(task_id):
+		return task_not_found(task_id)
+
+	# large tasks are serialized as they are sent (see server.py)
+	encoding = get_response_encoding(request)
+	num_datapoints = await run_blocking(task_store.get_num_datapoints, task_id)
+	stream = (num_datapoints >= STREAM_TASK_MIN_DATAPOINTS)
+	get_body = task_store.get_task_stream if stream else task_store.get_task_response
+	(body, etag) = await run_blocking(get_body, task_id, encoding)
+
+	headers = { 'Vary' : 'Accept-Encoding', 'Cache-Control' : 'no-cache' }
+	if etag is not None:
+		headers['ETag'] = '"%s"' % etag
+		if etag_matches(request, headers['ETag']):
+			return not_modified_response(headers)
+	if encoding is not None:
+		headers['Content-Encoding'] = encoding
+	if stream:
+		return StreamingResponse(iterate_blocking(body), media_type='application/json', headers=headers)
+	return Response(body, media_type='application/json', headers=headers)
+
+
+async def get_progress(request):
+	task_id = request.query_params.get('task_id')
+	if not await check_task_exists(task_id):
+		return task_not_found(task_id)
+
+	num_datapoints = await run_blocking(task_store.get_num_datapoints, task_id)
+	num_labeled = await run_blocking(task_store.get_progress, task_id)
+	return JSONResponse({ "task_id" : task_id, "num_datapoints" : num_datapoints, "num_labeled" : num_labeled })
+
+
+async def get_atlas_index(request):
+	task_id = request.query_params.get('task_id')
+	if not await check_task_exists(task_id):
+		return task_not_found(task_id)
+
+	index = await run_blocking(load_task_atlas_index, task_id)
+	if index is None:
+		return error_response(404, "Task %s has no atlases" % task_id)
+	return JSONResponse(index)
+
+
+async def get_window(request):
+	task_id = request.query_params.get('task_id')
+	if not await check_task_exists(task_id):
+		return task_not_found(task_id)
+
+	labeler_name = request.query_params.get('labeler', '')
+	select = request.query_params.get('select', taskwindows.WINDOW_SELECT_UNLABELED)
+	try:
+		start = int(request.query_params.get('start', 0))
+		count = int(request.query_params.get('count', taskwindows.DEFAULT_WINDOW_SIZE))
+	except ValueError:
+		return error_response(400, "Invalid window")
+	if len(labeler_name) == 0:
+		return error_response(400, "No labeler given")
+	if select not in taskwindows.WINDOW_SELECTIONS:
+		return error_response(400, "Invalid selection: %s" % select)
+	if start < 0 or count <= 0 or count > taskwindows.MAX_WINDOW_SIZE:
+		return error_response(400, "Invalid window: start=%d, count=%d" % (start, count))
+
+	order = None
+	if select == taskwindows.WINDOW_SELECT_UNCERTAINTY:
+		num_datapoints = await run_blocking(task_store.get_num_datapoints, task_id)
+		extended = request.query_params.get('ext', 'noext') == 'ext'
+		(order, error) = await run_blocking(get_dump_uncertainty_order, request.query_params.get('dump', ''), extended, num_datapoints)
+		if order is None:
+			return error_response(400, error)
+
+	window = await run_blocking(taskwindows.get_window, task_store, task_id, labeler_name, select, start, count, order)
+	return JSONResponse(window)
+
+
+async def store_labels(request):
+	incoming_data = await get_json_body(request)
+	if incoming_data is None:
+		return error_response(400, "Invalid json")
+
+	task_id = incoming_data["task_id"]
+	labeler_name = incoming_data["labeler_name"]
+	labels = incoming_data["labels"]
+	labeling_times = incoming_data["labeling_times"]
+
+	print("Saving to: %s" % task_id)
+
+	if await check_task_exists(task_id):
+		async with task_write_locks[task_id]:
+			num_datapoints = await run_blocking(task_store.get_num_datapoints, task_id)
+			if num_datapoints != len(labels):
+				error_msg = "Incorrect number of datapoints: got %d, expected %d" % (len(labels), num_datapoints)
+				return error_response(404, error_msg)
+
+			await run_blocking(task_store.replace_labeler_results, task_id, labeler_name, labels, labeling_times)
+
+	return JSONResponse("Success")
+
+
+async def store_label_updates(request):
+	incoming_data = await get_json_body(request)
+	if incoming_data is None:
+		return error_response(400, "Invalid json")
+
+	task_id = incoming_data["task_id"]
+	labeler_name = incoming_data["labeler_name"]
+	indices = incoming_data["indices"]
+	labels = incoming_data["labels"]
+	labeling_times = incoming_data.get("labeling_times")
+	seq = incoming_data.get("seq")
+
+	if not await check_task_exists(task_id):
+		return task_not_found(task_id)
+
+	if len(labels) != len(indices) or (labeling_times is not None and len(labeling_times) != len(indices)):
+		return error_response(400, "Got %d indices but %d labels" % (len(indices), len(labels)))
+
+	async with task_write_locks[task_id]:
+		num_datapoints = await run_blocking(task_store.get_num_datapoints, task_id)
+		if any(not isinstance(idx, int) or idx < 0 or idx >= num_datapoints for idx in indices):
+			return error_response(400, "Datapoint index out of range")
+
+		if not await run_blocking(task_store.set_labels, task_id, labeler_name, indices, labels, labeling_times, seq):
+			update_seq = await run_blocking(task_store.get_update_seq, task_id, labeler_name)
+			return JSONResponse({ "status" : "Duplicate", "seq" : update_seq })
+
+	return JSONResponse({ "status" : "Success", "seq" : seq })
+
+
+###############################################################
+# thumbnails and atlases of thumbnails (see server.py)
+###############################################################
+
+async def get_thumbnail(request):
+	url = request.query_params.get('url', '')
+	try:
+		size = get_thumbnail_size(int(request.query_params.get('size', THUMBNAIL_SIZES[-1])))
+	except ValueError:
+		size = THUMBNAIL_SIZES[-1]
+
+	filename = resolve_server_path(url)
+	if filename is None or not os.path.isfile(filename):
+		return error_response(404, "Image %s does not exist" % url)
+
+	# rendering a missing thumbnail decodes the image, so it runs in the executor
+	try:
+		(thumbnail_filename, digest) = await run_blocking(thumbnail_cache.get_thumbnail, filename, size)
+	except (OSError, ValueError):
+		return error_response(400, "Could not render a thumbnail of %s" % url)
+
+	headers = { 'Cache-Control' : 'public, max-age=%d' % THUMBNAIL_MAX_AGE, 'ETag' : '"%s_%d"' % (digest, size) }
+	if etag_matches(request, headers['ETag']):
+		return not_modified_response(headers)
+	stat = await run_blocking(os.stat, thumbnail_filename)
+	return FileResponse(thumbnail_filename, media_type='image/jpeg', headers=headers, stat_result=stat)
+
+
+async def get_atlas(request):
+	filename = request.path_params['path']
+	full_path = await run_blocking(find_atlas_file, filename)
+	if full_path is None:
+		return error_response(404, "Atlas %s does not exist" % filename)
+
+	# atlases are named by their content, so they never change
+	headers = { 'Cache-Control' : 'public, max-age=%d, immutable' % ATLAS_MAX_AGE }
+	stat = await run_blocking(os.stat, full_path)
+	response = FileResponse(full_path, media_type='image/jpeg', headers=headers, stat_result=stat)
+	if etag_matches(request, response.headers['etag']):
+		headers['ETag'] = response.headers['etag']
+		return not_modified_response(headers)
+	return response
+
+
+###############################################################
+# static files
+###############################################################
+
+# returns (filename, headers, stat) of the file to send for a request of path, or None
+# if there is no such file. Like server.py, the precompressed sidecar of a json file is
+# sent if there is one (see WeakDB.save_json())
+def find_static_file(path, accept_encoding):
+	full_path = os.path.realpath(os.path.join(SERVER_ROOT, path))
+	if os.path.commonpath([SERVER_ROOT, full_path]) != SERVER_ROOT or not os.path.isfile(full_path):
+		return None
+
+	headers = {}
+	filename = full_path
+	if full_path.endswith('.json'):
+		sidecars = {}
+		for encoding in compression.ENCODING_EXTENSIONS:
+			sidecar_filename = compression.find_sidecar(full_path, encoding)
+			if sidecar_filename is not None:
+				sidecars[encoding] = sidecar_filename
+
+		if len(sidecars) > 0:
+			headers['Vary'] = 'Accept-Encoding'
+			encoding = compression.negotiate_encoding(accept_encoding, list(sidecars))
+			if encoding is not None:
+				filename = sidecars[encoding]
+				headers['Content-Encoding'] = encoding
+
+	return (filename, headers, os.stat(filename))
+
+async def send_static_file(request):
+	path = request.path_params['path']
+	found = await run_blocking(find_static_file, path, request.headers.get('accept-encoding', ''))
+	if found is None:
+		return error_response(404, "File %s does not exist" % path)
+
+	(filename, headers, stat) = found
+	media_type = 'application/json' if path.endswith('.json') else None
+	response = FileResponse(filename, headers=headers, media_type=media_type, stat_result=stat)
+	if etag_matches(request, response.headers['etag']):
+		headers['ETag'] = response.headers['etag']
+		return not_modified_response(headers)
+	return response
+
+
+routes = [
+	Route('/labeling_api/get_task', instrumented(get_task)),
+	Route('/labeling_api/get_progress', instrumented(get_progress)),
+	Route('/labeling_api/get_atlas_index', instrumented(get_atlas_index)),
+	Route('/labeling_api/get_window', instrumented(get_window)),
+	Route('/labeling_api/store_labels', instrumented(store_labels), methods=["POST"]),
+	Route('/labeling_api/store_label_updates', instrumented(store_label_updates), methods=["POST"]),
+	Route('/thumbnail', instrumented(get_thumbnail)),
+	Route('/atlas/{path:path}', instrumented(get_atlas)),
+	Route('/metrics', get_metrics),
+	Route('/{path:path}', instrumented(send_static_file)),
+]
+
+app = Starlette(routes=routes)
+
+
+if __name__ == "__main__":
+
+	import uvicorn
+
+	parser = argparse.ArgumentParser(description="Asyncio labeling server")
+	parser.add_argument("--host", default="127.0.0.1")
+	parser.add_argument("--port", type=int, default=5000)
+	args = parser.parse_args()
+
+	uvicorn.run(app, host=args.host, port=args.port)
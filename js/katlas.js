@@ -0,0 +1,46 @@
+/*
+ * katlas.js
+ *
+ * Drawing thumbnails out of the atlases (sprite sheets) written by weakdb/atlases.py.
+ * A grid of thumbnails drawn from atlases needs one image request per atlas,
+ * rather than one per thumbnail.
+ */
+
+// a 1x1 transparent gif. Thumbnails are drawn as the background of an image with this source.
+var KATLAS_BLANK_IMAGE = "data:image/gif;base64,R0lGODlhAQABAIAAAAAAAP///yH5BAEAAAAALAAAAAABAAEAAAIBRAA7";
+
+class KAtlasIndex {
+
+	// index is the contents of an atlas index.json. The urls of the atlases in the
+	// index are relative to atlas_base_url
+	constructor(index, atlas_base_url) {
+		this.cell_size = index.cell_size;
+		this.atlases = index.atlases;
+		this.datapoints = index.datapoints;
+		this.atlas_base_url = atlas_base_url;
+	}
+
+	has_thumbnail(idx) {
+		return idx < this.datapoints.length && this.datapoints[idx] != null;
+	}
+
+	// returns the css style that draws the thumbnail of datapoint idx, letterboxed
+	// into an element of size panel_width x panel_height
+	get_thumbnail_style(idx, panel_width, panel_height) {
+		var rect = this.datapoints[idx];
+		var atlas = this.atlases[rect[0]];
+		var x = rect[1];
+		var y = rect[2];
+		var width = rect[3];
+		var height = rect[4];
+
+		var scale = Math.min(panel_width / width, panel_height / height);
+		var offset_x = (panel_width - width * scale) / 2 - x * scale;
+		var offset_y = (panel_height - height * scale) / 2 - y * scale;
+
+		return "background-image: url('" + this.atlas_base_url + atlas.url + "');" +
+			"background-repeat: no-repeat;" +
+			"background-position: " + offset_x + "px " + offset_y + "px;" +
+			"background-size: " + (atlas.width * scale) + "px " + (atlas.height * scale) + "px;";
+	}
+}
@@ -17,13 +17,20 @@ class KGridOptions {
 		// cells can either be arranged in a 2D grid, or a single cell per row.
 		// This option is true if the layout is a single cell per row.
 		this.single_cell_per_row = false;
+
+		// optional KAtlasIndex (see katlas.js). If set, panels of cells that have datapoint
+		// indices are drawn out of the atlases instead of loading each image
+		this.atlas_index = null;
 	}
 }
 
 class KGridCell {
-	constructor(image_urls, text) {
+	constructor(image_urls, text, datapoint_indices = null) {
 		this.image_urls = image_urls;
 		this.text = text;
+
+		// index of the datapoint shown in each panel in KGridOptions.atlas_index
+		this.datapoint_indices = datapoint_indices;
 	}
 }
 
@@ -72,7 +79,14 @@ class KGrid {
 				var img_el = document.createElement('img');
 				img_el.onload = this.make_image_load_handler(img_el);
 				img_el.onclick = this.make_image_click_handler(img_el);
-				img_el.src = cell_data[i].image_urls[j];
+				var atlas_index = this.options.atlas_index;
+				var datapoint_indices = cell_data[i].datapoint_indices;
+				if (atlas_index != null && datapoint_indices != null && atlas_index.has_thumbnail(datapoint_indices[j])) {
+					img_el.src = KATLAS_BLANK_IMAGE;
+					img_el.style.cssText = atlas_index.get_thumbnail_style(datapoint_indices[j], this.options.panel_width, this.options.panel_width);
+				} else {
+					img_el.src = cell_data[i].image_urls[j];
+				}
 				img_el.style.width = "" + this.options.panel_width + "px";
 				img_el.style.height = "" + this.options.panel_width + "px";
 				img_el.classList.add("kgrid_image");
@@ -0,0 +1,64 @@
+/*
+ * lfmatrix.js
+ *
+ * Decoding the compact LF matrices written by weakdb/lfmatrix.py (packed 2 bit votes,
+ * or CSR of the non-abstain votes) into a flat, row major Int8Array of votes, which
+ * can be indexed like the plain lists of votes of older dumps.
+ */
+
+var LF_MATRIX_FORMAT_PACKED = "packed2";
+var LF_MATRIX_FORMAT_CSR = "csr";
+
+// the vote of each 2 bit code
+var LF_MATRIX_CODE_VOTES = [0, 1, 0, -1];
+
+var LF_MATRIX_ARRAY_TYPES = {
+	"int8" : Int8Array,
+	"uint8" : Uint8Array,
+	"uint16" : Uint16Array,
+	"uint32" : Uint32Array,
+};
+
+// decodes an array encoded by weakdb/lfmatrix.py's encode_array() (base64 encoded little
+// endian bytes. Typed arrays use the platform's byte order, which is little endian on all
+// browsers' platforms)
+function decode_lf_matrix_array(encoded) {
+	var str = atob(encoded.data);
+	var bytes = new Uint8Array(str.length);
+	for (var i = 0; i < str.length; i++)
+		bytes[i] = str.charCodeAt(i);
+	var array_type = LF_MATRIX_ARRAY_TYPES[encoded.dtype];
+	return new array_type(bytes.buffer, 0, bytes.length / array_type.BYTES_PER_ELEMENT);
+}
+
+// returns the votes of an LF matrix as a flat array. data is the contents of an LF matrix
+// json file: a compact LF matrix, or (in dumps written with compact_lf_matrix=False) already
+// a flat list of votes
+function decode_lf_matrix(data) {
+	if (Array.isArray(data))
+		return data;
+
+	var votes = new Int8Array(data.num_rows * data.num_lf);
+
+	if (data.format == LF_MATRIX_FORMAT_PACKED) {
+		var packed = decode_lf_matrix_array(data.data);
+		for (var i = 0; i < votes.length; i++)
+			votes[i] = LF_MATRIX_CODE_VOTES[(packed[i >> 2] >> ((i & 3) * 2)) & 3];
+
+	} else if (data.format == LF_MATRIX_FORMAT_CSR) {
+		var row_counts = decode_lf_matrix_array(data.row_counts);
+		var lfs = decode_lf_matrix_array(data.lfs);
+		var lf_votes = decode_lf_matrix_array(data.votes);
+		var pos = 0;
+		for (var row = 0; row < data.num_rows; row++) {
+			var base = row * data.num_lf;
+			for (var end = pos + row_counts[row]; pos < end; pos++)
+				votes[base + lfs[pos]] = lf_votes[pos];
+		}
+
+	} else {
+		console.log("ERROR: unknown LF matrix format " + data.format);
+	}
+
+	return votes;
+}
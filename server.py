@@ -1,26 +1,265 @@
-from flask import Flask, jsonify, request, abort
+from flask import Flask, Response, g, jsonify, request, abort, send_file
+from werkzeug.security import safe_join
 import uuid
 import os
 import json
+import time
 
 # HACK(kayvonf): remove me
 import sys
 sys.path.append('weakdb')
-from labelingtask import LabelingTask
+import compression
+import lfmatrix
+import metrics
+import taskwindows
+from taskstore import JSONTaskStore, SQLiteTaskStore
+from thumbnails import THUMBNAIL_SIZES, ThumbnailCache, get_thumbnail_size
+from atlases import get_atlas_index_filename, is_atlas_filename
+
+from weakdb import WeakDB
+from shards import ShardedDump, get_sharded_manifest_filename, is_sharded_dump
 
 
 LABELING_RESULTS_DIR = 'labeling_results'
 
+# where labeling tasks are stored:
+#  -- "json": one json file per task in LABELING_RESULTS_DIR
+#  -- "sqlite": an sqlite database (LABELING_TASK_DB). Use taskstore.py to import existing json tasks.
+LABELING_TASK_STORE = 'json'
+LABELING_TASK_DB = os.path.join(LABELING_RESULTS_DIR, 'tasks.db')
+
+# memory budget for the cache of parsed labeling tasks (and their serialized responses)
+TASK_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# where rendered thumbnails of datapoint images are cached (see weakdb/thumbnails.py), and
+# how long browsers may cache a thumbnail (in seconds) before revalidating it
+THUMBNAIL_CACHE_DIR = 'thumbnail_cache'
+THUMBNAIL_MAX_AGE = 7 * 24 * 60 * 60
+
+# how long browsers may cache a versioned WeakDB dump file (see WeakDB.save_json())
+DUMP_FILE_MAX_AGE = 365 * 24 * 60 * 60
+
+# how long browsers may cache an atlas image. Atlases are named by their content, so they never change
+ATLAS_MAX_AGE = 365 * 24 * 60 * 60
+
+# tasks with at least this many datapoints are serialized (and compressed) as they are sent,
+# rather than serialized in memory and cached, so large tasks don't hold several copies
+# of their json in memory
+STREAM_TASK_MIN_DATAPOINTS = 100000
+
+# number of datapoints returned by the weakdb range API when the client doesn't specify a count
+WEAKDB_API_DEFAULT_COUNT = 1000
+
+# record request, task and WeakDB timings, served at /metrics (see weakdb/metrics.py).
+# SERVER_TRACE_MEMORY also records the peak memory of WeakDB stages, but slows down allocations
+SERVER_METRICS = True
+SERVER_TRACE_MEMORY = False
+
+# if set, requests with a 'profile' query parameter are run under cProfile, and the
+# profile is written to this directory (<endpoint>_<time>.prof)
+PROFILE_DIR = None
+
 app = Flask(__name__, static_url_path='/', static_folder='')
 
+if LABELING_TASK_STORE == 'sqlite':
+	task_store = SQLiteTaskStore(LABELING_TASK_DB)
+else:
+	task_store = JSONTaskStore(LABELING_RESULTS_DIR, TASK_CACHE_MAX_BYTES)
+
+thumbnail_cache = ThumbnailCache(THUMBNAIL_CACHE_DIR)
+
+if SERVER_METRICS:
+	metrics.enable(trace_memory=SERVER_TRACE_MEMORY)
+
+# returns the real path of a file or directory given by a (client provided) path
+# relative to the server root, or None if the path is outside of the server root
+def resolve_server_path(path):
+	root = os.path.realpath('.')
+	full_path = os.path.realpath(path.lstrip('/'))
+	if len(path) == 0 or os.path.commonpath([root, full_path]) != root:
+		return None
+	return full_path
+
 
 ###############################################################
-# functionality for supporting labeling tasks
+# metrics and profiling
+###############################################################
+
+REQUEST_SECONDS = metrics.histogram("weakdb_http_request_duration_seconds", "Time taken to handle requests", ["endpoint", "method"])
+REQUESTS = metrics.counter("weakdb_http_requests_total", "Requests handled", ["endpoint", "method", "status"])
+REQUEST_BYTES = metrics.counter("weakdb_http_request_bytes_total", "Bytes of request bodies received", ["endpoint"])
+RESPONSE_BYTES = metrics.counter("weakdb_http_response_bytes_total", "Bytes of response bodies sent", ["endpoint"])
+
+@app.before_request
+def start_request_timer():
+	g.request_start = time.perf_counter()
+
+# runs after the other after_request handlers (they run in the reverse order they are
+# registered in), so the response sizes are those of the compressed responses. Streamed
+# responses (of unknown length) are only recorded once their body has been sent
+@app.after_request
+def record_request_metrics(response):
+	endpoint = request.endpoint or 'unknown'
+	REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+	REQUEST_BYTES.inc(request.content_length or 0, endpoint=endpoint)
+	if response.is_streamed and response.content_length is None and response.status_code != 304 and request.method != 'HEAD':
+		response.response = record_streamed_response(response.response, response.iter_encoded(),
+			g.request_start, endpoint, request.method)
+		return response
+	REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, endpoint=endpoint, method=request.method)
+	RESPONSE_BYTES.inc(response.content_length or 0, endpoint=endpoint)
+	return response
+
+# yields the (encoded) chunks of a streamed response's body, and records the request's
+# latency and the response's size once the body is sent (or the client goes away)
+def record_streamed_response(body, chunks, start, endpoint, method):
+	num_bytes = 0
+	try:
+		for chunk in chunks:
+			num_bytes += len(chunk)
+			yield chunk
+	finally:
+		if hasattr(body, 'close'):
+			body.close()
+		REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, method=method)
+		RESPONSE_BYTES.inc(num_bytes, endpoint=endpoint)
+
+# handles requests with a 'profile' query parameter under cProfile (if PROFILE_DIR is set)
+@app.before_request
+def profile_request():
+	if PROFILE_DIR is None or 'profile' not in request.args or request.endpoint not in app.view_functions:
+		return None
+	filename = os.path.join(PROFILE_DIR, "%s_%d.prof" % (request.endpoint, time.time_ns()))
+	with metrics.profile(filename):
+		return app.ensure_sync(app.view_functions[request.endpoint])(**request.view_args)
+
+# metrics in the Prometheus text format
+@app.route('/metrics')
+def get_metrics():
+	return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+###############################################################
+# response compression and caching
+###############################################################
+
+# Clients that send an Accept-Encoding header get gzip (or brotli, if installed)
+# compressed responses. JSON responses to GET requests carry a strong ETag, so a
+# client can revalidate a response it already has (If-None-Match) and get back an
+# empty 304 response if it hasn't changed.
+
+# returns the content encoding to use for the current request (None for no compression)
+def get_response_encoding(encodings=None):
+	if encodings is None:
+		encodings = compression.get_encodings()
+	return request.accept_encodings.best_match(encodings)
+
+# compress (and tag) JSON API responses that weren't already compressed by the handler
+@app.after_request
+def compress_response(response):
+	if request.method != 'GET' or response.status_code != 200 or response.direct_passthrough \
+		or response.is_streamed or response.mimetype != 'application/json':
+		return response
+
+	if 'Content-Encoding' not in response.headers:
+		response.vary.add('Accept-Encoding')
+		encoding = get_response_encoding()
+		if encoding is not None and response.content_length >= compression.MIN_COMPRESS_BYTES:
+			response.set_data(compression.compress(response.get_data(), encoding))
+			response.headers['Content-Encoding'] = encoding
+
+	response.add_etag()
+	return response.make_conditional(request)
+
+
+# lfviz loads WeakDB json dumps as static files. If the dump was written with compressed
+# sidecars (see WeakDB.save_json()), send the sidecar instead of compressing the file on
+# every request
+def send_static_file(filename):
+	path = safe_join(app.static_folder, filename)
+	if not filename.endswith('.json') or path is None or not os.path.isfile(path):
+		return app.send_static_file(filename)
+
+	sidecars = {}
+	for encoding in compression.ENCODING_EXTENSIONS:
+		sidecar_filename = compression.find_sidecar(path, encoding)
+		if sidecar_filename is not None:
+			sidecars[encoding] = sidecar_filename
+
+	# lfviz requests dump files at urls holding the file's version (?v=<VERSION>), which
+	# change whenever the file does, so they can be cached
+	versioned = ('v' in request.args)
+	max_age = DUMP_FILE_MAX_AGE if versioned else None
+
+	encoding = get_response_encoding(list(sidecars)) if len(sidecars) > 0 else None
+	if encoding is None:
+		response = send_file(path, mimetype='application/json', conditional=True, max_age=max_age)
+	else:
+		response = send_file(sidecars[encoding], mimetype='application/json', conditional=True, max_age=max_age)
+		response.headers['Content-Encoding'] = encoding
+	if len(sidecars) > 0:
+		response.vary.add('Accept-Encoding')
+	if versioned:
+		response.cache_control.public = True
+		response.cache_control.immutable = True
+	return response
+
+app.view_functions['static'] = send_static_file
+
+
 ###############################################################
+# thumbnails of datapoint images
+###############################################################
+
+# return a thumbnail of the image at url (a path relative to the server root) that is
+# at least size pixels wide or tall (if the image is that large). Thumbnails are only
+# rendered at a few fixed sizes (see weakdb/thumbnails.py), and are rendered on the
+# first request for them, then served from the thumbnail cache
+@app.route('/thumbnail')
+def get_thumbnail():
+	url = request.args.get('url', '')
+	size = get_thumbnail_size(request.args.get('size', THUMBNAIL_SIZES[-1], type=int))
+
+	filename = resolve_server_path(url)
+	if filename is None or not os.path.isfile(filename):
+		abort(404, description="Image %s does not exist" % url)
+
+	try:
+		(thumbnail_filename, digest) = thumbnail_cache.get_thumbnail(filename, size)
+	except (OSError, ValueError):
+		abort(400, description="Could not render a thumbnail of %s" % url)
+
+	response = send_file(thumbnail_filename, mimetype='image/jpeg', conditional=True,
+		etag="%s_%d" % (digest, size), max_age=THUMBNAIL_MAX_AGE)
+	response.cache_control.public = True
+	return response
 
 
-def make_filename(name):
-	return os.path.join(LABELING_RESULTS_DIR, "%s.json" % name)
+# the real path of the atlas image filename (relative to the server root), or None if
+# there is no such atlas
+def find_atlas_file(filename):
+	full_path = resolve_server_path(filename)
+	if full_path is None or not is_atlas_filename(full_path) or not os.path.isfile(full_path):
+		return None
+	return full_path
+
+# return an atlas of thumbnails (see weakdb/atlases.py). filename is the path of the
+# atlas image relative to the server root, e.g., lfviz_assets/<DUMPNAME>_atlas/<HASH>.jpg
+@app.route('/atlas/<path:filename>')
+def get_atlas(filename):
+	full_path = find_atlas_file(filename)
+	if full_path is None:
+		abort(404, description="Atlas %s does not exist" % filename)
+
+	response = send_file(full_path, mimetype='image/jpeg', conditional=True, max_age=ATLAS_MAX_AGE)
+	response.cache_control.public = True
+	response.cache_control.immutable = True
+	return response
+
+
+###############################################################
+# functionality for supporting labeling tasks
+###############################################################
 
 
 # report API errors using JSON responses
@@ -28,20 +267,80 @@ def make_filename(name):
 def resource_not_found(e):
     return jsonify(error=str(e)), 404
 
+@app.errorhandler(400)
+def bad_request(e):
+    return jsonify(error=str(e)), 400
+
+
+def check_task_exists(task_id):
+	if task_id is None or not task_store.has_task(task_id):
+		abort(404, description="Task %s does not exist" % task_id)
+
 
 # return information about a labeling task
 # For now just return all information
+#
+# The serialized (and compressed) task is cached by the task store, along with its
+# ETag, so a client reloading an unchanged task only gets back a 304. Large tasks
+# are streamed instead (see STREAM_TASK_MIN_DATAPOINTS)
 @app.route('/labeling_api/get_task')
 def get_labels():
 	task_id = request.args.get('task_id')
-	filename = make_filename(task_id)
+	check_task_exists(task_id)
 
-	if os.path.exists(filename):
-		task = LabelingTask()
-		task.load(filename)
-		return jsonify(task.to_dict())
+	encoding = get_response_encoding()
+	if task_store.get_num_datapoints(task_id) >= STREAM_TASK_MIN_DATAPOINTS:
+		(body, etag) = task_store.get_task_stream(task_id, encoding)
 	else:
-		abort(404, description="Task %s does not exist" % task_id)
+		(body, etag) = task_store.get_task_response(task_id, encoding)
+
+	response = Response(body, mimetype='application/json')
+	if encoding is not None:
+		response.headers['Content-Encoding'] = encoding
+	response.vary.add('Accept-Encoding')
+	if etag is not None:
+		response.set_etag(etag)
+	response.cache_control.no_cache = True
+	# make_conditional() would otherwise read a streamed body to compute its length
+	response.automatically_set_content_length = not response.is_streamed
+	return response.make_conditional(request)
+
+
+# return the atlas index of a task's images (see LabelingTask.save_atlases()), with
+# the urls of the atlases pointing at /atlas
+@app.route('/labeling_api/get_atlas_index')
+def get_atlas_index():
+	task_id = request.args.get('task_id')
+	check_task_exists(task_id)
+
+	index = load_task_atlas_index(task_id)
+	if index is None:
+		abort(404, description="Task %s has no atlases" % task_id)
+	return jsonify(index)
+
+# the atlas index of a task, with the urls of the atlases pointing at /atlas, or None if
+# the task has no atlases (shared with async_server.py)
+def load_task_atlas_index(task_id):
+	atlas_dir = os.path.join(LABELING_RESULTS_DIR, "%s_atlas" % task_id)
+	index_filename = get_atlas_index_filename(atlas_dir)
+	if not os.path.exists(index_filename):
+		return None
+
+	with open(index_filename, "rt") as f:
+		index = json.load(f)
+	for atlas in index["atlases"]:
+		atlas["url"] = "/atlas/%s/%s" % (atlas_dir, atlas["url"])
+	return index
+
+
+# return the number of datapoints labeled by each labeler of a task
+@app.route('/labeling_api/get_progress')
+def get_progress():
+	task_id = request.args.get('task_id')
+	check_task_exists(task_id)
+	return jsonify(task_id=task_id,
+		num_datapoints=task_store.get_num_datapoints(task_id),
+		num_labeled=task_store.get_progress(task_id))
 
 
 # accept an updated set of labels from the client
@@ -50,39 +349,270 @@ def get_labels():
 #  -- a labeler name
 #  -- and a list of categorical labels for all task datapoints
 #
-# The function will update the task's json file with this information.
+# The function will update the task with this information.
 # If the labeler's results already existed, we'll replace them. If there are no
 # results for this labeler we'll add the labeler
+#
+# Only the labels that changed are written (see taskstore.py)
 @app.route('/labeling_api/store_labels', methods=["POST"])
 def store_labels():
 
-	incoming_data = request.get_json()
+	with metrics.TASK_SECONDS.time(operation="parse_request"):
+		incoming_data = request.get_json()
 
 	task_id = incoming_data["task_id"]
 	labeler_name = incoming_data["labeler_name"]
 	labels = incoming_data["labels"]
 	labeling_times = incoming_data["labeling_times"]
 
-	filename = make_filename(task_id)
-
-	print("Saving to: %s" % filename)
+	print("Saving to: %s" % task_id)
 
-	if os.path.exists(filename):
-		task = LabelingTask()
-		task.load(filename)
+	if task_store.has_task(task_id):
+		num_datapoints = task_store.get_num_datapoints(task_id)
 
 		# FIXME(kayvonf): shouldn't be a 404
-		if task.get_num_datapoints() != len(labels):
-			error_msg = "Incorrect number of datapoints: got %d, expected %d" % (len(results), task.get_num_datapoints())
+		if num_datapoints != len(labels):
+			error_msg = "Incorrect number of datapoints: got %d, expected %d" % (len(labels), num_datapoints)
 			abort(404, description=error_msg)
 
-		task.add_labeler_results(labeler_name, labels)
-		task.add_labeling_times(labeler_name, labeling_times)
-		task.save(filename)
+		task_store.replace_labeler_results(task_id, labeler_name, labels, labeling_times)
 
 
 	return jsonify("Success")
 
 
+# accept a sparse update of a labeler's labels from the client
+# the provided information will be:
+#  -- a task id
+#  -- a labeler name
+#  -- the indices of the updated datapoints
+#  -- the new labels (and optionally labeling times) of those datapoints
+#  -- optionally, a sequence number for the update
+#
+# Unlike store_labels, only the updated datapoints are sent. If a sequence number is
+# given, updates with a sequence number no greater than the last applied update from
+# the labeler are ignored, so clients can safely resend an update.
+@app.route('/labeling_api/store_label_updates', methods=["POST"])
+def store_label_updates():
+
+	with metrics.TASK_SECONDS.time(operation="parse_request"):
+		incoming_data = request.get_json()
+
+	task_id = incoming_data["task_id"]
+	labeler_name = incoming_data["labeler_name"]
+	indices = incoming_data["indices"]
+	labels = incoming_data["labels"]
+	labeling_times = incoming_data.get("labeling_times")
+	seq = incoming_data.get("seq")
+
+	check_task_exists(task_id)
+
+	if len(labels) != len(indices) or (labeling_times is not None and len(labeling_times) != len(indices)):
+		abort(400, description="Got %d indices but %d labels" % (len(indices), len(labels)))
+
+	num_datapoints = task_store.get_num_datapoints(task_id)
+	if any(not isinstance(idx, int) or idx < 0 or idx >= num_datapoints for idx in indices):
+		abort(400, description="Datapoint index out of range")
+
+	if not task_store.set_labels(task_id, labeler_name, indices, labels, labeling_times, seq):
+		return jsonify(status="Duplicate", seq=task_store.get_update_seq(task_id, labeler_name))
+
+	return jsonify(status="Success", seq=seq)
+
+
+# return a window of a task's datapoints for one labeler, with only that labeler's labels
+# for them, so a labeler can work through a large task without downloading all of it
+# (see weakdb/taskwindows.py):
+#  -- task_id and labeler (the labeler's name)
+#  -- select=unlabeled (the default): the next count datapoints from datapoint start on that
+#     the labeler hasn't labeled
+#  -- select=uncertainty: the next count datapoints the labeler hasn't labeled, most uncertain
+#     prob label first, from position start of that order on. dump= names a (columnar or
+#     sharded) WeakDB dump with the prob labels of the task's datapoints (ext=ext for the
+#     extended prob labels)
+#  -- select=range: datapoints [start, start+count)
+#
+# The response's "next" holds the start of the following window and the urls of its
+# datapoints, so the client can prefetch their images.
+@app.route('/labeling_api/get_window')
+def get_window():
+	task_id = request.args.get('task_id')
+	check_task_exists(task_id)
+
+	labeler_name = request.args.get('labeler', '')
+	select = request.args.get('select', taskwindows.WINDOW_SELECT_UNLABELED)
+	start = request.args.get('start', 0, type=int)
+	count = request.args.get('count', taskwindows.DEFAULT_WINDOW_SIZE, type=int)
+	if len(labeler_name) == 0:
+		abort(400, description="No labeler given")
+	if select not in taskwindows.WINDOW_SELECTIONS:
+		abort(400, description="Invalid selection: %s" % select)
+	if start < 0 or count <= 0 or count > taskwindows.MAX_WINDOW_SIZE:
+		abort(400, description="Invalid window: start=%d, count=%d" % (start, count))
+
+	order = None
+	if select == taskwindows.WINDOW_SELECT_UNCERTAINTY:
+		(order, error) = get_dump_uncertainty_order(request.args.get('dump', ''), get_ext_arg(), task_store.get_num_datapoints(task_id))
+		if order is None:
+			abort(400, description=error)
+
+	return jsonify(taskwindows.get_window(task_store, task_id, labeler_name, select, start, count, order))
+
+
+###############################################################
+# functionality for serving ranges of weakdb dumps
+###############################################################
+
+# The weakdb API serves slices of dumps written by WeakDB.save_columnar(), so that
+# lfviz can page in data instead of downloading the full json dump up front.
+# Every request names the dump via the 'dump' parameter: the path (relative to
+# the server root) of the dump's columnar directory, or of a sharded dump's directory
+# (see weakdb/shards.py). Dumps are memory mapped, so a request only reads the rows
+# it returns (and, for sharded dumps, only opens the shards they are in).
+
+# opened dumps, keyed by path. Entries are (manifest mtime, WeakDB or ShardedDump)
+open_dumps = {}
+
+# returns the dump (WeakDB or ShardedDump) at full_path, or None if there is no dump there
+def open_dump(full_path):
+	sharded = is_sharded_dump(full_path)
+	if sharded:
+		manifest_filename = get_sharded_manifest_filename(full_path)
+	else:
+		manifest_filename = WeakDB().get_columnar_manifest_filename(full_path)
+	if not os.path.exists(manifest_filename):
+		return None
+
+	# reopen the dump if it has been rewritten since it was opened
+	mtime = os.path.getmtime(manifest_filename)
+	if full_path not in open_dumps or open_dumps[full_path][0] != mtime:
+		if sharded:
+			db = ShardedDump(full_path)
+		else:
+			db = WeakDB()
+			db.load(full_path, mmap=True)
+		open_dumps[full_path] = (mtime, db)
+	return open_dumps[full_path][1]
+
+def get_dump():
+	dump_path = request.args.get('dump', '')
+	full_path = resolve_server_path(dump_path)
+	if full_path is None:
+		abort(400, description="Invalid dump path: %s" % dump_path)
+
+	db = open_dump(full_path)
+	if db is None:
+		abort(404, description="Dump %s does not exist" % dump_path)
+	return db
+
+# uncertainty orders (see weakdb/taskwindows.py) of the prob labels of opened dumps, keyed
+# by (path, extended). Entries are (dump, order)
+uncertainty_orders = {}
+
+# returns (order, None), where order is the uncertainty order of the prob labels of the
+# dump at dump_path, or (None, error description) if there is no such dump or it doesn't
+# have prob labels for num_datapoints datapoints
+def get_dump_uncertainty_order(dump_path, extended, num_datapoints):
+	full_path = resolve_server_path(dump_path)
+	db = None if full_path is None else open_dump(full_path)
+	if db is None:
+		return (None, "Dump %s does not exist" % dump_path)
+	if db.num_train + db.num_val != num_datapoints:
+		return (None, "Dump %s has %d datapoints, the task has %d" % (dump_path, db.num_train + db.num_val, num_datapoints))
+	if extended and not db.get_dump_info()["has_extended_data"]:
+		return (None, "Dump %s has no extended prob labels" % dump_path)
+
+	key = (full_path, extended)
+	entry = uncertainty_orders.get(key)
+	if entry is None or entry[0] is not db:
+		prob_labels = db.get_prob_labels_rows(0, num_datapoints, extended=extended)
+		entry = (db, taskwindows.get_uncertainty_order(prob_labels))
+		uncertainty_orders[key] = entry
+	return (entry[1], None)
+
+def get_range_args():
+	start = request.args.get('start', 0, type=int)
+	count = request.args.get('count', WEAKDB_API_DEFAULT_COUNT, type=int)
+	if start < 0 or count < 0:
+		abort(400, description="Invalid range: start=%d, count=%d" % (start, count))
+	return (start, count)
+
+def get_ext_arg():
+	return request.args.get('ext', 'noext') == 'ext'
+
+
+# return the dump info (the same contents as the info file of the json dump)
+@app.route('/weakdb_api/info')
+def get_dump_info():
+	db = get_dump()
+	return jsonify(db.get_dump_info())
+
+
+# return rows [start, start+count) of the LF matrix as a list of rows
+# -- ext=ext to get the extended LF matrix
+# -- lfs=<comma separated LF indices> to only return a subset of the LFs
+# -- format=compact to get the rows in a compact format (see weakdb/lfmatrix.py and js/lfmatrix.js)
+@app.route('/weakdb_api/lf_matrix')
+def get_lf_matrix():
+	db = get_dump()
+	(start, count) = get_range_args()
+	extended = get_ext_arg()
+	if extended and not db.get_dump_info()["has_extended_data"]:
+		abort(404, description="Dump has no extended LF matrix")
+
+	lfs = None
+	if 'lfs' in request.args:
+		try:
+			lfs = [int(lf) for lf in request.args['lfs'].split(',')]
+		except ValueError:
+			abort(400, description="Invalid LF list: %s" % request.args['lfs'])
+		if any(lf < 0 or lf >= db.num_lf for lf in lfs):
+			abort(400, description="LF index out of range")
+
+	rows = db.get_lf_matrix_rows(start, count, extended=extended, lfs=lfs)
+	if request.args.get('format') == 'compact':
+		return jsonify(start=start, count=len(rows), lfs=lfs, lf_matrix=lfmatrix.compact_lf_matrix(rows).to_json())
+	return jsonify(start=start, count=len(rows), lfs=lfs, lf_matrix=rows.tolist())
+
+
+# return entries [start, start+count) of the label model output (ext=ext for the extended output)
+@app.route('/weakdb_api/prob_labels')
+def get_prob_labels():
+	db = get_dump()
+	(start, count) = get_range_args()
+	prob_labels = db.get_prob_labels_rows(start, count, extended=get_ext_arg())
+	return jsonify(start=start, count=len(prob_labels), prob_labels=prob_labels.tolist())
+
+
+@app.route('/weakdb_api/ground_truth')
+def get_ground_truth():
+	db = get_dump()
+	(start, count) = get_range_args()
+	labels = db.get_ground_truth_rows(start, count)
+	return jsonify(start=start, count=len(labels), ground_truth_labels=labels.tolist())
+
+
+@app.route('/weakdb_api/datapoints')
+def get_datapoints():
+	db = get_dump()
+	(start, count) = get_range_args()
+	datapoints = db.get_datapoints_rows(start, count)
+	return jsonify(start=start, count=len(datapoints), datapoints=datapoints)
+
 
+# return the (up to count) nearest neighbors of datapoint idx, closest first
+@app.route('/weakdb_api/neighbors')
+def get_neighbors():
+	db = get_dump()
+	idx = request.args.get('idx', -1, type=int)
+	count = request.args.get('count', None, type=int)
+	if count is not None and count < 0:
+		abort(400, description="Invalid count: %d" % count)
+	if idx < 0 or idx >= db.num_train + db.num_val or not db.get_dump_info()["has_similarity_data"]:
+		abort(404, description="No neighbors for datapoint %d" % idx)
 
+	(indices, scores) = db.get_neighbors(idx, count)
+	response = { "idx" : idx, "neighbors" : indices.tolist() }
+	if scores is not None:
+		response["scores"] = scores.tolist()
+	return jsonify(response)
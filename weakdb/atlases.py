@@ -0,0 +1,132 @@
+import concurrent.futures
+import hashlib
+import io
+import json
+import os
+
+from PIL import Image
+
+try:
+	from .thumbnails import THUMBNAIL_CACHE_DIR, ThumbnailCache, is_local_url
+except ImportError:
+	from thumbnails import THUMBNAIL_CACHE_DIR, ThumbnailCache, is_local_url
+
+
+# Atlases (sprite sheets) of datapoint thumbnails, so that grid views can show
+# thousands of datapoints with a few dozen image requests.
+#
+# Each atlas is a grid of ATLAS_COLUMNS x ATLAS_ROWS square cells of cell_size
+# pixels, each holding one thumbnail (see thumbnails.py), centered in the cell.
+# The atlases of a dump or task live in an atlas directory, along with an index
+# (index.json):
+#
+#   { "cell_size" : 128,
+#     "atlases" : [ { "url" : <atlas filename, relative to the atlas directory>,
+#                     "width" : <pixels>, "height" : <pixels> }, ... ],
+#     "datapoints" : [ [atlas, x, y, width, height], ... ] }
+#
+# where datapoints[i] is the rectangle of datapoint i's thumbnail in atlases[atlas]
+# (or null if datapoint i has no thumbnail, e.g., it isn't a local image).
+# Atlas images are named by the hash of their contents, so they can be cached by
+# clients forever.
+
+ATLAS_CELL_SIZE = 128
+ATLAS_COLUMNS = 16
+ATLAS_ROWS = 16
+ATLAS_QUALITY = 85
+ATLAS_BACKGROUND = (160, 160, 160)
+
+ATLAS_INDEX_FILENAME = "index.json"
+
+
+def get_atlas_index_filename(atlas_dir):
+	return os.path.join(atlas_dir, ATLAS_INDEX_FILENAME)
+
+# true if filename looks like an atlas image (a content hash named jpeg in an atlas directory)
+def is_atlas_filename(filename):
+	(atlas_dir, name) = os.path.split(filename)
+	(digest, ext) = os.path.splitext(name)
+	return atlas_dir.endswith("_atlas") and ext == ".jpg" and len(digest) == 40 \
+		and all(c in "0123456789abcdef" for c in digest)
+
+
+# packs the thumbnails of image filenames (None for datapoints without an image) into
+# one atlas saved in atlas_dir. Returns (atlas info, thumbnail rectangles)
+def pack_atlas(filenames, atlas_dir, cell_size, columns, thumbnail_cache_dir):
+	cache = ThumbnailCache(thumbnail_cache_dir)
+	rows = (len(filenames) + columns - 1) // columns
+	atlas = Image.new("RGB", (columns * cell_size, rows * cell_size), ATLAS_BACKGROUND)
+
+	rects = []
+	for (i, filename) in enumerate(filenames):
+		rect = None
+		if filename is not None:
+			try:
+				(thumbnail_filename, digest) = cache.get_thumbnail(filename, cell_size)
+				with Image.open(thumbnail_filename) as thumbnail:
+					x = (i % columns) * cell_size + (cell_size - thumbnail.width) // 2
+					y = (i // columns) * cell_size + (cell_size - thumbnail.height) // 2
+					atlas.paste(thumbnail, (x, y))
+					rect = [x, y, thumbnail.width, thumbnail.height]
+			except (OSError, ValueError) as e:
+				print("Failed to add %s to atlas: %s" % (filename, e))
+		rects.append(rect)
+
+	buf = io.BytesIO()
+	atlas.save(buf, "JPEG", quality=ATLAS_QUALITY, optimize=True)
+	data = buf.getvalue()
+
+	atlas_filename = "%s.jpg" % hashlib.sha1(data).hexdigest()
+	tmp_filename = os.path.join(atlas_dir, "%s.%d.tmp" % (atlas_filename, os.getpid()))
+	with open(tmp_filename, "wb") as f:
+		f.write(data)
+	os.replace(tmp_filename, os.path.join(atlas_dir, atlas_filename))
+
+	return ({ "url" : atlas_filename, "width" : atlas.width, "height" : atlas.height }, rects)
+
+
+# builds the atlases (and index) of a list of image filenames in atlas_dir, packing
+# atlases in parallel across a pool of processes. Entries of filenames that are None
+# get no thumbnail. Atlases left over from a previous build are removed.
+def build_atlases(filenames, atlas_dir, cell_size=ATLAS_CELL_SIZE, columns=ATLAS_COLUMNS, rows=ATLAS_ROWS,
+	thumbnail_cache_dir=THUMBNAIL_CACHE_DIR, num_processes=None):
+
+	os.makedirs(atlas_dir, exist_ok=True)
+
+	atlas_capacity = columns * rows
+	batches = [filenames[i:i+atlas_capacity] for i in range(0, len(filenames), atlas_capacity)]
+	with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+		futures = [executor.submit(pack_atlas, batch, atlas_dir, cell_size, columns, thumbnail_cache_dir) for batch in batches]
+		results = [future.result() for future in futures]
+
+	atlases = []
+	datapoints = []
+	for (atlas_idx, (atlas, rects)) in enumerate(results):
+		atlases.append(atlas)
+		for rect in rects:
+			datapoints.append(None if rect is None else [atlas_idx] + rect)
+
+	index = { "cell_size" : cell_size, "atlases" : atlases, "datapoints" : datapoints }
+	index_filename = get_atlas_index_filename(atlas_dir)
+	with open(index_filename + ".tmp", "wt") as f:
+		f.write(json.dumps(index))
+	os.replace(index_filename + ".tmp", index_filename)
+
+	atlas_filenames = set(atlas["url"] for atlas in atlases)
+	for name in os.listdir(atlas_dir):
+		if is_atlas_filename(os.path.join(atlas_dir, name)) and name not in atlas_filenames:
+			os.remove(os.path.join(atlas_dir, name))
+
+	return index
+
+
+# returns the local image filename to put in an atlas for each datapoint url (None for
+# urls that aren't local images). Relative urls are relative to base_dir.
+def get_atlas_filenames(datapoint_urls, base_dir=""):
+	filenames = []
+	for url in datapoint_urls:
+		# image sequences are represented by their second image (like lfviz's grids)
+		if isinstance(url, list):
+			url = url[1] if len(url) > 1 else url[0]
+		filenames.append(os.path.join(base_dir, url) if is_local_url(url) else None)
+	return filenames
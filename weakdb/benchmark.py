@@ -0,0 +1,435 @@
+import argparse
+import concurrent.futures
+import contextlib
+import datetime
+import json
+import os
+import pickle
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import numpy
+
+from labelingtask import LabelingTask
+from weakdb import WeakDB
+
+
+# Benchmarks of WeakDB and the labeling server on synthetic data, at configurable scale
+# (up to millions of datapoints and hundreds of LFs). Each stage is timed, along with the
+# peak resident memory of the process during the stage, and the results are written as
+# json so runs (e.g., before and after a change) can be compared:
+#
+#    python weakdb/benchmark.py --preset medium --output before.json
+#    ... make changes ...
+#    python weakdb/benchmark.py --preset medium --output after.json --compare before.json
+#
+# Stages (see BENCHMARK_STAGES, select a subset with --stages):
+#   -- set_lf_matrix: set_lf_matrix() + set_extended_lf_matrix() of numpy (or, with
+#      --list-inputs, python list) LF matrices
+#   -- set_similarity_matrix: ranking a (num_train + num_val) x num_train similarity matrix
+#      (memory mapped from a .npy file). Skipped if the matrix is larger than --max-similarity-bytes
+#   -- set_embeddings: k nearest neighbor rankings from random embeddings
+#   -- extend_lfs: LF extension with random thresholds, then again with one changed threshold
+#   -- save_json: a full json dump, then a save of the unchanged dump (save_json_unchanged)
+#   -- load_linden: import of Linden style pkl files (the pkl distance matrices are
+#      --linden-train x --linden-train, so their size is set separately)
+#   -- server: --labelers concurrent clients each requesting get_task and posting
+#      store_labels --requests times against the Flask server's labeling API
+
+BENCHMARK_STAGES = ["set_lf_matrix", "set_similarity_matrix", "set_embeddings", "extend_lfs", "save_json", "load_linden", "server"]
+
+BENCHMARK_PRESETS = {
+	"small" : { "num_train" : 10000, "num_val" : 2000, "num_lf" : 20, "task_size" : 1000 },
+	"medium" : { "num_train" : 200000, "num_val" : 20000, "num_lf" : 100, "task_size" : 20000 },
+	"large" : { "num_train" : 2000000, "num_val" : 200000, "num_lf" : 200, "task_size" : 100000 },
+}
+
+# how often the memory sampler reads the resident set size
+MEMORY_SAMPLE_SECONDS = 0.01
+
+
+# resident set size of this process in bytes (the peak so far where /proc isn't available)
+def get_rss_bytes():
+	try:
+		with open("/proc/self/statm", "rt") as f:
+			return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except (OSError, ValueError):
+		import resource
+		maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		# ru_maxrss is in kilobytes on linux, bytes on macOS
+		return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+# samples the resident set size on a background thread, keeping the peak since the last reset()
+class MemorySampler:
+
+	def __init__(self):
+		self.peak = get_rss_bytes()
+		self.lock = threading.Lock()
+		self.stopped = threading.Event()
+		self.thread = threading.Thread(target=self.run, daemon=True)
+		self.thread.start()
+
+	def run(self):
+		while not self.stopped.wait(MEMORY_SAMPLE_SECONDS):
+			self.sample()
+
+	def sample(self):
+		rss = get_rss_bytes()
+		with self.lock:
+			self.peak = max(self.peak, rss)
+		return rss
+
+	# restarts peak tracking, returns the current rss
+	def reset(self):
+		rss = get_rss_bytes()
+		with self.lock:
+			self.peak = rss
+		return rss
+
+	def get_peak(self):
+		self.sample()
+		with self.lock:
+			return self.peak
+
+	def stop(self):
+		self.stopped.set()
+		self.thread.join()
+
+
+class Benchmark:
+
+	def __init__(self, config):
+		self.config = config
+		self.rng = numpy.random.default_rng(config["seed"])
+		self.memory = MemorySampler()
+		self.results = []
+
+	# times the body of a with block as stage name. The yielded dict is the stage's result,
+	# to which the caller can add extra results (e.g., request latencies)
+	@contextlib.contextmanager
+	def stage(self, name):
+		result = { "name" : name }
+		start_rss = self.memory.reset()
+		start = time.perf_counter()
+		yield result
+		seconds = time.perf_counter() - start
+		peak_rss = self.memory.get_peak()
+
+		result.update({ "seconds" : seconds, "start_rss_bytes" : start_rss, "peak_rss_bytes" : peak_rss })
+		self.results.append(result)
+		print("%-24s %10.3f s   peak rss %8.1f MB (+%.1f MB)" % (name, seconds, peak_rss / 1e6, (peak_rss - start_rss) / 1e6))
+
+	def skip(self, name, reason):
+		self.results.append({ "name" : name, "skipped" : reason })
+		print("%-24s skipped: %s" % (name, reason))
+
+	def get_num_rows(self):
+		return self.config["num_train"] + self.config["num_val"]
+
+	# a random LF matrix in which each vote is an abstain with probability abstain_rate
+	def random_lf_matrix(self, num_rows, num_lf):
+		abstain_rate = self.config["abstain_rate"]
+		p = [(1.0 - abstain_rate) / 2, abstain_rate, (1.0 - abstain_rate) / 2]
+		return self.rng.choice(numpy.array([-1, 0, 1], dtype=numpy.int8), size=(num_rows, num_lf), p=p)
+
+	def make_db(self):
+		config = self.config
+		num_rows = self.get_num_rows()
+		db = WeakDB(config["num_train"], config["num_val"], config["num_lf"])
+		db.set_name("benchmark")
+		db.set_description("Synthetic benchmark dump")
+		db.set_datapoints(WeakDB.DATAPOINT_TYPE_IMAGE_URL, ["images/image_%08d.jpg" % i for i in range(num_rows)])
+		db.set_prob_labels(self.rng.random(num_rows, dtype=numpy.float32))
+		db.set_extended_prob_labels(self.rng.random(num_rows, dtype=numpy.float32))
+		db.set_ground_truth(self.rng.integers(-1, 2, num_rows, dtype=numpy.int8))
+		return db
+
+	def bench_set_lf_matrix(self, db):
+		lf_matrix = self.random_lf_matrix(self.get_num_rows(), self.config["num_lf"])
+		extended_lf_matrix = numpy.where(lf_matrix == 0, self.random_lf_matrix(*lf_matrix.shape), lf_matrix)
+		if self.config["list_inputs"]:
+			lf_matrix = lf_matrix.reshape(-1).tolist()
+			extended_lf_matrix = extended_lf_matrix.reshape(-1).tolist()
+
+		with self.stage("set_lf_matrix") as extra:
+			db.set_lf_matrix(lf_matrix)
+			db.set_extended_lf_matrix(extended_lf_matrix)
+			extra["list_inputs"] = self.config["list_inputs"]
+
+	def bench_set_similarity_matrix(self, db, work_dir):
+		config = self.config
+		shape = (self.get_num_rows(), config["num_train"])
+		num_bytes = shape[0] * shape[1] * 4
+		if num_bytes > config["max_similarity_bytes"]:
+			self.skip("set_similarity_matrix", "%d byte similarity matrix is larger than --max-similarity-bytes" % num_bytes)
+			return
+
+		# written a block of rows at a time, so generating the matrix doesn't need it in memory
+		filename = os.path.join(work_dir, "similarity.npy")
+		sims = numpy.lib.format.open_memmap(filename, mode="w+", dtype=numpy.float32, shape=shape)
+		block_rows = max(1, (64 * 1024 * 1024) // (shape[1] * 4))
+		for start in range(0, shape[0], block_rows):
+			sims[start:start+block_rows] = self.rng.random((min(block_rows, shape[0] - start), shape[1]), dtype=numpy.float32)
+		sims.flush()
+		del sims
+
+		with self.stage("set_similarity_matrix") as extra:
+			db.set_similarity_matrix(filename, k=config["k"], keep_scores=True)
+			extra["k"] = config["k"]
+		os.remove(filename)
+
+	def bench_set_embeddings(self, db):
+		config = self.config
+		embeddings = self.rng.standard_normal((self.get_num_rows(), config["dim"]), dtype=numpy.float32)
+		index = "ivf" if config["ivf"] else None
+
+		with self.stage("set_embeddings") as extra:
+			db.set_embeddings(embeddings[:config["num_train"]], embeddings[config["num_train"]:], k=config["k"],
+				keep_scores=True, index=index, num_threads=config["threads"])
+			extra.update({ "k" : config["k"], "dim" : config["dim"], "index" : index })
+
+	def bench_extend_lfs(self, db):
+		if len(db.sorted_sims) == 0:
+			self.skip("extend_lfs", "no similarity scores (run set_similarity_matrix or set_embeddings)")
+			return
+
+		# thresholds around the median similarity, so that about half the abstains get extended
+		median = float(numpy.median(db.sorted_sims[:1000, 0]))
+		thresholds = median + self.rng.uniform(-0.1, 0.1, self.config["num_lf"])
+		with self.stage("extend_lfs"):
+			db.extend_lfs(thresholds, num_threads=self.config["threads"])
+
+		thresholds[0] = thresholds[0] + 0.05
+		with self.stage("extend_lfs_incremental") as extra:
+			extra["num_changed_lfs"] = len(db.extend_lfs(thresholds, num_threads=self.config["threads"]))
+
+	def bench_save_json(self, db, work_dir):
+		target_dir = os.path.join(work_dir, "dump")
+		os.makedirs(target_dir, exist_ok=True)
+
+		with self.stage("save_json") as extra:
+			db.save_json(target_dir, compress=self.config["compress"])
+			extra["compress"] = self.config["compress"]
+		extra["bytes"] = sum(os.path.getsize(os.path.join(target_dir, name)) for name in os.listdir(target_dir))
+
+		with self.stage("save_json_unchanged"):
+			db.save_json(target_dir, compress=self.config["compress"])
+
+	def bench_load_linden(self, work_dir):
+		config = self.config
+		num_train = config["linden_train"]
+		num_val = max(1, num_train // 5)
+		num_lf = config["num_lf"]
+		linden_dir = os.path.join(work_dir, "linden")
+		os.makedirs(linden_dir, exist_ok=True)
+
+		# Linden's tables: LF output, extended LF output, LM output (noext and ext), ground truth
+		for (split, num_rows, num_cols) in [("train", num_train, num_train), ("val", num_val, num_train)]:
+			lf_matrix = self.random_lf_matrix(num_rows, num_lf)
+			table = numpy.concatenate([lf_matrix, lf_matrix, self.rng.random((num_rows, 2)), self.rng.integers(-1, 2, (num_rows, 1))], axis=1)
+			with open(os.path.join(linden_dir, "benchmark_%s.pkl" % split), "wb") as f:
+				pickle.dump(table, f)
+			with open(os.path.join(linden_dir, "benchmark_%s_paths.pkl" % split), "wb") as f:
+				pickle.dump(["%s/clip_%08d.mp4" % (split, i) for i in range(num_rows)], f)
+			# (the training set is most similar to itself)
+			dists = self.rng.random((num_rows, num_cols), dtype=numpy.float32)
+			if split == "train":
+				numpy.fill_diagonal(dists, 1.0)
+			with open(os.path.join(linden_dir, "benchmark_%s_dists.pkl" % split), "wb") as f:
+				pickle.dump(dists, f)
+			del dists
+		with open(os.path.join(linden_dir, "benchmark_lf_thresholds.pkl"), "wb") as f:
+			pickle.dump(numpy.full(num_lf, 0.9), f)
+
+		linden_db = WeakDB()
+		with self.stage("load_linden") as extra:
+			linden_db.load_linden(linden_dir, "benchmark", num_processes=config["processes"])
+			extra.update({ "num_train" : num_train, "num_val" : num_val })
+
+	def bench_server(self, work_dir):
+
+		# the server module lives in the repository root, and configures its task store on
+		# import. Point it at a task store in the work directory
+		sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+		import server
+		from taskstore import JSONTaskStore, SQLiteTaskStore
+
+		config = self.config
+		results_dir = os.path.join(work_dir, "labeling_results")
+		os.makedirs(results_dir, exist_ok=True)
+		if config["task_store"] == "sqlite":
+			server.task_store = SQLiteTaskStore(os.path.join(results_dir, "tasks.db"))
+		else:
+			server.task_store = JSONTaskStore(results_dir, server.TASK_CACHE_MAX_BYTES)
+
+		task_size = config["task_size"]
+		task = LabelingTask()
+		task.set_description("Synthetic benchmark task")
+		task.set_datapoints(["images/image_%08d.jpg" % i for i in range(task_size)])
+		task.set_categories(["positive", "negative", "not sure"])
+		server.task_store.save_task(task)
+
+		latencies = { "get_task" : [], "store_labels" : [] }
+		response_bytes = { "get_task" : 0, "store_labels" : 0 }
+		lock = threading.Lock()
+
+		def run_labeler(labeler):
+			client = server.app.test_client()
+			rng = numpy.random.default_rng(config["seed"] + labeler)
+			headers = { "Accept-Encoding" : "gzip" } if config["compress"] else {}
+			for i in range(config["requests"]):
+				labels = rng.integers(-1, 4, task_size).tolist()
+				labeling_times = rng.random(task_size).tolist()
+				requests = [
+					("get_task", lambda: client.get("/labeling_api/get_task?task_id=%s" % task.task_id, headers=headers)),
+					("store_labels", lambda: client.post("/labeling_api/store_labels", json={ "task_id" : task.task_id,
+						"labeler_name" : "labeler%d" % labeler, "labels" : labels, "labeling_times" : labeling_times })),
+				]
+				for (endpoint, send) in requests:
+					start = time.perf_counter()
+					response = send()
+					seconds = time.perf_counter() - start
+					assert response.status_code == 200, "%s failed: %s" % (endpoint, response.status)
+					with lock:
+						latencies[endpoint].append(seconds)
+						response_bytes[endpoint] = response_bytes[endpoint] + len(response.get_data())
+
+		with self.stage("server") as extra:
+			# the labeling server prints each save, keep that out of the benchmark output
+			with open(os.devnull, "wt") as devnull, contextlib.redirect_stdout(devnull):
+				with concurrent.futures.ThreadPoolExecutor(max_workers=config["labelers"]) as pool:
+					for result in pool.map(run_labeler, range(config["labelers"])):
+						pass
+
+		extra.update({ "task_size" : task_size, "labelers" : config["labelers"], "task_store" : config["task_store"] })
+		for (endpoint, times) in latencies.items():
+			times = numpy.array(times)
+			extra[endpoint] = {
+				"requests" : len(times),
+				"response_bytes" : response_bytes[endpoint],
+				"p50_seconds" : float(numpy.percentile(times, 50)),
+				"p95_seconds" : float(numpy.percentile(times, 95)),
+				"max_seconds" : float(times.max()),
+			}
+			print("   %-21s %d requests, p50 %.1f ms, p95 %.1f ms, max %.1f ms" % (endpoint, len(times),
+				extra[endpoint]["p50_seconds"] * 1e3, extra[endpoint]["p95_seconds"] * 1e3, extra[endpoint]["max_seconds"] * 1e3))
+
+	def run(self, stages, work_dir):
+		db = self.make_db()
+		if "set_lf_matrix" in stages or "extend_lfs" in stages or "save_json" in stages:
+			self.bench_set_lf_matrix(db)
+		if "set_similarity_matrix" in stages:
+			self.bench_set_similarity_matrix(db, work_dir)
+		if "set_embeddings" in stages or ("extend_lfs" in stages and len(db.sorted_sims) == 0):
+			self.bench_set_embeddings(db)
+		if "extend_lfs" in stages:
+			self.bench_extend_lfs(db)
+		if "save_json" in stages:
+			self.bench_save_json(db, work_dir)
+		del db
+		if "load_linden" in stages:
+			self.bench_load_linden(work_dir)
+		if "server" in stages:
+			self.bench_server(work_dir)
+		self.memory.stop()
+
+
+# description of the machine and code a benchmark ran on
+def get_environment():
+	environment = {
+		"python" : platform.python_version(),
+		"numpy" : numpy.__version__,
+		"platform" : platform.platform(),
+		"cpu_count" : os.cpu_count(),
+	}
+	try:
+		repo_dir = os.path.dirname(os.path.abspath(__file__))
+		environment["git_commit"] = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=repo_dir,
+			stderr=subprocess.DEVNULL).decode("utf-8").strip()
+	except (OSError, subprocess.CalledProcessError):
+		pass
+	return environment
+
+
+# prints the time and peak memory of each stage of results relative to baseline
+def print_comparison(results, baseline):
+	baseline_stages = dict((stage["name"], stage) for stage in baseline["stages"] if "seconds" in stage)
+	print("\n%-24s %10s %10s %8s %12s %12s" % ("stage", "baseline", "time", "speedup", "base rss MB", "rss MB"))
+	for stage in results["stages"]:
+		base = baseline_stages.get(stage["name"])
+		if base is None or "seconds" not in stage:
+			continue
+		print("%-24s %10.3f %10.3f %7.2fx %12.1f %12.1f" % (stage["name"], base["seconds"], stage["seconds"],
+			base["seconds"] / max(stage["seconds"], 1e-9), base["peak_rss_bytes"] / 1e6, stage["peak_rss_bytes"] / 1e6))
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Benchmarks WeakDB and the labeling server on synthetic data")
+	parser.add_argument("--preset", choices=sorted(BENCHMARK_PRESETS), default="small", help="dataset scale (overridden by the options below)")
+	parser.add_argument("--num-train", type=int)
+	parser.add_argument("--num-val", type=int)
+	parser.add_argument("--num-lf", type=int)
+	parser.add_argument("--task-size", type=int, help="number of datapoints in the labeling task")
+	parser.add_argument("--abstain-rate", type=float, default=0.9, help="fraction of LF votes that are abstains")
+	parser.add_argument("--k", type=int, default=WeakDB.CLOSEST_LIST_SIZE, help="number of nearest neighbors ranked per datapoint")
+	parser.add_argument("--dim", type=int, default=128, help="embedding dimension")
+	parser.add_argument("--ivf", action="store_true", help="rank embeddings with an (approximate) IVF index")
+	parser.add_argument("--max-similarity-bytes", type=int, default=2 * 1024 * 1024 * 1024)
+	parser.add_argument("--linden-train", type=int, default=5000, help="number of training datapoints of the load_linden import")
+	parser.add_argument("--list-inputs", action="store_true", help="pass LF matrices as python lists rather than numpy arrays")
+	parser.add_argument("--no-compress", dest="compress", action="store_false", help="don't write (or request) compressed json")
+	parser.add_argument("--labelers", type=int, default=8, help="number of concurrent labeling server clients")
+	parser.add_argument("--requests", type=int, default=10, help="get_task + store_labels requests per client")
+	parser.add_argument("--task-store", choices=["json", "sqlite"], default="json")
+	parser.add_argument("--threads", type=int, default=None)
+	parser.add_argument("--processes", type=int, default=None)
+	parser.add_argument("--stages", default=",".join(BENCHMARK_STAGES), help="comma separated stages to run (default: all)")
+	parser.add_argument("--seed", type=int, default=0)
+	parser.add_argument("--work-dir", default=None, help="where to write dumps and tasks (default: a temporary directory)")
+	parser.add_argument("--output", default=None, help="json file to write the results to")
+	parser.add_argument("--compare", default=None, help="json results of a baseline run to compare against")
+	args = parser.parse_args()
+
+	config = dict(BENCHMARK_PRESETS[args.preset])
+	for (key, value) in vars(args).items():
+		if key not in ["stages", "work_dir", "output", "compare"] and (value is not None or key not in config):
+			config[key] = value
+
+	stages = [stage for stage in args.stages.split(",") if len(stage) > 0]
+	for stage in stages:
+		if stage not in BENCHMARK_STAGES:
+			parser.error("unknown stage %s (stages: %s)" % (stage, ", ".join(BENCHMARK_STAGES)))
+
+	work_dir = args.work_dir if args.work_dir is not None else tempfile.mkdtemp(prefix="weakdb_benchmark_")
+	os.makedirs(work_dir, exist_ok=True)
+	print("Benchmarking %d train + %d val datapoints, %d LFs (work dir: %s)" % (config["num_train"], config["num_val"], config["num_lf"], work_dir))
+
+	benchmark = Benchmark(config)
+	try:
+		benchmark.run(stages, work_dir)
+	finally:
+		if args.work_dir is None:
+			shutil.rmtree(work_dir, ignore_errors=True)
+
+	results = {
+		"timestamp" : datetime.datetime.now().isoformat(),
+		"config" : config,
+		"environment" : get_environment(),
+		"stages" : benchmark.results,
+	}
+
+	if args.output is not None:
+		with open(args.output, "wt") as f:
+			f.write(json.dumps(results, indent=2))
+		print("Wrote results to %s" % args.output)
+
+	if args.compare is not None:
+		with open(args.compare, "rt") as f:
+			print_comparison(results, json.load(f))
@@ -0,0 +1,155 @@
+import gzip
+import hashlib
+import os
+import zlib
+
+# brotli is optional: without it, responses and sidecars are only gzip compressed
+try:
+	import brotli
+except ImportError:
+	brotli = None
+
+
+# Helpers for serving compressed json: the server compresses responses (and
+# caches compressed task responses), and WeakDB.save_json() writes precompressed
+# sidecar files (e.g., dump_lf_matrix_noext.json.gz) that the server sends as is.
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# responses smaller than this are sent uncompressed
+MIN_COMPRESS_BYTES = 1024
+
+# supported content encodings, in order of preference, and the extension of their sidecar files
+ENCODING_EXTENSIONS = { "br" : ".br", "gzip" : ".gz" }
+
+
+def get_encodings():
+	if brotli is None:
+		return ["gzip"]
+	return ["br", "gzip"]
+
+# returns the encoding (from encodings, in order of preference) to use for a client
+# that sent the given Accept-Encoding header, or None to send the response uncompressed
+def negotiate_encoding(accept_encoding, encodings):
+	qualities = {}
+	for item in accept_encoding.split(","):
+		params = item.strip().split(";")
+		name = params[0].strip().lower()
+		q = 1.0
+		for param in params[1:]:
+			(key, _, value) = param.strip().partition("=")
+			if key == "q":
+				try:
+					q = float(value)
+				except ValueError:
+					q = 0.0
+		if len(name) > 0:
+			qualities[name] = q
+
+	best = None
+	best_q = 0.0
+	for encoding in encodings:
+		q = qualities.get(encoding, qualities.get("*", 0.0))
+		if q > best_q:
+			best = encoding
+			best_q = q
+	return best
+
+def compress(data, encoding):
+	if encoding == "gzip":
+		# mtime=0 so the same data always compresses to the same bytes
+		return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+	if encoding == "br":
+		return brotli.compress(data, quality=BROTLI_QUALITY)
+	raise ValueError("Unsupported content encoding: %s" % encoding)
+
+# incremental version of compress(), for data that is produced in chunks
+class StreamCompressor:
+
+	def __init__(self, encoding):
+		if encoding == "gzip":
+			# wbits=31 writes a gzip header (with mtime 0) and trailer
+			self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+			self.compress = self.compressor.compress
+			self.finish = self.compressor.flush
+		elif encoding == "br":
+			self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+			self.compress = self.compressor.process
+			self.finish = self.compressor.finish
+		else:
+			raise ValueError("Unsupported content encoding: %s" % encoding)
+
+# compresses an iterable of chunks of bytes, yielding chunks of compressed bytes
+def compress_chunks(chunks, encoding):
+	compressor = StreamCompressor(encoding)
+	for chunk in chunks:
+		data = compressor.compress(chunk)
+		if len(data) > 0:
+			yield data
+	yield compressor.finish()
+
+# strong ETag (unquoted) for a response body. encoding is part of the tag, since
+# each encoding of a response is a different representation
+def compute_etag(data, encoding=None):
+	tag = hashlib.sha1(data).hexdigest()
+	if encoding is not None:
+		tag = "%s-%s" % (tag, encoding)
+	return tag
+
+def get_sidecar_filename(filename, encoding):
+	return filename + ENCODING_EXTENSIONS[encoding]
+
+# writes the compressed sidecars of filename (given its contents as bytes). Sidecars
+# are written to a temporary file first so the server never sends a partial one
+def write_sidecars(filename, data):
+	for encoding in get_encodings():
+		sidecar_filename = get_sidecar_filename(filename, encoding)
+		tmp_filename = sidecar_filename + ".tmp"
+		with open(tmp_filename, "wb") as f:
+			f.write(compress(data, encoding))
+		os.replace(tmp_filename, sidecar_filename)
+
+# streaming version of write_sidecars(), for files written in chunks: call write() with
+# each chunk of filename's contents, then close() once filename is written and closed,
+# and commit() once it has been moved into place. Closing the sidecars after the file
+# keeps their mtime at least that of the file, as find_sidecar() expects
+class SidecarWriter:
+
+	def __init__(self, filename):
+		self.sidecars = []
+		for encoding in get_encodings():
+			sidecar_filename = get_sidecar_filename(filename, encoding)
+			tmp_filename = sidecar_filename + ".tmp"
+			self.sidecars.append((sidecar_filename, tmp_filename, open(tmp_filename, "wb"), StreamCompressor(encoding)))
+
+	def write(self, data):
+		for (_, _, f, compressor) in self.sidecars:
+			f.write(compressor.compress(data))
+
+	def close(self):
+		for (_, _, f, compressor) in self.sidecars:
+			f.write(compressor.finish())
+			f.close()
+
+	def commit(self):
+		for (sidecar_filename, tmp_filename, _, _) in self.sidecars:
+			os.replace(tmp_filename, sidecar_filename)
+
+	# closes and removes the temporary files (if the file could not be written)
+	def abort(self):
+		for (_, tmp_filename, f, _) in self.sidecars:
+			f.close()
+			if os.path.exists(tmp_filename):
+				os.remove(tmp_filename)
+
+# returns the sidecar of filename for encoding, or None if it doesn't exist or is
+# older than filename (the file was rewritten without its sidecars)
+def find_sidecar(filename, encoding):
+	sidecar_filename = get_sidecar_filename(filename, encoding)
+	try:
+		if os.stat(sidecar_filename).st_mtime_ns >= os.stat(filename).st_mtime_ns:
+			return sidecar_filename
+	except FileNotFoundError:
+		pass
+	return None
@@ -0,0 +1,147 @@
+import json
+import numpy
+
+
+# Streaming json serialization: turns a value into a sequence of chunks of json text,
+# so large values can be written to a file or an HTTP response without ever holding
+# the whole serialized document in memory. Values are dicts, lists/tuples, json
+# scalars and numpy arrays (serialized as (nested) lists, like numpy's tolist()).
+# Numeric arrays are serialized straight from their typed buffers, a block of
+# elements at a time, without converting the whole array to a python list first.
+#
+# The output is plain (compact) json, readable by json.loads() and JSON.parse().
+
+# number of array (or list) elements serialized at once
+STREAM_BLOCK_ELEMENTS = 64 * 1024
+
+# target size (in bytes) of the chunks yielded by iter_json_bytes()
+STREAM_CHUNK_BYTES = 256 * 1024
+
+SEPARATORS = (",", ":")
+
+JSON_SCALAR_TYPES = (str, int, float, bool, type(None))
+
+
+# The rows of a padded ranking matrix (see weakdb.pad_rankings()), serialized as a list
+# of lists without the padding. The padding of each row is given by the (int) rankings in
+# mask_rankings if given (used for the similarity scores that go with a ranking)
+class UnpaddedRows:
+
+	def __init__(self, rankings, mask_rankings=None):
+		self.rankings = rankings
+		self.mask_rankings = rankings if mask_rankings is None else mask_rankings
+
+
+def dumps_scalar(value):
+	return json.dumps(value, separators=SEPARATORS)
+
+# json text of the int8 values, indexed by the value's bits (as a uint8)
+INT8_STRINGS = [str(u - 256 if u >= 128 else u) for u in range(256)]
+
+# the elements of a 1D numeric array, as comma separated json text
+def format_numbers(values):
+	if values.dtype == numpy.int8:
+		# LF votes and labels, the bulk of a dump: a table lookup is much faster than formatting
+		strings = INT8_STRINGS
+		return ",".join([strings[u] for u in values.view(numpy.uint8).tolist()])
+	return dumps_scalar(values.tolist())[1:-1]
+
+def iter_array(arr):
+	if arr.ndim == 0:
+		yield dumps_scalar(arr.item())
+		return
+	if arr.ndim > 1:
+		yield from iter_list(arr)
+		return
+
+	yield "["
+	for start in range(0, len(arr), STREAM_BLOCK_ELEMENTS):
+		if start > 0:
+			yield ","
+		yield format_numbers(numpy.asarray(arr[start:start+STREAM_BLOCK_ELEMENTS]))
+	yield "]"
+
+def iter_unpadded_rows(rows):
+	if not isinstance(rows.rankings, numpy.ndarray):
+		yield from iter_json(rows.rankings)
+		return
+
+	num_rows = len(rows.rankings)
+	block_rows = max(1, STREAM_BLOCK_ELEMENTS // max(1, rows.rankings.shape[1]))
+	yield "["
+	for start in range(0, num_rows, block_rows):
+		block = numpy.asarray(rows.rankings[start:start+block_rows])
+		mask = numpy.asarray(rows.mask_rankings[start:start+block_rows]) >= 0
+		pieces = []
+		for (row, row_mask) in zip(block, mask):
+			pieces.append("[%s]" % format_numbers(row[row_mask]))
+		if start > 0:
+			yield ","
+		yield ",".join(pieces)
+	yield "]"
+
+def iter_list(values):
+	yield "["
+	for start in range(0, len(values), STREAM_BLOCK_ELEMENTS):
+		block = values[start:start+STREAM_BLOCK_ELEMENTS]
+		if start > 0:
+			yield ","
+		if not isinstance(block, numpy.ndarray) and all(isinstance(value, JSON_SCALAR_TYPES) for value in block):
+			# a block of scalars (e.g., labels, urls) is serialized in one go
+			yield dumps_scalar(list(block))[1:-1]
+			continue
+		for (i, value) in enumerate(block):
+			if i > 0:
+				yield ","
+			yield from iter_json(value)
+	yield "]"
+
+def iter_dict(values):
+	yield "{"
+	for (i, (key, value)) in enumerate(values.items()):
+		# like json.dumps(), non-string keys are converted to strings
+		if not isinstance(key, str):
+			key = dumps_scalar(key)
+		yield "%s%s:" % ("," if i > 0 else "", dumps_scalar(key))
+		yield from iter_json(value)
+	yield "}"
+
+# yields the json serialization of value as a sequence of strings
+def iter_json(value):
+	if isinstance(value, JSON_SCALAR_TYPES):
+		yield dumps_scalar(value)
+	elif isinstance(value, numpy.ndarray):
+		yield from iter_array(value)
+	elif isinstance(value, numpy.generic):
+		yield dumps_scalar(value.item())
+	elif isinstance(value, UnpaddedRows):
+		yield from iter_unpadded_rows(value)
+	elif isinstance(value, dict):
+		yield from iter_dict(value)
+	elif isinstance(value, (list, tuple)):
+		yield from iter_list(value)
+	else:
+		raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
+
+# yields the json serialization of value as utf-8 encoded chunks of about chunk_bytes bytes
+def iter_json_bytes(value, chunk_bytes=STREAM_CHUNK_BYTES):
+	pieces = []
+	size = 0
+	for piece in iter_json(value):
+		pieces.append(piece)
+		size = size + len(piece)
+		if size >= chunk_bytes:
+			yield "".join(pieces).encode("utf-8")
+			pieces = []
+			size = 0
+	if len(pieces) > 0:
+		yield "".join(pieces).encode("utf-8")
+
+# writes the json serialization of value to f (a file opened in binary mode)
+def write_json(f, value):
+	for chunk in iter_json_bytes(value):
+		f.write(chunk)
+
+# the json serialization of value, as bytes
+def dumps(value):
+	return b"".join(iter_json_bytes(value))
@@ -0,0 +1,273 @@
+import concurrent.futures
+import numpy
+
+
+# Helpers for turning rows of similarity scores into nearest neighbor rankings.
+# WeakDB processes similarity data a block of rows at a time using these, so
+# that only a bounded amount of score data is ever in flight.
+
+# amount of similarity score data (in bytes) to process at once
+DEFAULT_BLOCK_BYTES = 64 * 1024 * 1024
+
+# number of rows of a matrix with num_cols columns that fit in one block
+def rows_per_block(num_cols, itemsize=4, block_bytes=DEFAULT_BLOCK_BYTES):
+	return max(1, int(block_bytes / max(1, num_cols * itemsize)))
+
+# datatype used to rank a block of scores. Integer scores are promoted so that
+# entries can be masked out with -inf.
+def score_dtype(dtype):
+	return numpy.result_type(dtype, numpy.float32)
+
+# block is the rows [row_start, row_start + len(block)) of a similarity matrix
+# whose first num_train rows correspond to the columns (the training set). Sets
+# the similarity of each training datapoint to itself to -inf, so a datapoint
+# never shows up as its own nearest neighbor. Modifies block in place.
+def mask_self_similarity(block, row_start, num_train):
+	row_end = min(row_start + len(block), num_train)
+	if row_start < row_end:
+		rows = numpy.arange(row_start, row_end)
+		block[rows - row_start, rows] = -numpy.inf
+
+# Returns (indices, scores): the k highest scoring columns of each row of scores,
+# ordered from highest to lowest score. The k winners are found with a partial
+# selection (argpartition) so only they need to be sorted. If k is at least the
+# number of columns this degenerates to a full ranking of each row.
+def topk_rows(scores, k):
+	num_rows, num_cols = scores.shape
+	k = min(k, num_cols)
+
+	if k < num_cols:
+		candidates = numpy.argpartition(scores, num_cols - k, axis=1)[:, num_cols - k:]
+	else:
+		candidates = numpy.broadcast_to(numpy.arange(num_cols), (num_rows, num_cols))
+
+	candidate_scores = numpy.take_along_axis(scores, candidates, axis=1)
+	order = numpy.flip(numpy.argsort(candidate_scores, axis=1, kind="stable"), axis=1)
+
+	indices = numpy.take_along_axis(candidates, order, axis=1).astype(numpy.int32)
+	scores = numpy.take_along_axis(candidate_scores, order, axis=1)
+	return (indices, scores)
+
+
+###############################################################
+# nearest neighbor search over embeddings
+###############################################################
+
+METRIC_COSINE = "cosine"
+METRIC_L2 = "l2"
+
+# Prepares a matrix of embeddings (one per row) for search with the given metric.
+# Returns (vectors, sq_norms). For cosine similarity the rows are normalized to unit
+# length (and sq_norms is None). For L2 distance, the squared norm of each row is
+# also returned, since it is needed to compute distances via a matrix multiply.
+def prepare_embeddings(embeddings, metric):
+	vectors = numpy.ascontiguousarray(embeddings, dtype=numpy.float32)
+	assert len(vectors.shape) == 2
+	if metric == METRIC_COSINE:
+		norms = numpy.linalg.norm(vectors, axis=1, keepdims=True)
+		norms[norms == 0.0] = 1.0
+		return (vectors / norms, None)
+	elif metric == METRIC_L2:
+		return (vectors, numpy.einsum("ij,ij->i", vectors, vectors))
+	raise ValueError("Unknown embedding metric: %s" % metric)
+
+# Similarity scores (higher is more similar) between a block of (prepared) query
+# vectors and a set of (prepared) database vectors, computed with a single matrix
+# multiply. For cosine similarity the score is the cosine of the angle between the
+# vectors. For L2 the score is the negated squared distance (query_sq_norms may be
+# None if only the ordering of the scores within each row matters).
+def embedding_scores(queries, query_sq_norms, database, database_sq_norms):
+	scores = queries @ database.T
+	if database_sq_norms is not None:
+		scores *= 2.0
+		scores -= database_sq_norms[numpy.newaxis, :]
+		if query_sq_norms is not None:
+			scores -= query_sq_norms[:, numpy.newaxis]
+	return scores
+
+# Replaces the indices of entries that never had a valid score (e.g., the masked
+# out query datapoint itself, or unfilled slots in an approximate search) with -1,
+# which is how rankings are padded.
+def pad_invalid(indices, scores):
+	indices[numpy.isneginf(scores)] = -1
+	return (indices, scores)
+
+# Runs func(row_start, row_end) on consecutive blocks of num_rows rows, spread across
+# a pool of num_threads threads. The heavy lifting in the block functions is done by
+# BLAS and numpy, which release the GIL, so the blocks really run in parallel.
+def run_row_blocks(func, num_rows, block_rows, num_threads=None):
+	ranges = [(start, min(start + block_rows, num_rows)) for start in range(0, num_rows, block_rows)]
+	if num_threads == 1 or len(ranges) <= 1:
+		for (start, end) in ranges:
+			func(start, end)
+		return
+	with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+		for result in pool.map(lambda r: func(*r), ranges):
+			pass
+
+# Exact k nearest neighbor search. For each query row, finds the k most similar
+# database rows, in order (see embedding_scores() for the metrics). Rows of queries
+# and database are the embeddings of datapoints; if the first num_self queries are
+# also the first num_self database entries (e.g., training set queries against the
+# training set), a query is never returned as its own neighbor.
+#
+# Queries are processed in blocks sized so that a block of scores stays within
+# block_bytes, and blocks are spread across num_threads threads.
+# Returns (indices, scores) arrays of shape (num_queries, k).
+def embedding_topk(queries, database, k, metric=METRIC_COSINE, num_self=0, num_threads=None, block_bytes=DEFAULT_BLOCK_BYTES):
+	(queries, query_sq_norms) = prepare_embeddings(queries, metric)
+	(database, database_sq_norms) = prepare_embeddings(database, metric)
+	assert queries.shape[1] == database.shape[1]
+
+	num_queries = len(queries)
+	k = min(k, len(database))
+	indices = numpy.zeros((num_queries, k), dtype=numpy.int32)
+	scores = numpy.zeros((num_queries, k), dtype=numpy.float32)
+
+	def process_block(start, end):
+		block_sq_norms = None if query_sq_norms is None else query_sq_norms[start:end]
+		block = embedding_scores(queries[start:end], block_sq_norms, database, database_sq_norms)
+		mask_self_similarity(block, start, num_self)
+		(block_indices, block_scores) = pad_invalid(*topk_rows(block, k))
+		indices[start:end] = block_indices
+		scores[start:end] = block_scores
+
+	block_rows = rows_per_block(len(database), 4, block_bytes)
+	run_row_blocks(process_block, num_queries, block_rows, num_threads)
+	return (indices, scores)
+
+
+# An inverted file (IVF) index for approximate nearest neighbor search over large
+# sets of embeddings. The database is partitioned into num_lists clusters (found via
+# k-means on a sample of the data). A query is only compared against the members of
+# the num_probes clusters whose centroids are closest to it, rather than against the
+# whole database. More probes gives better recall at the cost of speed.
+class IVFIndex:
+
+	KMEANS_SAMPLES_PER_LIST = 64
+
+	def __init__(self, database, metric=METRIC_COSINE, num_lists=None, num_probes=8, num_iterations=10, seed=0):
+
+		(self.database, self.database_sq_norms) = prepare_embeddings(database, metric)
+		self.metric = metric
+
+		num_database = len(self.database)
+		if num_lists is None:
+			num_lists = int(4 * numpy.sqrt(num_database))
+		self.num_lists = max(1, min(num_lists, num_database))
+		self.num_probes = min(num_probes, self.num_lists)
+
+		self.centroids = self.train_centroids(num_iterations, numpy.random.default_rng(seed))
+
+		# bucket the database by closest centroid
+		assignments = self.assign(self.database, self.database_sq_norms, 1)[:, 0]
+		order = numpy.argsort(assignments, kind="stable")
+		bounds = numpy.searchsorted(assignments[order], numpy.arange(self.num_lists + 1))
+		self.lists = [order[bounds[l]:bounds[l+1]].astype(numpy.int32) for l in range(self.num_lists)]
+
+	# a few iterations of Lloyd's algorithm on a random sample of the database
+	def train_centroids(self, num_iterations, rng):
+		num_samples = min(len(self.database), self.num_lists * IVFIndex.KMEANS_SAMPLES_PER_LIST)
+		sample = self.database[rng.choice(len(self.database), num_samples, replace=False)]
+		centroids = sample[rng.choice(num_samples, self.num_lists, replace=False)].copy()
+
+		for i in range(num_iterations):
+			(prepared, sq_norms) = prepare_embeddings(centroids, self.metric)
+			scores = embedding_scores(sample, None, prepared, sq_norms)
+			assignments = numpy.argmax(scores, axis=1)
+			counts = numpy.bincount(assignments, minlength=self.num_lists)
+			sums = numpy.zeros_like(centroids)
+			numpy.add.at(sums, assignments, sample)
+			nonempty = counts > 0
+			centroids[nonempty] = sums[nonempty] / counts[nonempty, numpy.newaxis]
+
+		return prepare_embeddings(centroids, self.metric)
+
+	# indices of the num_probes closest centroids to each of the (prepared) vectors
+	def assign(self, vectors, sq_norms, num_probes):
+		(centroids, centroid_sq_norms) = self.centroids
+		probes = numpy.zeros((len(vectors), num_probes), dtype=numpy.int32)
+		block_rows = rows_per_block(self.num_lists)
+		for start in range(0, len(vectors), block_rows):
+			block_sq_norms = None if sq_norms is None else sq_norms[start:start+block_rows]
+			scores = embedding_scores(vectors[start:start+block_rows], block_sq_norms, centroids, centroid_sq_norms)
+			probes[start:start+block_rows] = topk_rows(scores, num_probes)[0]
+		return probes
+
+	# Approximate k nearest neighbor search. Same interface as embedding_topk().
+	# Queries with fewer than k candidates in their probed clusters have their
+	# rankings padded with -1.
+	def search(self, queries, k, num_self=0, num_threads=None, block_bytes=DEFAULT_BLOCK_BYTES):
+		(queries, query_sq_norms) = prepare_embeddings(queries, self.metric)
+		assert queries.shape[1] == self.database.shape[1]
+
+		num_queries = len(queries)
+		k = min(k, len(self.database))
+		indices = numpy.zeros((num_queries, k), dtype=numpy.int32)
+		scores = numpy.zeros((num_queries, k), dtype=numpy.float32)
+
+		def process_block(start, end):
+			block_sq_norms = None if query_sq_norms is None else query_sq_norms[start:end]
+			probes = self.assign(queries[start:end], block_sq_norms, self.num_probes)
+
+			best_indices = numpy.full((end - start, k), -1, dtype=numpy.int32)
+			best_scores = numpy.full((end - start, k), -numpy.inf, dtype=numpy.float32)
+
+			# group the queries by the clusters they probe
+			probe_order = numpy.argsort(probes.reshape(-1), kind="stable")
+			probe_bounds = numpy.searchsorted(probes.reshape(-1)[probe_order], numpy.arange(self.num_lists + 1))
+
+			# visit each probed cluster once, comparing it to all the queries that probe it,
+			# and merge the results into the running top-k of those queries
+			for l in range(self.num_lists):
+				members = self.lists[l]
+				rows = probe_order[probe_bounds[l]:probe_bounds[l+1]] // self.num_probes
+				if len(members) == 0 or len(rows) == 0:
+					continue
+				member_sq_norms = None if self.database_sq_norms is None else self.database_sq_norms[members]
+				row_sq_norms = None if block_sq_norms is None else block_sq_norms[rows]
+				candidate_scores = embedding_scores(queries[start + rows], row_sq_norms, self.database[members], member_sq_norms)
+				candidate_indices = numpy.broadcast_to(members, candidate_scores.shape)
+
+				# never return a query as its own neighbor
+				query_ids = (start + rows)[:, numpy.newaxis]
+				candidate_scores[(query_ids == members[numpy.newaxis, :]) & (query_ids < num_self)] = -numpy.inf
+
+				merged_scores = numpy.concatenate([best_scores[rows], candidate_scores], axis=1)
+				merged_indices = numpy.concatenate([best_indices[rows], candidate_indices], axis=1)
+				(order, top_scores) = topk_rows(merged_scores, k)
+				best_indices[rows] = numpy.take_along_axis(merged_indices, order, axis=1)
+				best_scores[rows] = top_scores
+
+			(indices[start:end], scores[start:end]) = pad_invalid(best_indices, best_scores)
+
+		block_rows = rows_per_block(k + self.num_probes * max(len(members) for members in self.lists), 8, block_bytes)
+		run_row_blocks(process_block, num_queries, block_rows, num_threads)
+		return (indices, scores)
+
+
+###############################################################
+# full rankings of distance matrices
+###############################################################
+
+# Full ranking of each row of block (highest score first, ties broken by lower column
+# index). block is the rows [row_start, row_start + len(block)) of a matrix whose first
+# num_self rows correspond to its first num_self columns. Those rows have their own
+# datapoint removed from their ranking (their rankings are padded with -1 at the end).
+#
+# Returns (ranking, mismatched) where mismatched holds the (matrix) indices of the rows
+# whose highest scoring column is not their own datapoint. Often a sign of duplicate data.
+def rank_rows_excluding_self(block, row_start, num_self):
+	block = numpy.asarray(block)
+	ranking = numpy.argsort(-block, axis=1, kind="stable").astype(numpy.int32)
+
+	rows = numpy.arange(row_start, row_start + len(block))
+	is_self_row = rows < num_self
+	mismatched = rows[is_self_row & (ranking[:, 0] != rows)]
+
+	# move each row's own datapoint to the end of its ranking, then drop it
+	is_self_entry = (ranking == rows[:, numpy.newaxis]) & is_self_row[:, numpy.newaxis]
+	ranking = numpy.take_along_axis(ranking, numpy.argsort(is_self_entry, axis=1, kind="stable"), axis=1)
+	ranking[is_self_row, -1] = -1
+
+	return (ranking, mismatched)
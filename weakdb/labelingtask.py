@@ -2,10 +2,26 @@ import json
 import os
 import uuid
 
+import jsonstream
+import metrics
+
+
+# Label updates to a task are appended to a journal file that sits next to the
+# task's json file (the snapshot), rather than rewriting the whole snapshot on
+# every update. LabelingTask.load() replays the journal on top of the snapshot,
+# and LabelingTask.save() folds the journal back into the snapshot.
+def get_journal_filename(filename):
+	return "%s.journal" % os.path.splitext(filename)[0]
 
 
 class LabelingTask:
 
+	# label value of datapoints a labeler has not labeled (matches Annotation.INVALID_CATEGORY in klabel.js)
+	UNLABELED = -1
+
+	# compact the journal into the snapshot once it grows past this size (or past the size of the snapshot)
+	JOURNAL_COMPACTION_BYTES = 4 * 1024 * 1024
+
 	def __init__(self):
 		self.task_id = self.generate_task_id()
 		self.description = ""
@@ -24,6 +40,21 @@ class LabelingTask:
 	def get_task_filename(self, target_dir):
 		return os.path.join(target_dir, "%s.json" % self.task_id)
 
+	# directory holding the atlases of thumbnails of the task's images (see atlases.py)
+	def get_atlas_dir(self, target_dir):
+		return os.path.join(target_dir, "%s_atlas" % self.task_id)
+
+	# packs thumbnails of the task's images into atlases in target_dir (the directory the
+	# task is saved to), which the server hands out via /labeling_api/get_atlas_index.
+	# Call when creating a task.
+	def save_atlases(self, target_dir, num_processes=None):
+
+		# imported here so that Pillow is only required when building atlases
+		import atlases
+
+		filenames = atlases.get_atlas_filenames(self.datapoint_urls)
+		atlases.build_atlases(filenames, self.get_atlas_dir(target_dir), num_processes=num_processes)
+
 	def set_description(self, description):
 		self.description = description
 
@@ -93,11 +124,83 @@ class LabelingTask:
 		else:
 			self.labeler_results[labeler_name] = { "labeling_times" : labeling_times}
 
+	# sets the labels (and optionally labeling times) of the datapoints with the given indices,
+	# leaving the labeler's other results untouched. Datapoints the labeler has no results for
+	# are unlabeled (with a labeling time of 0).
+	# seq is an optional client-provided sequence number of the update (see get_update_seq())
+	def set_labels(self, labeler_name, indices, labels, labeling_times=None, seq=None):
+		assert len(indices) == len(labels)
+		assert labeling_times is None or len(labeling_times) == len(indices)
+
+		num_datapoints = self.get_num_datapoints()
+		results = self.labeler_results.setdefault(labeler_name, {})
+		if "labels" not in results:
+			results["labels"] = [LabelingTask.UNLABELED] * num_datapoints
+		if "labeling_times" not in results:
+			results["labeling_times"] = [0.0] * num_datapoints
+
+		for (i, idx) in enumerate(indices):
+			assert 0 <= idx < num_datapoints
+			results["labels"][idx] = labels[i]
+			if labeling_times is not None:
+				results["labeling_times"][idx] = labeling_times[i]
+
+		if seq is not None:
+			results["update_seq"] = seq
+
+	# sequence number of the last update from the labeler that carried one (-1 if none).
+	# Clients number their updates so that a retransmitted update is only applied once.
+	def get_update_seq(self, labeler_name):
+		return self.labeler_results.get(labeler_name, {}).get("update_seq", -1)
+
+	# indices of the datapoints whose label or labeling time in the given (complete) lists of
+	# results differs from the labeler's current results
+	def get_changed_indices(self, labeler_name, labels, labeling_times):
+		results = self.labeler_results.get(labeler_name, {})
+		cur_labels = results.get("labels")
+		cur_labeling_times = results.get("labeling_times")
+		if cur_labels is None or cur_labeling_times is None:
+			return list(range(len(labels)))
+		return [i for i in range(len(labels)) if labels[i] != cur_labels[i] or labeling_times[i] != cur_labeling_times[i]]
+
 	def get_labeler_results(self, labeler_name):
 		if labeler_name in self.labeler_results:
 			return self.labeler_results[labeler_name]["labels"]
 		return []
 
+	# number of datapoints the labeler has labeled
+	def get_num_labeled(self, labeler_name):
+		return sum(1 for label in self.get_labeler_results(labeler_name) if label != LabelingTask.UNLABELED)
+
+	# for each of the given datapoints, true if the labeler hasn't labeled it
+	def get_unlabeled_mask(self, labeler_name, indices):
+		labels = self.labeler_results.get(labeler_name, {}).get("labels")
+		if labels is None:
+			return [True] * len(indices)
+		return [labels[idx] == LabelingTask.UNLABELED for idx in indices]
+
+	# the datapoints with the given indices, with only the labeler's results for them
+	# (see taskwindows.py)
+	def get_window(self, labeler_name, indices):
+		results = self.labeler_results.get(labeler_name, {})
+		labels = results.get("labels")
+		labeling_times = results.get("labeling_times")
+
+		window = {
+			"task_id" : self.task_id,
+			"description" : self.description,
+			"categories" : self.categories,
+			"num_datapoints" : self.get_num_datapoints(),
+			"indices" : list(indices),
+			"datapoint_urls" : [self.datapoint_urls[idx] for idx in indices],
+			"labels" : [LabelingTask.UNLABELED] * len(indices) if labels is None else [labels[idx] for idx in indices],
+			"labeling_times" : [0.0] * len(indices) if labeling_times is None else [labeling_times[idx] for idx in indices],
+			"update_seq" : self.get_update_seq(labeler_name)
+		}
+		if len(self.datapoint_boxes) == self.get_num_datapoints():
+			window["datapoint_boxes"] = [self.datapoint_boxes[idx] for idx in indices]
+		return window
+
 	def print_stats(self):
 
 		counts = [0 for x in range(10)]
@@ -158,8 +261,33 @@ class LabelingTask:
 		}
 		return task_info
 
+	# a copy of to_dict() that later label updates don't change, for serializing a task
+	# outside of its lock (the datapoints, which never change, are shared with the task)
+	def snapshot_dict(self):
+		task_info = self.to_dict()
+		task_info["labeler_results"] = {}
+		for (labeler_name, results) in self.labeler_results.items():
+			task_info["labeler_results"][labeler_name] = \
+				{ key : list(value) if isinstance(value, list) else value for (key, value) in results.items() }
+		return task_info
+
+	# a copy of the task whose labeler_name's results can be updated (see set_labels()) without
+	# changing this task. The datapoints and the other labelers' results are shared with this task
+	def copy_for_update(self, labeler_name):
+		task = LabelingTask()
+		task.task_id = self.task_id
+		task.description = self.description
+		task.datapoint_urls = self.datapoint_urls
+		task.datapoint_boxes = self.datapoint_boxes
+		task.categories = self.categories
+		task.labeler_results = dict(self.labeler_results)
+		if labeler_name in self.labeler_results:
+			task.labeler_results[labeler_name] = \
+				{ key : list(value) if isinstance(value, list) else value for (key, value) in self.labeler_results[labeler_name].items() }
+		return task
+
 	def load(self, filename):
-		with open(filename, "rt") as f:
+		with open(filename, "rt") as f, metrics.TASK_SECONDS.time(operation="parse"):
 			task_info = json.load(f)
 			self.task_id = task_info["task_id"] 
 			self.description = task_info["description"]
@@ -168,9 +296,69 @@ class LabelingTask:
 			if "datapoint_boxes" in task_info:
 				self.datapoint_boxes = task_info["datapoint_boxes"]
 			self.labeler_results = task_info["labeler_results"]		
+		self.replay_journal(filename)
 
+	# Writes the task to filename. The file is replaced atomically, so a crash mid-save
+	# leaves the previous version intact. Any journaled updates are part of this task's
+	# state, so the journal is removed once the new snapshot is in place.
 	def save(self, filename):
-		with open(filename, "wt") as f:
-			f.write(json.dumps(self.to_dict()))
+		tmp_filename = "%s.tmp" % filename
+		with open(tmp_filename, "wb") as f, metrics.TASK_SECONDS.time(operation="save"):
+			jsonstream.write_json(f, self.to_dict())
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(tmp_filename, filename)
+
+		journal_filename = get_journal_filename(filename)
+		if os.path.exists(journal_filename):
+			os.remove(journal_filename)
+
+	# Records an update of a labeler's results (see set_labels()) in the journal of the task
+	# stored in filename. Only the updated datapoints are written. The caller is expected
+	# to have applied the same update to this task via set_labels().
+	def append_to_journal(self, filename, labeler_name, indices, labels, labeling_times=None, seq=None):
+		record = { "labeler_name" : labeler_name, "indices" : indices, "labels" : labels }
+		if labeling_times is not None:
+			record["labeling_times"] = labeling_times
+		if seq is not None:
+			record["seq"] = seq
+
+		with open(get_journal_filename(filename), "ab+") as f, metrics.TASK_SECONDS.time(operation="journal_append"):
+			# if a previous append was cut short, start a fresh line rather than extend the partial record
+			line = json.dumps(record) + "\n"
+			if f.tell() > 0:
+				f.seek(-1, os.SEEK_END)
+				if f.read(1) != b"\n":
+					line = "\n" + line
+			f.write(line.encode("utf-8"))
+			f.flush()
+			os.fsync(f.fileno())
+
+	# applies the updates in the journal of the task stored in filename to this task
+	def replay_journal(self, filename):
+		journal_filename = get_journal_filename(filename)
+		if not os.path.exists(journal_filename):
+			return
+
+		with open(journal_filename, "rt") as f, metrics.TASK_SECONDS.time(operation="journal_replay"):
+			for line in f:
+				# incomplete lines are appends that were cut short by a crash
+				try:
+					if not line.endswith("\n"):
+						raise ValueError("incomplete record")
+					record = json.loads(line)
+				except ValueError:
+					print("WARNING: ignoring truncated record in %s" % journal_filename)
+					continue
+				self.set_labels(record["labeler_name"], record["indices"], record["labels"], record.get("labeling_times"), record.get("seq"))
+
+	# true if the journal of the task stored in filename is large enough that it should
+	# be compacted into the snapshot (by calling save())
+	def journal_needs_compaction(self, filename):
+		journal_filename = get_journal_filename(filename)
+		if not os.path.exists(journal_filename):
+			return False
+		journal_size = os.path.getsize(journal_filename)
+		return journal_size > LabelingTask.JOURNAL_COMPACTION_BYTES or journal_size > os.path.getsize(filename)
 
 
@@ -0,0 +1,128 @@
+import concurrent.futures
+import numpy
+
+try:
+	from . import knn
+except ImportError:
+	import knn
+
+
+# LF extension: propagating the votes of labeling functions to nearby datapoints they
+# abstain on. LF i is extended with a similarity threshold t_i: a datapoint the LF
+# abstains on takes the LF's vote on its nearest neighbor (in the training set) that
+# the LF votes on, provided that neighbor's similarity to the datapoint is at least t_i.
+# Datapoints the LF votes on keep their vote. A threshold of nan leaves an LF unextended.
+#
+# The neighbor structure is the one WeakDB keeps: (num_rows x k) arrays of the indices
+# of each datapoint's nearest training set datapoints (closest first, padded with -1)
+# and their similarity scores. Only those k neighbors are considered, so with
+# truncated rankings an abstaining datapoint whose closest voting neighbor is farther
+# away than its k-th neighbor stays an abstain.
+#
+# Work is split into (batch of LFs, block of rows) pieces. All the LFs of a batch share
+# the neighbor lookups of a block, and pieces run in parallel across a pool of threads
+# (the work is numpy indexing and reductions, which run without the GIL).
+
+# number of LFs extended together
+EXTENSION_LF_BATCH_SIZE = 8
+
+
+# extended votes of a block of rows for a batch of LFs. votes holds the votes of the
+# batch's LFs on the training set (num_support x num_batch_lfs), own_votes their votes
+# on the rows of the block, and indices/sims the neighbors of the rows
+def extend_block(votes, own_votes, indices, sims, thresholds):
+	valid = (indices >= 0) & (indices < len(votes))
+	neighbor_votes = votes[numpy.where(valid, indices, 0)]
+
+	# neighbors that vote and are similar enough. Neighbors are ordered closest first,
+	# so the first such neighbor is the closest voting neighbor
+	candidates = (neighbor_votes != 0) & valid[:, :, numpy.newaxis] & \
+		(sims[:, :, numpy.newaxis] >= thresholds[numpy.newaxis, numpy.newaxis, :])
+	first = numpy.argmax(candidates, axis=1)[:, numpy.newaxis, :]
+	found = numpy.take_along_axis(candidates, first, axis=1)[:, 0, :]
+	extended = numpy.where(found, numpy.take_along_axis(neighbor_votes, first, axis=1)[:, 0, :], 0)
+
+	return numpy.where(own_votes != 0, own_votes, extended).astype(own_votes.dtype)
+
+
+# Extends the LFs (columns) lfs (default: all) of lf_matrix, a (num_rows x num_lf) matrix
+# whose first num_support rows are the training set. thresholds holds one similarity
+# threshold per LF (of all num_lf LFs). The extended columns are written to out (a
+# num_rows x num_lf array, allocated if None), which is returned.
+def extend_lf_matrix(lf_matrix, neighbor_indices, neighbor_sims, thresholds, num_support, lfs=None,
+	out=None, num_threads=None, block_bytes=knn.DEFAULT_BLOCK_BYTES):
+
+	lf_matrix = numpy.asarray(lf_matrix)
+	neighbor_indices = numpy.asarray(neighbor_indices)
+	neighbor_sims = numpy.asarray(neighbor_sims)
+	thresholds = numpy.asarray(thresholds, dtype=numpy.float64)
+	(num_rows, num_lf) = lf_matrix.shape
+	assert neighbor_indices.shape == neighbor_sims.shape and len(neighbor_indices) == num_rows
+	assert len(thresholds) == num_lf
+
+	if out is None:
+		out = numpy.array(lf_matrix)
+	if lfs is None:
+		lfs = range(num_lf)
+	lfs = list(lfs)
+
+	batches = [lfs[i:i+EXTENSION_LF_BATCH_SIZE] for i in range(0, len(lfs), EXTENSION_LF_BATCH_SIZE)]
+	k = neighbor_indices.shape[1]
+	block_rows = knn.rows_per_block(k * EXTENSION_LF_BATCH_SIZE, 4, block_bytes)
+	pieces = [(b, start) for b in range(len(batches)) for start in range(0, num_rows, block_rows)]
+
+	# votes of each batch's LFs on the training set, which is all that neighbor lookups touch
+	batch_votes = [numpy.ascontiguousarray(lf_matrix[:num_support, batch]) for batch in batches]
+
+	def extend_piece(piece):
+		(b, start) = piece
+		batch = batches[b]
+		end = min(start + block_rows, num_rows)
+		out[start:end, batch] = extend_block(batch_votes[b], lf_matrix[start:end, batch],
+			neighbor_indices[start:end], neighbor_sims[start:end], thresholds[batch])
+
+	if num_threads == 1 or len(pieces) <= 1:
+		for piece in pieces:
+			extend_piece(piece)
+	else:
+		with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+			for result in pool.map(extend_piece, pieces):
+				pass
+
+	return out
+
+
+# LFs whose threshold differs between two threshold arrays (nan equals nan)
+def changed_lfs(old_thresholds, new_thresholds):
+	old_thresholds = numpy.asarray(old_thresholds, dtype=numpy.float64)
+	new_thresholds = numpy.asarray(new_thresholds, dtype=numpy.float64)
+	same = (old_thresholds == new_thresholds) | (numpy.isnan(old_thresholds) & numpy.isnan(new_thresholds))
+	return numpy.flatnonzero(~same).tolist()
+
+
+# Incremental LF extension, for interactively tuning thresholds: keeps the extended LF
+# matrix of the last call to extend(), and only recomputes the LFs whose threshold
+# changed since. The LF matrix and neighbor arrays must not change between calls.
+class LFExtender:
+
+	def __init__(self, lf_matrix, neighbor_indices, neighbor_sims, num_support, num_threads=None):
+
+		self.lf_matrix = numpy.asarray(lf_matrix)
+		self.neighbor_indices = neighbor_indices
+		self.neighbor_sims = neighbor_sims
+		self.num_support = num_support
+		self.num_threads = num_threads
+
+		# to start with, no LF is extended
+		self.thresholds = numpy.full(self.lf_matrix.shape[1], numpy.nan)
+		self.extended_lf_matrix = numpy.array(self.lf_matrix)
+
+	# extends the LFs with new thresholds. Returns the LFs that were recomputed
+	def extend(self, thresholds):
+		thresholds = numpy.array(thresholds, dtype=numpy.float64)
+		lfs = changed_lfs(self.thresholds, thresholds)
+		if len(lfs) > 0:
+			extend_lf_matrix(self.lf_matrix, self.neighbor_indices, self.neighbor_sims, thresholds, self.num_support,
+				lfs=lfs, out=self.extended_lf_matrix, num_threads=self.num_threads)
+		self.thresholds = thresholds
+		return lfs
@@ -0,0 +1,219 @@
+import base64
+import numpy
+
+
+# Compact representations of LF matrices (num_rows x num_lf matrices of LF votes, -1
+# (negative), 0 (abstain) or 1 (positive)), for storing and shipping them:
+#
+#   -- PackedLFMatrix: dense, 2 bits per vote (4 votes per byte, row major)
+#   -- CSRLFMatrix: compressed sparse rows, holding only the non-abstain votes (for each
+#      row, the LFs that vote on it and their votes)
+#
+# compact_lf_matrix() picks whichever is smaller for a given matrix: LF matrices are
+# mostly abstains, so for sparse ones CSR is much smaller than even the packed form.
+# Both provide the same vectorized accessors (rows, LF columns, vote counts), so code
+# reading a compact matrix doesn't need to know its format.
+#
+# The serialized (json) form of a compact matrix (see to_json()) holds its arrays as
+# base64 encoded little endian bytes, which js/lfmatrix.js decodes back into a flat
+# array of votes for lfviz.
+
+LF_MATRIX_FORMAT_PACKED = "packed2"
+LF_MATRIX_FORMAT_CSR = "csr"
+
+# number of rows decoded at once by the accessors that scan the whole matrix
+LF_MATRIX_ROWS_PER_BLOCK = 64 * 1024
+
+# 2 bit code of each vote (the low bits of the vote as a uint8: 0 -> 0, 1 -> 1, -1 -> 3)
+# and the vote of each code
+VOTE_CODE_MASK = 3
+CODE_VOTES = numpy.array([0, 1, 0, -1], dtype=numpy.int8)
+
+
+def encode_array(arr):
+	arr = numpy.ascontiguousarray(arr)
+	return { "dtype" : arr.dtype.name, "data" : base64.b64encode(arr.astype(arr.dtype.newbyteorder("<"), copy=False).tobytes()).decode("ascii") }
+
+def decode_array(encoded):
+	return numpy.frombuffer(base64.b64decode(encoded["data"]), dtype=numpy.dtype(encoded["dtype"]).newbyteorder("<"))
+
+# smallest unsigned int dtype holding values up to max_value
+def get_index_dtype(max_value):
+	for dtype in [numpy.uint8, numpy.uint16, numpy.uint32]:
+		if max_value <= numpy.iinfo(dtype).max:
+			return dtype
+	return numpy.uint64
+
+# CSR row offsets from per row vote counts (preceded by a 0), as int32 unless they don't fit
+def get_indptr(row_counts):
+	indptr = numpy.cumsum(row_counts, dtype=numpy.int64)
+	if indptr[-1] <= numpy.iinfo(numpy.int32).max:
+		indptr = indptr.astype(numpy.int32)
+	return indptr
+
+
+# Accessors shared by the compact formats. Subclasses implement get_rows() (and faster
+# versions of the other accessors where their format allows)
+class CompactLFMatrix:
+
+	def __init__(self, num_rows, num_lf):
+		self.num_rows = num_rows
+		self.num_lf = num_lf
+		self.shape = (num_rows, num_lf)
+
+	# the votes of rows [start, end), as a dense (end-start) x num_lf int8 array
+	def get_rows(self, start, end):
+		raise NotImplementedError()
+
+	def get_row(self, row):
+		return self.get_rows(row, row + 1)[0]
+
+	# rows [start, end) clamped to the matrix's rows, as (start, end) with start <= end
+	def clamp_rows(self, start, end):
+		start = max(0, min(start, self.num_rows))
+		return (start, max(start, min(end, self.num_rows)))
+
+	def iter_row_blocks(self):
+		for start in range(0, self.num_rows, LF_MATRIX_ROWS_PER_BLOCK):
+			end = min(start + LF_MATRIX_ROWS_PER_BLOCK, self.num_rows)
+			yield (start, self.get_rows(start, end))
+
+	# the votes of LF lf on all rows
+	def get_lf(self, lf):
+		votes = numpy.zeros(self.num_rows, dtype=numpy.int8)
+		for (start, block) in self.iter_row_blocks():
+			votes[start:start+len(block)] = block[:, lf]
+		return votes
+
+	# number of (non-abstain) votes of each LF
+	def get_lf_vote_counts(self):
+		counts = numpy.zeros(self.num_lf, dtype=numpy.int64)
+		for (start, block) in self.iter_row_blocks():
+			counts = counts + numpy.count_nonzero(block, axis=0)
+		return counts
+
+	# fraction of rows each LF votes on
+	def get_coverage(self):
+		return self.get_lf_vote_counts() / max(1, self.num_rows)
+
+	# number of LFs voting on each row
+	def get_row_vote_counts(self):
+		counts = numpy.zeros(self.num_rows, dtype=numpy.int64)
+		for (start, block) in self.iter_row_blocks():
+			counts[start:start+len(block)] = numpy.count_nonzero(block, axis=1)
+		return counts
+
+	def to_dense(self):
+		return self.get_rows(0, self.num_rows)
+
+
+class PackedLFMatrix(CompactLFMatrix):
+
+	# data holds the 2 bit codes of the votes in row major order, 4 per byte, starting
+	# at the low bits
+	def __init__(self, data, num_rows, num_lf):
+		CompactLFMatrix.__init__(self, num_rows, num_lf)
+		self.data = data
+		self.nbytes = data.nbytes
+
+	def get_rows(self, start, end):
+		(start, end) = self.clamp_rows(start, end)
+		(first, last) = (start * self.num_lf, end * self.num_lf)
+		packed = self.data[first // 4:(last + 3) // 4]
+		codes = (packed[:, numpy.newaxis] >> numpy.array([0, 2, 4, 6], dtype=numpy.uint8)) & VOTE_CODE_MASK
+		votes = CODE_VOTES[codes.reshape(-1)]
+		return votes[first % 4:first % 4 + (last - first)].reshape((end - start, self.num_lf))
+
+	def to_json(self):
+		return { "format" : LF_MATRIX_FORMAT_PACKED, "num_rows" : self.num_rows, "num_lf" : self.num_lf,
+				 "data" : encode_array(self.data) }
+
+
+class CSRLFMatrix(CompactLFMatrix):
+
+	# the votes of row i are votes[indptr[i]:indptr[i+1]], on LFs lfs[indptr[i]:indptr[i+1]]
+	# (in increasing order)
+	def __init__(self, indptr, lfs, votes, num_rows, num_lf):
+		CompactLFMatrix.__init__(self, num_rows, num_lf)
+		self.indptr = indptr
+		self.lfs = lfs
+		self.votes = votes
+		self.nbytes = indptr.nbytes + lfs.nbytes + votes.nbytes
+
+	def get_rows(self, start, end):
+		(start, end) = self.clamp_rows(start, end)
+		rows = numpy.zeros((end - start, self.num_lf), dtype=numpy.int8)
+		(first, last) = (self.indptr[start], self.indptr[end])
+		row_counts = numpy.diff(self.indptr[start:end+1])
+		rows[numpy.repeat(numpy.arange(end - start), row_counts), self.lfs[first:last]] = self.votes[first:last]
+		return rows
+
+	def get_lf(self, lf):
+		positions = numpy.flatnonzero(self.lfs == lf)
+		votes = numpy.zeros(self.num_rows, dtype=numpy.int8)
+		votes[numpy.searchsorted(self.indptr, positions, side="right") - 1] = self.votes[positions]
+		return votes
+
+	def get_lf_vote_counts(self):
+		return numpy.bincount(self.lfs, minlength=self.num_lf).astype(numpy.int64)
+
+	def get_row_vote_counts(self):
+		return numpy.diff(self.indptr).astype(numpy.int64)
+
+	# the row offsets are serialized as per row vote counts, which fit a smaller dtype
+	def to_json(self):
+		row_counts = numpy.diff(self.indptr).astype(get_index_dtype(self.num_lf))
+		return { "format" : LF_MATRIX_FORMAT_CSR, "num_rows" : self.num_rows, "num_lf" : self.num_lf,
+				 "row_counts" : encode_array(row_counts), "lfs" : encode_array(self.lfs), "votes" : encode_array(self.votes) }
+
+
+def pack_lf_matrix(lf_matrix):
+	lf_matrix = numpy.asarray(lf_matrix, dtype=numpy.int8)
+	(num_rows, num_lf) = lf_matrix.shape
+	codes = lf_matrix.reshape(-1).view(numpy.uint8) & VOTE_CODE_MASK
+	codes = numpy.concatenate([codes, numpy.zeros(-len(codes) % 4, dtype=numpy.uint8)]).reshape((-1, 4))
+	data = codes[:, 0] | (codes[:, 1] << 2) | (codes[:, 2] << 4) | (codes[:, 3] << 6)
+	return PackedLFMatrix(data, num_rows, num_lf)
+
+def csr_lf_matrix(lf_matrix):
+	lf_matrix = numpy.asarray(lf_matrix, dtype=numpy.int8)
+	(num_rows, num_lf) = lf_matrix.shape
+	lf_dtype = get_index_dtype(max(0, num_lf - 1))
+	lfs = [numpy.zeros(0, dtype=lf_dtype)]
+	votes = [numpy.zeros(0, dtype=numpy.int8)]
+	row_counts = numpy.zeros(num_rows + 1, dtype=numpy.int64)
+	for start in range(0, num_rows, LF_MATRIX_ROWS_PER_BLOCK):
+		block = lf_matrix[start:start+LF_MATRIX_ROWS_PER_BLOCK]
+		(rows, cols) = numpy.nonzero(block)
+		lfs.append(cols.astype(lf_dtype))
+		votes.append(block[rows, cols])
+		row_counts[start+1:start+len(block)+1] = numpy.count_nonzero(block, axis=1)
+	return CSRLFMatrix(get_indptr(row_counts), numpy.concatenate(lfs), numpy.concatenate(votes), num_rows, num_lf)
+
+# compact form of an LF matrix (a num_rows x num_lf array) in the given format, or (if
+# format is None) in whichever format is smaller
+def compact_lf_matrix(lf_matrix, format=None):
+	lf_matrix = numpy.asarray(lf_matrix)
+	if format is None:
+		(num_rows, num_lf) = lf_matrix.shape
+		num_votes = 0
+		for start in range(0, num_rows, LF_MATRIX_ROWS_PER_BLOCK):
+			num_votes = num_votes + int(numpy.count_nonzero(lf_matrix[start:start+LF_MATRIX_ROWS_PER_BLOCK]))
+		packed_bytes = (num_rows * num_lf + 3) // 4
+		csr_bytes = num_votes * (numpy.dtype(get_index_dtype(max(0, num_lf - 1))).itemsize + 1) + \
+			num_rows * numpy.dtype(get_index_dtype(num_lf)).itemsize
+		format = LF_MATRIX_FORMAT_CSR if csr_bytes < packed_bytes else LF_MATRIX_FORMAT_PACKED
+	if format == LF_MATRIX_FORMAT_PACKED:
+		return pack_lf_matrix(lf_matrix)
+	if format == LF_MATRIX_FORMAT_CSR:
+		return csr_lf_matrix(lf_matrix)
+	raise ValueError("Unknown LF matrix format: %s" % format)
+
+# inverse of to_json()
+def lf_matrix_from_json(obj):
+	if obj["format"] == LF_MATRIX_FORMAT_PACKED:
+		return PackedLFMatrix(decode_array(obj["data"]), obj["num_rows"], obj["num_lf"])
+	if obj["format"] == LF_MATRIX_FORMAT_CSR:
+		indptr = get_indptr(numpy.concatenate([[0], decode_array(obj["row_counts"])]))
+		return CSRLFMatrix(indptr, decode_array(obj["lfs"]), decode_array(obj["votes"]), obj["num_rows"], obj["num_lf"])
+	raise ValueError("Unknown LF matrix format: %s" % obj["format"])
@@ -0,0 +1,142 @@
+import numpy
+
+
+# Summary statistics of labeling functions, computed from an LF matrix (one row per
+# datapoint, one column per LF, values -1 (negative), 0 (abstain), 1 (positive))
+# and optionally ground truth labels (-1, 1, or 0 for unknown).
+#
+# Per LF:
+#   -- coverage: fraction of datapoints the LF votes on
+#   -- overlap: fraction of datapoints the LF votes on that some other LF also votes on
+#   -- conflict: fraction of datapoints the LF votes on that some other LF votes differently on
+#   -- num_correct, num_incorrect, accuracy: agreement of the LF's votes with the ground
+#      truth, on datapoints with a known ground truth label (accuracy is None if there are none)
+# Per pair of LFs (num_lf x num_lf matrices of counts):
+#   -- pair_overlap[i][j]: number of datapoints both LFs vote on
+#   -- pair_conflict[i][j]: number of datapoints both LFs vote on, with different votes
+#
+# All statistics are computed with numpy a block of rows at a time, so they are cheap
+# to compute even for millions of datapoints.
+
+LF_POSITIVE = 1
+LF_NEGATIVE = -1
+
+# number of LF matrix rows processed at once
+STATS_ROWS_PER_BLOCK = 64 * 1024
+
+
+def compute_lf_stats(lf_matrix, ground_truth=None):
+	lf_matrix = numpy.asarray(lf_matrix)
+	(num_rows, num_lf) = lf_matrix.shape
+
+	num_votes = numpy.zeros(num_lf, dtype=numpy.int64)
+	num_positive = numpy.zeros(num_lf, dtype=numpy.int64)
+	num_negative = numpy.zeros(num_lf, dtype=numpy.int64)
+	num_overlap = numpy.zeros(num_lf, dtype=numpy.int64)
+	num_conflict = numpy.zeros(num_lf, dtype=numpy.int64)
+	num_correct = numpy.zeros(num_lf, dtype=numpy.int64)
+	num_incorrect = numpy.zeros(num_lf, dtype=numpy.int64)
+	pair_overlap = numpy.zeros((num_lf, num_lf), dtype=numpy.float64)
+	pair_conflict = numpy.zeros((num_lf, num_lf), dtype=numpy.float64)
+	num_covered = 0
+	num_overlapped = 0
+	num_conflicted = 0
+
+	for start in range(0, num_rows, STATS_ROWS_PER_BLOCK):
+		block = lf_matrix[start:start+STATS_ROWS_PER_BLOCK]
+		positive = (block == LF_POSITIVE)
+		negative = (block == LF_NEGATIVE)
+		votes = positive | negative
+
+		row_votes = votes.sum(axis=1)
+		row_conflicts = positive.any(axis=1) & negative.any(axis=1)
+		num_covered = num_covered + int((row_votes > 0).sum())
+		num_overlapped = num_overlapped + int((row_votes > 1).sum())
+		num_conflicted = num_conflicted + int(row_conflicts.sum())
+
+		num_votes = num_votes + votes.sum(axis=0)
+		num_positive = num_positive + positive.sum(axis=0)
+		num_negative = num_negative + negative.sum(axis=0)
+		num_overlap = num_overlap + (votes & (row_votes > 1)[:, None]).sum(axis=0)
+		num_conflict = num_conflict + (votes & row_conflicts[:, None]).sum(axis=0)
+
+		# pairwise counts as matrix products (floats, since numpy's integer matmul doesn't
+		# use BLAS. float64 counts are exact far beyond any dump size)
+		votes_f = votes.astype(numpy.float64)
+		positive_f = positive.astype(numpy.float64)
+		negative_f = negative.astype(numpy.float64)
+		pair_overlap = pair_overlap + votes_f.T @ votes_f
+		disagree = positive_f.T @ negative_f
+		pair_conflict = pair_conflict + disagree + disagree.T
+
+		if ground_truth is not None:
+			truth = numpy.asarray(ground_truth[start:start+STATS_ROWS_PER_BLOCK])[:, None]
+			labeled_votes = votes & (truth != 0)
+			correct = labeled_votes & (block == truth)
+			num_correct = num_correct + correct.sum(axis=0)
+			num_incorrect = num_incorrect + (labeled_votes & ~correct).sum(axis=0)
+
+	def fraction(counts, totals):
+		return [float(c) / t if t > 0 else 0.0 for (c, t) in zip(counts, totals)]
+
+	stats = {
+		"num_datapoints" : num_rows,
+		"coverage" : fraction(num_votes, [num_rows] * num_lf),
+		"overlap" : fraction(num_overlap, num_votes),
+		"conflict" : fraction(num_conflict, num_votes),
+		"num_positive" : num_positive.tolist(),
+		"num_negative" : num_negative.tolist(),
+		"total_coverage" : float(num_covered) / num_rows if num_rows > 0 else 0.0,
+		"total_overlap" : float(num_overlapped) / num_rows if num_rows > 0 else 0.0,
+		"total_conflict" : float(num_conflicted) / num_rows if num_rows > 0 else 0.0,
+		"pair_overlap" : pair_overlap.astype(numpy.int64).tolist(),
+		"pair_conflict" : pair_conflict.astype(numpy.int64).tolist(),
+	}
+
+	if ground_truth is not None:
+		num_labeled = num_correct + num_incorrect
+		stats["num_correct"] = num_correct.tolist()
+		stats["num_incorrect"] = num_incorrect.tolist()
+		stats["accuracy"] = [float(c) / n if n > 0 else None for (c, n) in zip(num_correct, num_labeled)]
+
+	return stats
+
+
+# statistics of an LF matrix for all datapoints, and for the train and val splits
+# (the first num_train rows, and the rest)
+def compute_split_lf_stats(lf_matrix, num_train, ground_truth=None):
+	splits = { "all" : slice(0, None), "train" : slice(0, num_train), "val" : slice(num_train, None) }
+	stats = {}
+	for (split, rows) in splits.items():
+		split_truth = None if ground_truth is None else ground_truth[rows]
+		stats[split] = compute_lf_stats(lf_matrix[rows], split_truth)
+	return stats
+
+
+# prints a per-LF table of the statistics of one split
+def print_lf_stats(stats, lf_names):
+	has_accuracy = "accuracy" in stats
+	print("%-32s %9s %9s %9s %9s" % ("LF", "coverage", "overlap", "conflict", "accuracy" if has_accuracy else ""))
+	for (lf, name) in enumerate(lf_names):
+		accuracy = ""
+		if has_accuracy and stats["accuracy"][lf] is not None:
+			accuracy = "%.4f" % stats["accuracy"][lf]
+		print("%-32s %9.4f %9.4f %9.4f %9s" % (name[:32], stats["coverage"][lf], stats["overlap"][lf], stats["conflict"][lf], accuracy))
+	print("%-32s %9.4f %9.4f %9.4f" % ("(any LF)", stats["total_coverage"], stats["total_overlap"], stats["total_conflict"]))
+
+
+# usage: python lfstats.py <columnar dump directory>
+# prints the LF statistics of a dump written by WeakDB.save_columnar() (e.g., to check them in CI)
+if __name__ == "__main__":
+	import sys
+	from weakdb import WeakDB
+
+	db = WeakDB()
+	db.load(sys.argv[1])
+	all_stats = db.compute_lf_stats()
+	for ext_type in ["noext", "ext"]:
+		if ext_type not in all_stats:
+			continue
+		for split in ["train", "val"]:
+			print("\n%s (%s, %d datapoints)" % (split, ext_type, all_stats[ext_type][split]["num_datapoints"]))
+			print_lf_stats(all_stats[ext_type][split], db.lf_names)
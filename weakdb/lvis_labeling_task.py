@@ -6,6 +6,9 @@ import os
 # This script is an example of how to create a labeling tasks from a
 # list of image files in a directory.
 #
+# For large collections of images, see taskbuilder.py, which splits a collection
+# into many labeling tasks of bounded size.
+#
 
 ASSETS_DIR = "lfviz_assets" 
 LVIS_DIR = "lvis_val2017"
@@ -48,5 +51,8 @@ task.set_category_mapping( {
 filename = os.path.join("labeling_results", "%s.json" % task.task_id)
 task.save(filename)
 
+# Pack thumbnails of the task's images into atlases, for views that show many of them at once
+task.save_atlases("labeling_results")
+
 # Now you can open this labeling task using labeling.html and start labeling
 print("Created labeling task: %s" % task.task_id)
\ No newline at end of file
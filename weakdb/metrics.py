@@ -0,0 +1,296 @@
+import bisect
+import contextlib
+import cProfile
+import functools
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+# Lightweight instrumentation of the labeling server and WeakDB: counters, gauges and
+# latency histograms, rendered in the Prometheus text format (see server.py's /metrics).
+#
+# Recording is off until enable() is called (the servers enable it on startup), and
+# costs a lock and a few additions per observation when on. Metrics are identified by
+# name and labels, e.g.:
+#
+#    REQUEST_SECONDS = histogram("weakdb_http_request_duration_seconds", "...", ["endpoint"])
+#    REQUEST_SECONDS.observe(0.02, endpoint="get_task")
+#    with REQUEST_SECONDS.time(endpoint="get_task"):
+#        ...
+#
+# WeakDB methods are timed as "stages" (see stage_timer()). If tracemalloc is tracing
+# (enable(trace_memory=True)), the peak memory allocated during each stage is recorded too.
+
+# latency histogram buckets, in seconds
+DEFAULT_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape_label_value(value):
+	return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def format_labels(labelnames, values, extra=""):
+	pairs = ["%s=\"%s\"" % (name, escape_label_value(value)) for (name, value) in zip(labelnames, values)]
+	if len(extra) > 0:
+		pairs.append(extra)
+	return "{%s}" % ",".join(pairs) if len(pairs) > 0 else ""
+
+def format_value(value):
+	if value == float("inf"):
+		return "+Inf"
+	return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# base class of metrics: a value (or histogram) per combination of label values
+class Metric:
+
+	TYPE = None
+
+	def __init__(self, registry, name, help, labelnames):
+		self.registry = registry
+		self.name = name
+		self.help = help
+		self.labelnames = list(labelnames)
+		self.values = {}
+		self.lock = threading.Lock()
+
+	def get_key(self, labels):
+		assert len(labels) == len(self.labelnames), "%s takes labels %s" % (self.name, self.labelnames)
+		return tuple(str(labels[name]) for name in self.labelnames)
+
+	def render(self):
+		lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.TYPE)]
+		with self.lock:
+			items = sorted(self.values.items())
+		for (key, value) in items:
+			lines.extend(self.render_value(key, value))
+		return lines
+
+	def render_value(self, key, value):
+		return ["%s%s %s" % (self.name, format_labels(self.labelnames, key), format_value(value))]
+
+
+class Counter(Metric):
+
+	TYPE = "counter"
+
+	def inc(self, amount=1, **labels):
+		if not self.registry.enabled:
+			return
+		key = self.get_key(labels)
+		with self.lock:
+			self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+
+	TYPE = "gauge"
+
+	def set(self, value, **labels):
+		if not self.registry.enabled:
+			return
+		key = self.get_key(labels)
+		with self.lock:
+			self.values[key] = value
+
+	# sets the gauge to value if it is larger than the current value
+	def set_max(self, value, **labels):
+		if not self.registry.enabled:
+			return
+		key = self.get_key(labels)
+		with self.lock:
+			self.values[key] = max(self.values.get(key, value), value)
+
+
+class Histogram(Metric):
+
+	TYPE = "histogram"
+
+	def __init__(self, registry, name, help, labelnames, buckets=DEFAULT_BUCKETS):
+		Metric.__init__(self, registry, name, help, labelnames)
+		self.buckets = sorted(buckets)
+
+	def observe(self, value, **labels):
+		if not self.registry.enabled:
+			return
+		key = self.get_key(labels)
+		bucket = bisect.bisect_left(self.buckets, value)
+		with self.lock:
+			counts = self.values.get(key)
+			if counts is None:
+				# per bucket counts (the last one is +Inf), then the sum of the observations
+				counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+			counts[bucket] = counts[bucket] + 1
+			counts[-1] = counts[-1] + value
+
+	# observes the time taken by the body of a with block
+	@contextlib.contextmanager
+	def time(self, **labels):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - start, **labels)
+
+	def render_value(self, key, counts):
+		lines = []
+		total = 0
+		for (bound, count) in zip(self.buckets + [float("inf")], counts[:-1]):
+			total = total + count
+			le = "le=\"%s\"" % format_value(float(bound))
+			lines.append("%s_bucket%s %d" % (self.name, format_labels(self.labelnames, key, le), total))
+		labels = format_labels(self.labelnames, key)
+		lines.append("%s_sum%s %s" % (self.name, labels, format_value(counts[-1])))
+		lines.append("%s_count%s %d" % (self.name, labels, total))
+		return lines
+
+
+class MetricsRegistry:
+
+	def __init__(self):
+		self.enabled = False
+		self.metrics = {}
+		self.lock = threading.Lock()
+
+	# returns the metric called name, creating it if it doesn't exist yet
+	def get_metric(self, cls, name, help, labelnames, **options):
+		with self.lock:
+			metric = self.metrics.get(name)
+			if metric is None:
+				metric = self.metrics[name] = cls(self, name, help, labelnames, **options)
+			assert metric.TYPE == cls.TYPE
+			return metric
+
+	def render(self):
+		update_process_metrics()
+		with self.lock:
+			metrics = sorted(self.metrics.values(), key=lambda metric: metric.name)
+		lines = []
+		for metric in metrics:
+			lines.extend(metric.render())
+		return "\n".join(lines) + "\n"
+
+
+# HACK: like weakdb.py, this module is imported both as part of the weakdb package and as a
+# top-level module (by the servers and the other modules in this directory). Whichever
+# copy is imported second shares the registry of the first, so all metrics end up in one place.
+other_module = sys.modules.get("metrics" if __name__ != "metrics" else "weakdb.metrics")
+REGISTRY = other_module.REGISTRY if other_module is not None else MetricsRegistry()
+
+def counter(name, help, labelnames=()):
+	return REGISTRY.get_metric(Counter, name, help, labelnames)
+
+def gauge(name, help, labelnames=()):
+	return REGISTRY.get_metric(Gauge, name, help, labelnames)
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+	return REGISTRY.get_metric(Histogram, name, help, labelnames, buckets=buckets)
+
+# turns on recording of metrics. If trace_memory is set, memory allocations are traced
+# (with tracemalloc, which slows allocations down) to record the peak memory of stages
+def enable(trace_memory=False):
+	REGISTRY.enabled = True
+	if trace_memory and not tracemalloc.is_tracing():
+		tracemalloc.start()
+
+def disable():
+	REGISTRY.enabled = False
+
+def is_enabled():
+	return REGISTRY.enabled
+
+# the metrics in the Prometheus text format
+def render():
+	return REGISTRY.render()
+
+
+###############################################################
+# process, task and WeakDB metrics
+###############################################################
+
+PROCESS_PEAK_RSS_BYTES = gauge("weakdb_process_peak_rss_bytes", "Peak resident set size of the process")
+
+# time spent loading, serializing and saving labeling tasks (see taskcache.py, taskstore.py, labelingtask.py)
+TASK_SECONDS = histogram("weakdb_task_operation_seconds", "Time spent on labeling task operations", ["operation"])
+
+STAGE_SECONDS = histogram("weakdb_stage_seconds", "Time taken by WeakDB stages", ["stage"])
+STAGE_PEAK_BYTES = gauge("weakdb_stage_peak_memory_bytes",
+	"Peak memory allocated during the last run of a WeakDB stage (only recorded while tracemalloc is tracing)", ["stage"])
+STAGE_MAX_PEAK_BYTES = gauge("weakdb_stage_max_peak_memory_bytes",
+	"Largest peak memory allocated during any run of a WeakDB stage (only recorded while tracemalloc is tracing)", ["stage"])
+
+def update_process_metrics():
+	try:
+		import resource
+		maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		# ru_maxrss is in kilobytes on linux, bytes on macOS
+		PROCESS_PEAK_RSS_BYTES.set(maxrss if sys.platform == "darwin" else maxrss * 1024)
+	except ImportError:
+		pass
+
+# peak traced memory of the stages running on each thread, so that nested stages don't
+# lose the peak of the stage they run in (tracemalloc has a single, process wide, peak)
+stage_peaks = threading.local()
+
+# times the body of a with block as WeakDB stage name
+@contextlib.contextmanager
+def stage_timer(name):
+	if not REGISTRY.enabled:
+		yield
+		return
+
+	# each stage on the stack is [traced bytes at its start, peak traced bytes of its nested stages]
+	tracing = tracemalloc.is_tracing()
+	if tracing:
+		stack = stage_peaks.__dict__.setdefault("stack", [])
+		(start_bytes, peak_bytes) = tracemalloc.get_traced_memory()
+		if len(stack) > 0:
+			stack[-1][1] = max(stack[-1][1], peak_bytes)
+		tracemalloc.reset_peak()
+		stack.append([start_bytes, 0])
+
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		STAGE_SECONDS.observe(time.perf_counter() - start, stage=name)
+		if tracing:
+			(start_bytes, nested_peak_bytes) = stack.pop()
+			peak_bytes = max(nested_peak_bytes, tracemalloc.get_traced_memory()[1])
+			if len(stack) > 0:
+				stack[-1][1] = max(stack[-1][1], peak_bytes)
+			STAGE_PEAK_BYTES.set(peak_bytes - start_bytes, stage=name)
+			STAGE_MAX_PEAK_BYTES.set_max(peak_bytes - start_bytes, stage=name)
+
+# decorator version of stage_timer() (for methods)
+def timed_stage(name):
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args, **kwargs):
+			with stage_timer(name):
+				return func(*args, **kwargs)
+		return wrapper
+	return decorator
+
+
+###############################################################
+# profiling
+###############################################################
+
+# runs the body of a with block under cProfile and writes the profile to filename
+# (view it with, e.g., python -m pstats <filename>)
+@contextlib.contextmanager
+def profile(filename):
+	profiler = cProfile.Profile()
+	profiler.enable()
+	try:
+		yield profiler
+	finally:
+		profiler.disable()
+		if len(os.path.dirname(filename)) > 0:
+			os.makedirs(os.path.dirname(filename), exist_ok=True)
+		profiler.dump_stats(filename)
@@ -0,0 +1,312 @@
+import bisect
+import concurrent.futures
+import json
+import os
+import shutil
+import threading
+import numpy
+
+# HACK: like weakdb.py, this module is imported both as part of the weakdb package and
+# as a top-level module (by server.py)
+try:
+	from .weakdb import WeakDB
+except ImportError:
+	from weakdb import WeakDB
+
+
+# Sharded dumps: a columnar dump (see WeakDB.save_columnar()) split into shards holding
+# contiguous ranges of datapoints, for dumps too large to build or read as one piece.
+#
+# A sharded dump is a directory (<DUMPNAME>_shards) with one columnar dump per shard,
+# holding the shard's rows of every per-datapoint column, and a manifest (shards.json)
+# listing the shards and their datapoint ranges, plus the dump info of the whole dump.
+# Neighbor indices (sorted_dists) always refer to datapoints of the whole dump.
+#
+# Shards are independent: each can be written by a different process (e.g., the worker
+# that ran the LFs on those datapoints) with save_shard(), given a WeakDB holding just
+# the shard's datapoints. Once all shards are written, merge_shards() checks that they
+# cover the dump and writes the manifest. save_sharded() does all of it for a WeakDB
+# holding a whole dump (replacing any shards of a previous save). When re-writing a
+# sharded dump shard by shard, remove the old shards first (clear_shards()), and pass
+# the number of datapoints of the dump to merge_shards(), so shards left over from a
+# previous (larger) dump are caught.
+#
+# ShardedDump reads a sharded dump, opening (memory mapping) only the shards that the
+# rows it is asked for are in. It has the same range accessors as WeakDB, so the
+# server's weakdb API serves sharded dumps like columnar ones.
+
+SHARDED_FORMAT_VERSION = 1
+SHARDED_MANIFEST_FILENAME = "shards.json"
+
+# default number of datapoints per shard of save_sharded()
+DEFAULT_SHARD_ROWS = 1000000
+
+
+def get_sharded_dir(target_dir, dump_name):
+	return os.path.join(target_dir, "%s_shards" % dump_name)
+
+def get_sharded_manifest_filename(sharded_dir):
+	return os.path.join(sharded_dir, SHARDED_MANIFEST_FILENAME)
+
+# shards are named by their range, so shards written by different processes never collide
+def get_shard_dirname(start, end):
+	return "shard_%012d_%012d" % (start, end)
+
+def is_sharded_dump(path):
+	return os.path.exists(get_sharded_manifest_filename(path))
+
+def is_shard_dirname(dirname):
+	return dirname.startswith("shard_")
+
+# removes the manifest and shards of the sharded dump in sharded_dir (if any)
+def clear_shards(sharded_dir):
+	if not os.path.isdir(sharded_dir):
+		return
+	manifest_filename = get_sharded_manifest_filename(sharded_dir)
+	if os.path.exists(manifest_filename):
+		os.remove(manifest_filename)
+	for dirname in os.listdir(sharded_dir):
+		if is_shard_dirname(dirname):
+			shutil.rmtree(os.path.join(sharded_dir, dirname))
+
+
+# writes db, which holds datapoints [start, start + the number of datapoints in db) of a
+# dump, as a shard of the sharded dump in sharded_dir. The shard's manifest is written
+# last, so merge_shards() ignores shards that are still being written
+def save_shard(db, sharded_dir, start):
+	end = start + db.num_train + db.num_val
+	shard_dir = os.path.join(sharded_dir, get_shard_dirname(start, end))
+	db.write_columnar(shard_dir, { "shard" : { "start" : start, "end" : end } })
+	return shard_dir
+
+# writes a whole dump as a sharded dump of shards of (up to) rows_per_shard datapoints,
+# num_threads at a time. Returns the directory of the sharded dump
+def save_sharded(db, target_dir, rows_per_shard=DEFAULT_SHARD_ROWS, num_threads=None):
+	sharded_dir = get_sharded_dir(target_dir, db.dump_name)
+	num_rows = db.num_train + db.num_val
+	starts = range(0, num_rows, rows_per_shard)
+	clear_shards(sharded_dir)
+
+	def save(start):
+		return os.path.basename(save_shard(db.get_row_range(start, start + rows_per_shard), sharded_dir, start))
+
+	with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+		shard_dirnames = list(pool.map(save, starts))
+
+	merge_shards(sharded_dir, num_rows, shard_dirnames)
+	return sharded_dir
+
+# the manifests of the (completely written) shards in sharded_dir, or of the shards with the
+# given directory names
+def load_shard_manifests(sharded_dir, shard_dirnames=None):
+	if shard_dirnames is None:
+		shard_dirnames = [dirname for dirname in os.listdir(sharded_dir) if is_shard_dirname(dirname)]
+	manifests = []
+	for dirname in sorted(shard_dirnames):
+		manifest_filename = os.path.join(sharded_dir, dirname, WeakDB.COLUMNAR_MANIFEST_FILENAME)
+		if not os.path.exists(manifest_filename):
+			continue
+		with open(manifest_filename, "rt") as f:
+			manifest = json.load(f)
+		manifest["dir"] = dirname
+		manifests.append(manifest)
+	return manifests
+
+# Writes the manifest of the sharded dump in sharded_dir from the shards written to it (or
+# just the shards with the given directory names). The shards must cover datapoints [0, N)
+# (with N = num_rows, if given) without gaps or overlaps, agree on the LFs and columns of
+# the dump, and have all training set datapoints before the val set ones. Raises ValueError
+# otherwise. Returns the manifest.
+def merge_shards(sharded_dir, num_rows=None, shard_dirnames=None):
+	manifests = load_shard_manifests(sharded_dir, shard_dirnames)
+	if shard_dirnames is not None and len(manifests) != len(shard_dirnames):
+		raise ValueError("Only %d of the %d shards in %s are complete" % (len(manifests), len(shard_dirnames), sharded_dir))
+	if len(manifests) == 0:
+		raise ValueError("No shards in %s" % sharded_dir)
+	manifests.sort(key=lambda manifest: manifest["shard"]["start"])
+
+	first_info = manifests[0]["dump_info"]
+	columns = {}
+	shards = []
+	(num_train, num_val) = (0, 0)
+	for manifest in manifests:
+		(start, end) = (manifest["shard"]["start"], manifest["shard"]["end"])
+		info = manifest["dump_info"]
+		if start != num_train + num_val:
+			raise ValueError("Shard %s starts at datapoint %d, expected %d" % (manifest["dir"], start, num_train + num_val))
+		if info["num_train"] > 0 and num_val > 0:
+			raise ValueError("Shard %s has training set datapoints after val set ones" % manifest["dir"])
+		for key in ["num_lf", "lf_names", "datatype", "has_extended_data", "has_similarity_data", "has_similarity_scores", "has_ground_truth"]:
+			if info[key] != first_info[key]:
+				raise ValueError("Shard %s has a different %s than shard %s" % (manifest["dir"], key, manifests[0]["dir"]))
+
+		for (column, column_info) in manifest["columns"].items():
+			columns[column] = { "dtype" : column_info["dtype"] }
+		num_train = num_train + info["num_train"]
+		num_val = num_val + info["num_val"]
+		shards.append({ "start" : start, "end" : end, "dir" : manifest["dir"] })
+
+	if num_rows is not None and num_train + num_val != num_rows:
+		raise ValueError("Shards in %s cover %d datapoints, expected %d" % (sharded_dir, num_train + num_val, num_rows))
+
+	dump_info = dict(first_info)
+	dump_info["num_train"] = num_train
+	dump_info["num_val"] = num_val
+
+	manifest = { "format_version" : SHARDED_FORMAT_VERSION, "dump_info" : dump_info, "columns" : columns, "shards" : shards }
+	manifest_filename = get_sharded_manifest_filename(sharded_dir)
+	tmp_filename = "%s.tmp" % manifest_filename
+	with open(tmp_filename, "wt") as f:
+		f.write(json.dumps(manifest))
+	os.replace(tmp_filename, manifest_filename)
+	return manifest
+
+
+# concatenates rankings of (possibly) different widths, padding the narrower ones with pad
+def concatenate_rankings(rankings, pad):
+	rankings = [r for r in rankings if len(r) > 0]
+	if len(rankings) == 0:
+		return None
+	width = max(r.shape[1] for r in rankings)
+	padded = []
+	for r in rankings:
+		if r.shape[1] < width:
+			r = numpy.concatenate([r, numpy.full((len(r), width - r.shape[1]), pad, dtype=r.dtype)], axis=1)
+		padded.append(r)
+	return numpy.concatenate(padded)
+
+
+class ShardedDump:
+
+	def __init__(self, path):
+		self.path = path
+		with open(get_sharded_manifest_filename(path), "rt") as f:
+			self.manifest = json.load(f)
+		if self.manifest["format_version"] != SHARDED_FORMAT_VERSION:
+			raise ValueError("Unsupported sharded dump version %d in %s" % (self.manifest["format_version"], path))
+
+		dump_info = self.manifest["dump_info"]
+		self.dump_name = dump_info["name"]
+		self.num_lf = dump_info["num_lf"]
+		self.num_train = dump_info["num_train"]
+		self.num_val = dump_info["num_val"]
+		self.lf_names = dump_info["lf_names"]
+		self.shards = self.manifest["shards"]
+		self.shard_starts = [shard["start"] for shard in self.shards]
+
+		# opened shards (WeakDBs), by index
+		self.open_shards = {}
+		self.lock = threading.Lock()
+
+	def get_dump_info(self):
+		return dict(self.manifest["dump_info"])
+
+	def get_num_shards(self):
+		return len(self.shards)
+
+	def load_shard(self, i, mmap):
+		db = WeakDB()
+		db.load(os.path.join(self.path, self.shards[i]["dir"]), mmap=mmap)
+		return db
+
+	# the (memory mapped) WeakDB of shard i, opened on first use
+	def get_shard(self, i):
+		with self.lock:
+			db = self.open_shards.get(i)
+		if db is None:
+			db = self.load_shard(i, True)
+			with self.lock:
+				db = self.open_shards.setdefault(i, db)
+		return db
+
+	# indices of the shards holding datapoints [start, start + count)
+	def get_shard_range(self, start, count):
+		if count <= 0:
+			return range(0)
+		first = bisect.bisect_right(self.shard_starts, start) - 1
+		last = bisect.bisect_right(self.shard_starts, start + count - 1) - 1
+		return range(max(0, first), last + 1)
+
+	def clamp_range(self, start, count):
+		num_total = self.num_train + self.num_val
+		start = max(0, min(start, num_total))
+		return (start, max(0, min(count, num_total - start)))
+
+	# calls get(shard db, start, count) for the part of datapoints [start, start + count)
+	# in each shard, and returns the list of results
+	def map_range(self, start, count, get):
+		(start, count) = self.clamp_range(start, count)
+		results = []
+		for i in self.get_shard_range(start, count):
+			shard = self.shards[i]
+			shard_start = max(start, shard["start"])
+			shard_end = min(start + count, shard["end"])
+			results.append(get(self.get_shard(i), shard_start - shard["start"], shard_end - shard_start))
+		return results
+
+	def concatenate(self, parts, empty):
+		return numpy.concatenate(parts) if len(parts) > 0 else empty
+
+	# the same range accessors as WeakDB's
+
+	def get_lf_matrix_rows(self, start, count, extended=False, lfs=None):
+		parts = self.map_range(start, count, lambda db, s, c: db.get_lf_matrix_rows(s, c, extended=extended, lfs=lfs))
+		return self.concatenate(parts, numpy.zeros((0, self.num_lf if lfs is None else len(lfs)), dtype=numpy.int8))
+
+	def get_prob_labels_rows(self, start, count, extended=False):
+		parts = self.map_range(start, count, lambda db, s, c: db.get_prob_labels_rows(s, c, extended=extended))
+		return self.concatenate(parts, numpy.zeros(0, dtype=numpy.float32))
+
+	def get_ground_truth_rows(self, start, count):
+		parts = self.map_range(start, count, lambda db, s, c: db.get_ground_truth_rows(s, c))
+		return self.concatenate(parts, numpy.zeros(0, dtype=numpy.int8))
+
+	def get_datapoints_rows(self, start, count):
+		rows = []
+		for part in self.map_range(start, count, lambda db, s, c: db.get_datapoints_rows(s, c)):
+			rows.extend(part)
+		return rows
+
+	def get_neighbors(self, idx, count=None):
+		i = self.get_shard_range(idx, 1)[0]
+		return self.get_shard(i).get_neighbors(idx - self.shards[i]["start"], count)
+
+	# reads the whole dump into a single WeakDB (in memory), e.g., to save it as a json dump for lfviz
+	def load_weakdb(self):
+		dump_info = self.manifest["dump_info"]
+		db = WeakDB(self.num_train, self.num_val, self.num_lf)
+		db.dump_name = self.dump_name
+		db.description = dump_info["description"]
+		db.lf_names = list(self.lf_names)
+		db.datapoint_type = dump_info["datatype"]
+
+		shard_dbs = [self.load_shard(i, False) for i in range(len(self.shards))]
+		db.datapoints = []
+		for shard_db in shard_dbs:
+			db.datapoints.extend(shard_db.datapoints)
+		for column in self.manifest["columns"]:
+			values = [getattr(shard_db, column) for shard_db in shard_dbs]
+			if column in WeakDB.RANKING_COLUMNS:
+				setattr(db, column, concatenate_rankings(values, -1 if column == "sorted_dists" else 0))
+			else:
+				setattr(db, column, numpy.concatenate(values))
+		return db
+
+
+# usage: python shards.py <sharded dump directory> [<columnar dump target directory>] [--num-rows N]
+# merges the shards written to a sharded dump directory (writes its manifest), checking
+# that they cover N datapoints if given, and optionally writes the merged dump as a
+# single columnar dump
+if __name__ == "__main__":
+	import argparse
+
+	parser = argparse.ArgumentParser(description="Merges the shards of a sharded dump")
+	parser.add_argument("sharded_dir")
+	parser.add_argument("columnar_dir", nargs="?", default=None)
+	parser.add_argument("--num-rows", type=int, default=None, help="number of datapoints the shards must cover")
+	args = parser.parse_args()
+
+	manifest = merge_shards(args.sharded_dir, args.num_rows)
+	print("Merged %d shards, %d datapoints" % (len(manifest["shards"]), manifest["dump_info"]["num_train"] + manifest["dump_info"]["num_val"]))
+	if args.columnar_dir is not None:
+		ShardedDump(args.sharded_dir).load_weakdb().save_columnar(args.columnar_dir)
@@ -0,0 +1,352 @@
+import argparse
+import concurrent.futures
+import hashlib
+import io
+import json
+import math
+import os
+import numpy
+
+from PIL import Image
+
+import jsonstream
+from labelingtask import LabelingTask
+from taskstore import JSONTaskStore, SQLiteTaskStore
+
+
+# Bulk creation of labeling tasks from (very large) collections of images, for collections
+# too large to label as a single task (see lvis_labeling_task.py for creating one task).
+#
+# Building the tasks of a collection:
+#
+#   1. the image trees are scanned in parallel (a pool of threads, one directory at a time)
+#   2. the content hash (sha1) and size of every image are extracted by a pool of processes.
+#      Images with the same contents are only labeled once, and unreadable images are skipped.
+#   3. the images are ordered (by path, or by content hash, which spreads each directory
+#      over all the tasks) and split into tasks of at most max_task_size datapoints.
+#      Optionally, each task also holds a fraction (overlap) of the next task's images, so
+#      every image in the overlap is labeled in two tasks, for measuring labeler agreement.
+#   4. all the tasks are registered with a task store at once (see taskstore.py)
+#
+# Splits only depend on the set of images and the options, so rebuilding the tasks of a
+# collection gives the same tasks (with the same ids). Since replacing a task discards
+# the labels submitted to it, tasks (or a manifest) of the same name are only replaced
+# if asked to (replace=True, or --replace), in which case tasks of the previous build
+# that the new one doesn't have are deleted too.
+#
+# A manifest (<name>_tasks.json) is saved next to the tasks, recording the images (urls,
+# sizes, hashes) and the images of each task, as ranges of indices into the images:
+#
+#   { "name" : ..., "order" : ..., "overlap" : ..., "max_task_size" : ...,
+#     "images" : { "urls" : [...], "widths" : [...], "heights" : [...], "sha1" : [...] },
+#     "tasks" : [ { "task_id" : ..., "ranges" : [[start, end], ...] }, ... ] }
+#
+# The datapoints of a task are the images of its ranges, in order. Usage:
+#
+#    python weakdb/taskbuilder.py <IMAGE_DIR> ... --name <NAME> --categories cat,background --max-task-size 10000 --overlap 0.05
+
+TASK_BUILD_FORMAT_VERSION = 1
+
+IMAGE_EXTENSIONS = [".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"]
+
+# directories scanned at once (scanning is I/O bound, e.g., on network file systems)
+SCAN_THREADS = 16
+
+# images probed per process pool job
+PROBE_BATCH_SIZE = 256
+
+DEFAULT_MAX_TASK_SIZE = 10000
+
+ORDER_PATH = "path"
+ORDER_HASH = "hash"
+
+# EXIF orientations of images stored rotated by 90 degrees (their width and height are swapped when shown)
+EXIF_ORIENTATION_TAG = 0x0112
+TRANSPOSED_ORIENTATIONS = [5, 6, 7, 8]
+
+
+def get_manifest_filename(target_dir, name):
+	return os.path.join(target_dir, "%s_tasks.json" % name)
+
+
+# (image filenames, subdirectories) of a directory
+def scan_dir(path, extensions):
+	filenames = []
+	subdirs = []
+	try:
+		with os.scandir(path) as entries:
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False):
+					subdirs.append(entry.path)
+				elif os.path.splitext(entry.name)[1].lower() in extensions and entry.is_file():
+					filenames.append(entry.path)
+	except OSError as e:
+		print("Failed to scan %s: %s" % (path, e))
+	return (filenames, subdirs)
+
+# the image files in the trees under root_dirs, sorted. Subdirectories are scanned as
+# soon as they are found, num_threads at a time
+def scan_images(root_dirs, num_threads=SCAN_THREADS, extensions=IMAGE_EXTENSIONS):
+	filenames = []
+	with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+		pending = set(pool.submit(scan_dir, root_dir, extensions) for root_dir in root_dirs)
+		while len(pending) > 0:
+			(done, pending) = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+			for future in done:
+				(dir_filenames, subdirs) = future.result()
+				filenames.extend(dir_filenames)
+				pending.update(pool.submit(scan_dir, subdir, extensions) for subdir in subdirs)
+	return sorted(filenames)
+
+
+# (sha1, width, height) of an image, reading the file once. Only the image's header is
+# decoded. The size is the displayed size (after applying the image's EXIF orientation)
+def probe_image(filename):
+	with open(filename, "rb") as f:
+		data = f.read()
+	with Image.open(io.BytesIO(data)) as img:
+		(width, height) = img.size
+		if img.getexif().get(EXIF_ORIENTATION_TAG) in TRANSPOSED_ORIENTATIONS:
+			(width, height) = (height, width)
+	return (hashlib.sha1(data).hexdigest(), width, height)
+
+def probe_images_worker(filenames):
+	results = []
+	for filename in filenames:
+		try:
+			results.append(probe_image(filename))
+		except (OSError, ValueError, Image.DecompressionBombError) as e:
+			print("Failed to read %s: %s" % (filename, e))
+			results.append(None)
+	return results
+
+# (sha1, width, height) of each image file (None for unreadable ones), probed across a
+# pool of processes
+def probe_images(filenames, num_processes=None, batch_size=PROBE_BATCH_SIZE):
+	batches = [filenames[i:i+batch_size] for i in range(0, len(filenames), batch_size)]
+	results = []
+	with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+		for batch_results in executor.map(probe_images_worker, batches):
+			results.extend(batch_results)
+	return results
+
+
+# The images of a collection, as columns (the datapoint urls, sizes and content hashes)
+class ImageCollection:
+
+	def __init__(self, urls, widths, heights, sha1s):
+		self.urls = urls
+		self.widths = numpy.asarray(widths, dtype=numpy.int32)
+		self.heights = numpy.asarray(heights, dtype=numpy.int32)
+		self.sha1s = sha1s
+
+	def get_num_images(self):
+		return len(self.urls)
+
+	def take(self, indices):
+		return ImageCollection([self.urls[i] for i in indices], self.widths[indices], self.heights[indices],
+			[self.sha1s[i] for i in indices])
+
+	# the images in the given order (ORDER_PATH or ORDER_HASH)
+	def ordered(self, order):
+		if order == ORDER_PATH:
+			keys = self.urls
+		elif order == ORDER_HASH:
+			# ties (which only happen without deduplication) are broken by path, so the order is deterministic
+			keys = list(zip(self.sha1s, self.urls))
+		else:
+			raise ValueError("Unknown image order: %s" % order)
+		return self.take(sorted(range(self.get_num_images()), key=keys.__getitem__))
+
+	# the collection without the images whose contents are the same as an earlier image's
+	def deduplicated(self):
+		seen = set()
+		indices = []
+		for (i, sha1) in enumerate(self.sha1s):
+			if sha1 not in seen:
+				seen.add(sha1)
+				indices.append(i)
+		return self.take(indices)
+
+	# a name derived from the contents of the collection, for naming its tasks
+	def get_digest(self):
+		sha1 = hashlib.sha1()
+		for digest in sorted(self.sha1s):
+			sha1.update(digest.encode("ascii"))
+		return sha1.hexdigest()
+
+	def to_json(self):
+		return { "urls" : self.urls, "widths" : self.widths, "heights" : self.heights, "sha1" : self.sha1s }
+
+
+# scans the image trees under root_dirs and probes their images
+def collect_images(root_dirs, num_processes=None, num_threads=SCAN_THREADS, extensions=IMAGE_EXTENSIONS):
+	filenames = scan_images(root_dirs, num_threads, extensions)
+	results = probe_images(filenames, num_processes)
+
+	valid = [i for i in range(len(filenames)) if results[i] is not None]
+	if len(valid) < len(filenames):
+		print("Skipping %d unreadable images" % (len(filenames) - len(valid)))
+	return ImageCollection([filenames[i] for i in valid], [results[i][1] for i in valid],
+		[results[i][2] for i in valid], [results[i][0] for i in valid])
+
+
+# number of images of a task of num_images images that are also put in the previous task
+def get_num_overlap(num_images, overlap):
+	return min(num_images, int(math.ceil(num_images * overlap)))
+
+# Splits images [0, num_images) into num_tasks tasks (or more, if needed so that no task
+# holds more than max_task_size images, overlap included). Each task holds a contiguous
+# range of images, plus (if overlap > 0) the first overlap fraction of the next task's
+# range (the last task's overlap comes from the first task). Returns the list of ranges
+# of each task
+def split_images(num_images, max_task_size, num_tasks=None, overlap=0.0):
+	if not 0.0 <= overlap <= 1.0:
+		raise ValueError("overlap must be between 0 and 1, got %g" % overlap)
+	if num_images == 0:
+		return []
+
+	num_tasks = min(num_images, max(num_tasks or 1, int(math.ceil(num_images / max_task_size))))
+	while num_tasks < num_images:
+		largest = int(math.ceil(num_images / num_tasks))
+		if largest + (get_num_overlap(largest, overlap) if num_tasks > 1 else 0) <= max_task_size:
+			break
+		num_tasks = num_tasks + 1
+
+	bounds = [i * num_images // num_tasks for i in range(num_tasks + 1)]
+	splits = []
+	for i in range(num_tasks):
+		ranges = [(bounds[i], bounds[i + 1])]
+		if num_tasks > 1 and overlap > 0.0:
+			(start, end) = (bounds[(i + 1) % num_tasks], bounds[(i + 1) % num_tasks + 1])
+			num_overlap = get_num_overlap(end - start, overlap)
+			if num_overlap > 0:
+				ranges.append((start, start + num_overlap))
+		splits.append(ranges)
+	return splits
+
+
+# the labeling tasks of a collection (already ordered, see ImageCollection.ordered()), split
+# by split_images(). Returns (tasks, manifest)
+def build_tasks(images, name, description, categories, max_task_size=DEFAULT_MAX_TASK_SIZE, num_tasks=None,
+	overlap=0.0, order=ORDER_HASH):
+
+	splits = split_images(images.get_num_images(), max_task_size, num_tasks, overlap)
+	tasks = []
+	manifest_tasks = []
+	for (i, ranges) in enumerate(splits):
+		task = LabelingTask()
+		task.task_id = "%s_%05d" % (name, i)
+		task.set_description("%s (%d of %d)" % (description, i + 1, len(splits)))
+		urls = []
+		for (start, end) in ranges:
+			urls.extend(images.urls[start:end])
+		task.set_datapoints(urls)
+		if isinstance(categories, dict):
+			task.set_category_mapping(categories)
+		else:
+			task.set_categories(categories)
+		tasks.append(task)
+		manifest_tasks.append({ "task_id" : task.task_id, "ranges" : [list(r) for r in ranges] })
+
+	manifest = { "format_version" : TASK_BUILD_FORMAT_VERSION, "name" : name, "order" : order, "overlap" : overlap,
+		"max_task_size" : max_task_size, "images" : images.to_json(), "tasks" : manifest_tasks }
+	return (tasks, manifest)
+
+def load_manifest(target_dir, name):
+	filename = get_manifest_filename(target_dir, name)
+	if not os.path.exists(filename):
+		return None
+	with open(filename, "rt") as f:
+		return json.load(f)
+
+def save_manifest(manifest, target_dir):
+	filename = get_manifest_filename(target_dir, manifest["name"])
+	tmp_filename = "%s.tmp" % filename
+	with open(tmp_filename, "wb") as f:
+		jsonstream.write_json(f, manifest)
+	os.replace(tmp_filename, filename)
+	return filename
+
+# raises ValueError if tasks named name (tasks with the given ids, or a previous build's
+# manifest in manifest_dir) already exist
+def check_not_built(task_store, manifest_dir, name, task_ids=()):
+	if os.path.exists(get_manifest_filename(manifest_dir, name)):
+		raise ValueError("Tasks %s have already been built (%s), pass replace=True (--replace) to replace them and discard their labels" %
+			(name, get_manifest_filename(manifest_dir, name)))
+	for task_id in task_ids:
+		if task_store.has_task(task_id):
+			raise ValueError("Task %s already exists, pass replace=True (--replace) to replace it and discard its labels" % task_id)
+
+# Builds the labeling tasks of the images under root_dirs (see above) and registers them
+# all with task_store. The manifest is saved to manifest_dir. If name is None, tasks are
+# named after the contents of the collection. Existing tasks of the same name are only
+# replaced (and the ones the new build doesn't have deleted) if replace is True, otherwise
+# ValueError is raised. Returns (tasks, manifest)
+def create_tasks(root_dirs, task_store, manifest_dir, description, categories, name=None,
+	max_task_size=DEFAULT_MAX_TASK_SIZE, num_tasks=None, overlap=0.0, order=ORDER_HASH, deduplicate=True,
+	replace=False, num_processes=None, num_threads=SCAN_THREADS):
+
+	# fail before scanning the images if possible
+	if name is not None and not replace:
+		check_not_built(task_store, manifest_dir, name)
+
+	images = collect_images(root_dirs, num_processes, num_threads)
+	if deduplicate:
+		images = images.deduplicated()
+	images = images.ordered(order)
+	if name is None:
+		name = images.get_digest()[:12]
+
+	(tasks, manifest) = build_tasks(images, name, description, categories, max_task_size, num_tasks, overlap, order)
+	old_manifest = load_manifest(manifest_dir, name)
+	if not replace:
+		check_not_built(task_store, manifest_dir, name, [task.task_id for task in tasks])
+
+	task_store.save_tasks(tasks)
+	if old_manifest is not None:
+		task_ids = set(task.task_id for task in tasks)
+		for old_task in old_manifest["tasks"]:
+			if old_task["task_id"] not in task_ids and task_store.has_task(old_task["task_id"]):
+				task_store.delete_task(old_task["task_id"])
+	save_manifest(manifest, manifest_dir)
+	return (tasks, manifest)
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Creates labeling tasks from directories of images")
+	parser.add_argument("image_dirs", nargs="+", help="directories to scan (recursively) for images")
+	parser.add_argument("--name", default=None, help="prefix of the task ids (default: derived from the images)")
+	parser.add_argument("--description", default="")
+	parser.add_argument("--categories", required=True, help="comma separated category names")
+	parser.add_argument("--max-task-size", type=int, default=DEFAULT_MAX_TASK_SIZE)
+	parser.add_argument("--num-tasks", type=int, default=None, help="minimum number of tasks")
+	parser.add_argument("--overlap", type=float, default=0.0, help="fraction of each task also labeled in another task")
+	parser.add_argument("--order", choices=[ORDER_PATH, ORDER_HASH], default=ORDER_HASH)
+	parser.add_argument("--keep-duplicates", action="store_true", help="don't skip images with identical contents")
+	parser.add_argument("--replace", action="store_true", help="replace previously built tasks of the same name, discarding their labels")
+	parser.add_argument("--output", default="labeling_results", help="directory of the tasks (json store) and manifest")
+	parser.add_argument("--db", default=None, help="sqlite task store to register the tasks with, instead of json files")
+	parser.add_argument("--atlases", action="store_true", help="also pack thumbnail atlases of each task (json store)")
+	parser.add_argument("--processes", type=int, default=None)
+	parser.add_argument("--threads", type=int, default=SCAN_THREADS)
+	args = parser.parse_args()
+
+	os.makedirs(args.output, exist_ok=True)
+	task_store = SQLiteTaskStore(args.db) if args.db is not None else JSONTaskStore(args.output, 0)
+
+	try:
+		(tasks, manifest) = create_tasks(args.image_dirs, task_store, args.output, args.description, args.categories.split(","),
+			name=args.name, max_task_size=args.max_task_size, num_tasks=args.num_tasks, overlap=args.overlap, order=args.order,
+			deduplicate=not args.keep_duplicates, replace=args.replace, num_processes=args.processes, num_threads=args.threads)
+	except ValueError as e:
+		parser.error(str(e))
+
+	if args.atlases and args.db is None:
+		for task in tasks:
+			task.save_atlases(args.output, args.processes)
+
+	print("Created %d labeling tasks of %d images: %s_00000 ... %s" % (len(tasks), len(manifest["images"]["urls"]),
+		manifest["name"], tasks[-1].task_id if len(tasks) > 0 else "-"))
+	print("Manifest: %s" % get_manifest_filename(args.output, manifest["name"]))
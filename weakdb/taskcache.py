@@ -0,0 +1,164 @@
+import collections
+import contextlib
+import os
+import threading
+
+import compression
+import jsonstream
+import metrics
+from labelingtask import LabelingTask, get_journal_filename
+
+
+# An in-memory LRU cache of labeling tasks, used by the labeling server so that
+# it doesn't have to re-parse a task's json file (and re-serialize the task) on
+# every request.
+#
+# Entries are keyed by task filename and are invalidated whenever the mtime or
+# size of the file or its journal changes (e.g., the task was updated by another
+# process).
+# When the estimated memory used by the cache exceeds max_bytes, the least
+# recently used tasks are evicted.
+#
+# Cached tasks are shared by all callers, so they are never modified: updates are
+# made to a copy of the task (see LabelingTask.copy_for_update()), which replaces
+# the cached task with put() once it has been saved. Readers can therefore use a
+# cached task (and serialize it) without holding its lock.
+class TaskCache:
+
+	LOOKUPS = metrics.counter("weakdb_task_cache_lookups_total", "Labeling task cache lookups", ["result"])
+
+	# rough ratio of the in-memory size of a parsed task to the size of its json file
+	PARSED_SIZE_FACTOR = 4
+
+	def __init__(self, max_bytes):
+		self.max_bytes = max_bytes
+		self.cur_bytes = 0
+		self.entries = collections.OrderedDict()
+		self.lock = threading.Lock()
+		# per task [lock, number of threads holding or waiting for it]. Locks that aren't
+		# in use are dropped along with their task's entry
+		self.task_locks = {}
+
+		self.num_hits = 0
+		self.num_misses = 0
+
+	# holds the lock used to serialize updates of a task for the body of a with block (hold
+	# it while updating and saving a copy of a task returned by get_task(), and put()ing it)
+	@contextlib.contextmanager
+	def task_lock(self, filename):
+		with self.lock:
+			task_lock = self.task_locks.setdefault(filename, [threading.Lock(), 0])
+			task_lock[1] = task_lock[1] + 1
+		try:
+			with task_lock[0]:
+				yield
+		finally:
+			with self.lock:
+				task_lock[1] = task_lock[1] - 1
+				if task_lock[1] == 0 and filename not in self.entries:
+					del self.task_locks[filename]
+
+	def file_version(self, filename):
+		st = os.stat(filename)
+		version = (st.st_mtime_ns, st.st_size)
+		journal_filename = get_journal_filename(filename)
+		if os.path.exists(journal_filename):
+			st = os.stat(journal_filename)
+			version = version + (st.st_mtime_ns, st.st_size)
+		return version
+
+	def entry_size(self, entry):
+		size = sum(entry["version"][1::2]) * TaskCache.PARSED_SIZE_FACTOR
+		if entry["response"] is not None:
+			size = size + len(entry["response"])
+		for (body, etag) in entry["encoded"].values():
+			size = size + len(body)
+		return size
+
+	# returns the cache entry for filename, (re)loading the task if needed
+	def get_entry(self, filename):
+		version = self.file_version(filename)
+
+		with self.lock:
+			entry = self.entries.get(filename)
+			if entry is not None and entry["version"] == version:
+				self.entries.move_to_end(filename)
+				self.num_hits = self.num_hits + 1
+				TaskCache.LOOKUPS.inc(result="hit")
+				return entry
+			self.num_misses = self.num_misses + 1
+			TaskCache.LOOKUPS.inc(result="miss")
+
+		# parse the task outside of the lock so other requests aren't blocked
+		task = LabelingTask()
+		with metrics.TASK_SECONDS.time(operation="load"):
+			task.load(filename)
+		return self.put(filename, task, version)
+
+	def get_task(self, filename):
+		return self.get_entry(filename)["task"]
+
+	# returns the task, serialized to json (as bytes)
+	def get_response(self, filename):
+		return self.get_encoded_response(filename, None)[0]
+
+	# returns (body, etag) of the task serialized to json and compressed with encoding
+	# (None for no compression). Compressed responses are cached along with the task.
+	def get_encoded_response(self, filename, encoding):
+		entry = self.get_entry(filename)
+		if encoding in entry["encoded"]:
+			return entry["encoded"][encoding]
+
+		if entry["response"] is None:
+			with metrics.TASK_SECONDS.time(operation="serialize"):
+				response = jsonstream.dumps(entry["task"].to_dict())
+			self.update_entry(filename, entry, "response", response)
+		body = entry["response"]
+		if encoding is not None:
+			with metrics.TASK_SECONDS.time(operation="compress"):
+				body = compression.compress(body, encoding)
+		encoded = (body, compression.compute_etag(entry["response"], encoding))
+		all_encoded = dict(entry["encoded"])
+		all_encoded[encoding] = encoded
+		self.update_entry(filename, entry, "encoded", all_encoded)
+		return encoded
+
+	# sets entry[key] = value, keeping track of the cache size if the entry is still in the cache
+	def update_entry(self, filename, entry, key, value):
+		with self.lock:
+			in_cache = (self.entries.get(filename) is entry)
+			if in_cache:
+				self.cur_bytes = self.cur_bytes - self.entry_size(entry)
+			entry[key] = value
+			if in_cache:
+				self.cur_bytes = self.cur_bytes + self.entry_size(entry)
+
+	# (re)places the task stored in filename in the cache. Call after saving a task.
+	def put(self, filename, task, version=None):
+		if version is None:
+			version = self.file_version(filename)
+		entry = { "version" : version, "task" : task, "response" : None, "encoded" : {} }
+
+		with self.lock:
+			self.remove_locked(filename)
+			self.entries[filename] = entry
+			self.cur_bytes = self.cur_bytes + self.entry_size(entry)
+
+			# evict least recently used tasks (but always keep the newest one)
+			while self.cur_bytes > self.max_bytes and len(self.entries) > 1:
+				oldest = next(iter(self.entries))
+				self.remove_locked(oldest)
+
+		return entry
+
+	def invalidate(self, filename):
+		with self.lock:
+			self.remove_locked(filename)
+
+	def remove_locked(self, filename):
+		entry = self.entries.pop(filename, None)
+		if entry is not None:
+			self.cur_bytes = self.cur_bytes - self.entry_size(entry)
+		task_lock = self.task_locks.get(filename)
+		if task_lock is not None and task_lock[1] == 0:
+			del self.task_locks[filename]
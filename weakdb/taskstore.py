@@ -0,0 +1,486 @@
+import contextlib
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+import compression
+import jsonstream
+import metrics
+from labelingtask import LabelingTask, get_journal_filename
+from taskcache import TaskCache
+
+
+# Storage backends for labeling tasks, used by the labeling server.
+#
+# Both backends provide the same interface:
+#   -- has_task(task_id)
+#   -- get_task(task_id): the task as a LabelingTask
+#   -- get_task_response(task_id, encoding): (body, etag) of the task serialized to json and
+#      compressed with the given content encoding (None for uncompressed, see compression.py)
+#   -- get_task_stream(task_id, encoding): like get_task_response(), but the body is an iterable
+#      of chunks of bytes, serialized and compressed as it is consumed, for sending large tasks
+#      without holding their json in memory (etag is None if the store can't tag the task
+#      without serializing it)
+#   -- save_task(task): add (or replace) a task
+#   -- save_tasks(tasks): add (or replace) several tasks at once (see taskbuilder.py)
+#   -- delete_task(task_id)
+#   -- get_num_datapoints(task_id)
+#   -- get_update_seq(task_id, labeler_name)
+#   -- set_labels(task_id, labeler_name, indices, labels, labeling_times, seq): sparse update
+#      of a labeler's results (see LabelingTask.set_labels()). Returns False (and changes
+#      nothing) if seq is not newer than the labeler's last update.
+#   -- replace_labeler_results(task_id, labeler_name, labels, labeling_times): replaces all
+#      of a labeler's results, only writing the datapoints that changed
+#   -- get_progress(task_id): per-labeler counts of labeled datapoints
+#   -- get_unlabeled_mask(task_id, labeler_name, indices): for each of the given datapoints,
+#      true if the labeler hasn't labeled it
+#   -- get_window(task_id, labeler_name, indices): the given datapoints, with only the
+#      labeler's results for them (see LabelingTask.get_window() and taskwindows.py)
+#   -- get_datapoint_urls(task_id, indices)
+
+
+# the json serialization of task_info as chunks of bytes, compressed with encoding (if not None)
+def get_encoded_stream(task_info, encoding):
+	chunks = jsonstream.iter_json_bytes(task_info)
+	if encoding is not None:
+		chunks = compression.compress_chunks(chunks, encoding)
+	return chunks
+
+
+# Tasks are stored as one json file per task in a directory (with label updates
+# journaled next to it, see labelingtask.py). Parsed tasks are kept in a TaskCache.
+class JSONTaskStore:
+
+	def __init__(self, results_dir, cache_max_bytes):
+		self.results_dir = results_dir
+		self.cache = TaskCache(cache_max_bytes)
+
+	def get_task_filename(self, task_id):
+		return os.path.join(self.results_dir, "%s.json" % task_id)
+
+	def has_task(self, task_id):
+		return os.path.exists(self.get_task_filename(task_id))
+
+	def get_task(self, task_id):
+		return self.cache.get_task(self.get_task_filename(task_id))
+
+	def get_task_response(self, task_id, encoding=None):
+		return self.cache.get_encoded_response(self.get_task_filename(task_id), encoding)
+
+	# the task is snapshotted under its lock and tagged with the version of its files, so the
+	# stream is consistent and has an ETag even though it is serialized as it is sent
+	def get_task_stream(self, task_id, encoding=None):
+		filename = self.get_task_filename(task_id)
+		with self.lock_task(filename):
+			entry = self.cache.get_entry(filename)
+			task_info = entry["task"].snapshot_dict()
+			etag = compression.compute_etag(("%s:%r" % (filename, entry["version"])).encode("utf-8"), encoding)
+		return (get_encoded_stream(task_info, encoding), etag)
+
+	def save_task(self, task):
+		filename = self.get_task_filename(task.task_id)
+		with self.lock_task(filename):
+			task.save(filename)
+			self.cache.invalidate(filename)
+
+	def save_tasks(self, tasks):
+		for task in tasks:
+			self.save_task(task)
+
+	def delete_task(self, task_id):
+		filename = self.get_task_filename(task_id)
+		with self.lock_task(filename):
+			for task_filename in [filename, get_journal_filename(filename)]:
+				if os.path.exists(task_filename):
+					os.remove(task_filename)
+			self.cache.invalidate(filename)
+
+	def get_num_datapoints(self, task_id):
+		return self.get_task(task_id).get_num_datapoints()
+
+	def get_update_seq(self, task_id, labeler_name):
+		return self.get_task(task_id).get_update_seq(labeler_name)
+
+	def set_labels(self, task_id, labeler_name, indices, labels, labeling_times=None, seq=None):
+		filename = self.get_task_filename(task_id)
+		with self.lock_task(filename):
+			task = self.cache.get_task(filename)
+			if seq is not None and seq <= task.get_update_seq(labeler_name):
+				return False
+			self.write_labels_locked(filename, task, labeler_name, indices, labels, labeling_times, seq)
+		return True
+
+	def replace_labeler_results(self, task_id, labeler_name, labels, labeling_times):
+		filename = self.get_task_filename(task_id)
+		with self.lock_task(filename):
+			task = self.cache.get_task(filename)
+			indices = task.get_changed_indices(labeler_name, labels, labeling_times)
+			changed_labels = [labels[i] for i in indices]
+			changed_labeling_times = [labeling_times[i] for i in indices]
+			self.write_labels_locked(filename, task, labeler_name, indices, changed_labels, changed_labeling_times, None)
+
+	# holds the task's lock (see TaskCache.task_lock()) for the body of a with block, timing
+	# how long it takes to acquire, since concurrent label updates of a task wait on each other
+	@contextlib.contextmanager
+	def lock_task(self, filename):
+		start = time.perf_counter()
+		with self.cache.task_lock(filename):
+			metrics.TASK_SECONDS.observe(time.perf_counter() - start, operation="lock_wait")
+			yield
+
+	# the cached task is shared with readers, so the update is made to a copy, which only
+	# replaces the cached task once it is saved. If saving fails, the cached task is dropped
+	# (the journal may or may not hold the update) so the next request reloads it from disk
+	def write_labels_locked(self, filename, task, labeler_name, indices, labels, labeling_times, seq):
+		if len(indices) == 0 and seq is None:
+			return
+		with metrics.TASK_SECONDS.time(operation="write_labels"):
+			task = task.copy_for_update(labeler_name)
+			task.set_labels(labeler_name, indices, labels, labeling_times, seq)
+			try:
+				task.append_to_journal(filename, labeler_name, indices, labels, labeling_times, seq)
+				if task.journal_needs_compaction(filename):
+					task.save(filename)
+			except BaseException:
+				self.cache.invalidate(filename)
+				raise
+			self.cache.put(filename, task)
+
+	def get_progress(self, task_id):
+		task = self.get_task(task_id)
+		progress = {}
+		for labeler_name in task.labeler_results:
+			progress[labeler_name] = task.get_num_labeled(labeler_name)
+		return progress
+
+	def get_unlabeled_mask(self, task_id, labeler_name, indices):
+		return self.get_task(task_id).get_unlabeled_mask(labeler_name, indices)
+
+	def get_window(self, task_id, labeler_name, indices):
+		return self.get_task(task_id).get_window(labeler_name, indices)
+
+	def get_datapoint_urls(self, task_id, indices):
+		datapoint_urls = self.get_task(task_id).datapoint_urls
+		return [datapoint_urls[idx] for idx in indices]
+
+
+# Tasks are stored in an SQLite database (in WAL mode, so readers don't block the
+# writer, and several server processes can share the database). Labels are stored
+# one row per (task, labeler, datapoint), so updates only touch the changed datapoints
+# and per-labeler queries are index lookups rather than parses of the whole task.
+#
+# Only datapoints a labeler has a result for have rows in the labels table. All
+# other datapoints are unlabeled.
+class SQLiteTaskStore:
+
+	SCHEMA = [
+		"""CREATE TABLE IF NOT EXISTS tasks (
+			task_id TEXT PRIMARY KEY,
+			description TEXT NOT NULL,
+			categories TEXT NOT NULL,
+			num_datapoints INTEGER NOT NULL)""",
+		"""CREATE TABLE IF NOT EXISTS datapoints (
+			task_id TEXT NOT NULL,
+			idx INTEGER NOT NULL,
+			url TEXT NOT NULL,
+			box TEXT,
+			PRIMARY KEY (task_id, idx)) WITHOUT ROWID""",
+		"""CREATE TABLE IF NOT EXISTS labelers (
+			task_id TEXT NOT NULL,
+			labeler_name TEXT NOT NULL,
+			update_seq INTEGER NOT NULL DEFAULT -1,
+			PRIMARY KEY (task_id, labeler_name)) WITHOUT ROWID""",
+		"""CREATE TABLE IF NOT EXISTS labels (
+			task_id TEXT NOT NULL,
+			labeler_name TEXT NOT NULL,
+			idx INTEGER NOT NULL,
+			label INTEGER NOT NULL,
+			labeling_time REAL NOT NULL DEFAULT 0.0,
+			PRIMARY KEY (task_id, labeler_name, idx)) WITHOUT ROWID""",
+		"""CREATE INDEX IF NOT EXISTS labels_by_label ON labels (task_id, labeler_name, label)""",
+	]
+
+	# maximum number of datapoint indices passed to a single statement
+	MAX_QUERY_INDICES = 500
+
+	def __init__(self, db_filename):
+		self.db_filename = db_filename
+		self.local = threading.local()
+
+		conn = self.get_connection()
+		conn.execute("PRAGMA journal_mode=WAL")
+		for statement in SQLiteTaskStore.SCHEMA:
+			conn.execute(statement)
+
+	# sqlite connections can't be shared across threads, so each thread gets its own
+	def get_connection(self):
+		conn = getattr(self.local, "conn", None)
+		if conn is None:
+			conn = sqlite3.connect(self.db_filename, timeout=30.0, isolation_level=None)
+			conn.execute("PRAGMA synchronous=NORMAL")
+			self.local.conn = conn
+		return conn
+
+	# runs func(conn) in a write transaction. BEGIN IMMEDIATE takes the database's write
+	# lock up front, so concurrent writers (threads or processes) are serialized
+	def write_transaction(self, func):
+		conn = self.get_connection()
+		conn.execute("BEGIN IMMEDIATE")
+		try:
+			result = func(conn)
+		except BaseException:
+			conn.execute("ROLLBACK")
+			raise
+		conn.execute("COMMIT")
+		return result
+
+	def has_task(self, task_id):
+		row = self.get_connection().execute("SELECT 1 FROM tasks WHERE task_id=?", (task_id,)).fetchone()
+		return row is not None
+
+	def get_num_datapoints(self, task_id):
+		row = self.get_connection().execute("SELECT num_datapoints FROM tasks WHERE task_id=?", (task_id,)).fetchone()
+		return row[0]
+
+	def get_task(self, task_id):
+		with metrics.TASK_SECONDS.time(operation="load"):
+			return self.load_task(task_id)
+
+	def load_task(self, task_id):
+		conn = self.get_connection()
+		conn.execute("BEGIN")
+		try:
+			(description, categories, num_datapoints) = conn.execute(
+				"SELECT description, categories, num_datapoints FROM tasks WHERE task_id=?", (task_id,)).fetchone()
+
+			task = LabelingTask()
+			task.task_id = task_id
+			task.set_description(description)
+			task.set_category_mapping(json.loads(categories))
+
+			urls = []
+			boxes = []
+			for (url, box) in conn.execute("SELECT url, box FROM datapoints WHERE task_id=? ORDER BY idx", (task_id,)):
+				urls.append(url)
+				boxes.append(None if box is None else json.loads(box))
+			task.set_datapoints(urls)
+			if any(box is not None for box in boxes):
+				task.set_datapoint_boxes(boxes)
+
+			for (labeler_name, update_seq) in conn.execute("SELECT labeler_name, update_seq FROM labelers WHERE task_id=?", (task_id,)):
+				(indices, labels, labeling_times) = self.get_labeler_rows(conn, task_id, labeler_name)
+				task.set_labels(labeler_name, indices, labels, labeling_times, update_seq if update_seq >= 0 else None)
+		finally:
+			conn.execute("COMMIT")
+
+		return task
+
+	def get_task_response(self, task_id, encoding=None):
+		task = self.get_task(task_id)
+		with metrics.TASK_SECONDS.time(operation="serialize"):
+			response = jsonstream.dumps(task.to_dict())
+		body = response
+		if encoding is not None:
+			with metrics.TASK_SECONDS.time(operation="compress"):
+				body = compression.compress(response, encoding)
+		return (body, compression.compute_etag(response, encoding))
+
+	# tasks are loaded from their rows, so are already snapshots
+	def get_task_stream(self, task_id, encoding=None):
+		return (get_encoded_stream(self.get_task(task_id).to_dict(), encoding), None)
+
+	def save_task(self, task):
+		with metrics.TASK_SECONDS.time(operation="save"):
+			self.write_transaction(lambda conn: self.save_task_rows(conn, task))
+
+	# all the tasks are written in a single transaction (one commit rather than one per task)
+	def save_tasks(self, tasks):
+		def save(conn):
+			for task in tasks:
+				self.save_task_rows(conn, task)
+
+		with metrics.TASK_SECONDS.time(operation="save"):
+			self.write_transaction(save)
+
+	def save_task_rows(self, conn, task):
+		self.delete_task_rows(conn, task.task_id)
+		conn.execute("INSERT INTO tasks VALUES (?, ?, ?, ?)",
+			(task.task_id, task.description, json.dumps(task.categories), task.get_num_datapoints()))
+
+		has_boxes = (len(task.datapoint_boxes) == task.get_num_datapoints())
+		conn.executemany("INSERT INTO datapoints VALUES (?, ?, ?, ?)",
+			((task.task_id, idx, url, json.dumps(task.datapoint_boxes[idx]) if has_boxes else None)
+				for (idx, url) in enumerate(task.datapoint_urls)))
+
+		for (labeler_name, results) in task.labeler_results.items():
+			labels = results.get("labels", [])
+			labeling_times = results.get("labeling_times", [0.0] * len(labels))
+			conn.execute("INSERT INTO labelers VALUES (?, ?, ?)", (task.task_id, labeler_name, results.get("update_seq", -1)))
+			conn.executemany("INSERT INTO labels VALUES (?, ?, ?, ?, ?)",
+				((task.task_id, labeler_name, idx, labels[idx], labeling_times[idx])
+					for idx in range(len(labels))
+					if labels[idx] != LabelingTask.UNLABELED or labeling_times[idx] != 0.0))
+
+	def delete_task(self, task_id):
+		self.write_transaction(lambda conn: self.delete_task_rows(conn, task_id))
+
+	def delete_task_rows(self, conn, task_id):
+		for table in ["tasks", "datapoints", "labelers", "labels"]:
+			conn.execute("DELETE FROM %s WHERE task_id=?" % table, (task_id,))
+
+	def get_update_seq(self, task_id, labeler_name):
+		row = self.get_connection().execute(
+			"SELECT update_seq FROM labelers WHERE task_id=? AND labeler_name=?", (task_id, labeler_name)).fetchone()
+		return -1 if row is None else row[0]
+
+	def set_labels(self, task_id, labeler_name, indices, labels, labeling_times=None, seq=None):
+		def update(conn):
+			row = conn.execute("SELECT update_seq FROM labelers WHERE task_id=? AND labeler_name=?", (task_id, labeler_name)).fetchone()
+			if seq is not None and row is not None and seq <= row[0]:
+				return False
+
+			if row is None:
+				conn.execute("INSERT INTO labelers VALUES (?, ?, -1)", (task_id, labeler_name))
+			if seq is not None:
+				conn.execute("UPDATE labelers SET update_seq=? WHERE task_id=? AND labeler_name=?", (seq, task_id, labeler_name))
+
+			if labeling_times is None:
+				conn.executemany(
+					"INSERT INTO labels (task_id, labeler_name, idx, label) VALUES (?, ?, ?, ?) "
+					"ON CONFLICT (task_id, labeler_name, idx) DO UPDATE SET label=excluded.label",
+					((task_id, labeler_name, idx, label) for (idx, label) in zip(indices, labels)))
+			else:
+				conn.executemany(
+					"INSERT INTO labels VALUES (?, ?, ?, ?, ?) "
+					"ON CONFLICT (task_id, labeler_name, idx) DO UPDATE SET label=excluded.label, labeling_time=excluded.labeling_time",
+					((task_id, labeler_name, idx, label, time) for (idx, label, time) in zip(indices, labels, labeling_times)))
+			return True
+
+		with metrics.TASK_SECONDS.time(operation="write_labels"):
+			return self.write_transaction(update)
+
+	def replace_labeler_results(self, task_id, labeler_name, labels, labeling_times):
+		def replace(conn):
+			(indices, cur_labels, cur_labeling_times) = self.get_labeler_rows(conn, task_id, labeler_name)
+			cur = dict(zip(indices, zip(cur_labels, cur_labeling_times)))
+			default = (LabelingTask.UNLABELED, 0.0)
+			changed = [idx for idx in range(len(labels)) if cur.get(idx, default) != (labels[idx], labeling_times[idx])]
+
+			if conn.execute("SELECT 1 FROM labelers WHERE task_id=? AND labeler_name=?", (task_id, labeler_name)).fetchone() is None:
+				conn.execute("INSERT INTO labelers VALUES (?, ?, -1)", (task_id, labeler_name))
+			conn.executemany(
+				"INSERT INTO labels VALUES (?, ?, ?, ?, ?) "
+				"ON CONFLICT (task_id, labeler_name, idx) DO UPDATE SET label=excluded.label, labeling_time=excluded.labeling_time",
+				((task_id, labeler_name, idx, labels[idx], labeling_times[idx]) for idx in changed))
+
+		with metrics.TASK_SECONDS.time(operation="write_labels"):
+			self.write_transaction(replace)
+
+	# (indices, labels, labeling_times) of the datapoints the labeler has results for
+	def get_labeler_rows(self, conn, task_id, labeler_name):
+		rows = conn.execute("SELECT idx, label, labeling_time FROM labels WHERE task_id=? AND labeler_name=? ORDER BY idx",
+			(task_id, labeler_name)).fetchall()
+		return ([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows])
+
+	# the labeler's results as complete (num_datapoints long) lists of labels and labeling times
+	def get_labeler_results(self, task_id, labeler_name):
+		num_datapoints = self.get_num_datapoints(task_id)
+		labels = [LabelingTask.UNLABELED] * num_datapoints
+		labeling_times = [0.0] * num_datapoints
+		for (idx, label, labeling_time) in self.get_connection().execute(
+				"SELECT idx, label, labeling_time FROM labels WHERE task_id=? AND labeler_name=?", (task_id, labeler_name)):
+			labels[idx] = label
+			labeling_times[idx] = labeling_time
+		return (labels, labeling_times)
+
+	def get_num_unlabeled(self, task_id, labeler_name):
+		return self.get_num_datapoints(task_id) - self.get_num_labeled(task_id, labeler_name)
+
+	def get_num_labeled(self, task_id, labeler_name):
+		row = self.get_connection().execute(
+			"SELECT COUNT(*) FROM labels WHERE task_id=? AND labeler_name=? AND label!=?",
+			(task_id, labeler_name, LabelingTask.UNLABELED)).fetchone()
+		return row[0]
+
+	def get_progress(self, task_id):
+		progress = {}
+		for (labeler_name,) in self.get_connection().execute("SELECT labeler_name FROM labelers WHERE task_id=?", (task_id,)).fetchall():
+			progress[labeler_name] = self.get_num_labeled(task_id, labeler_name)
+		return progress
+
+	# runs query (with a %s where the list of indices goes) on the given datapoint indices,
+	# a chunk at a time (sqlite limits the number of parameters of a statement), and returns
+	# all the rows
+	def query_indices(self, conn, query, params, indices):
+		rows = []
+		for start in range(0, len(indices), SQLiteTaskStore.MAX_QUERY_INDICES):
+			chunk = tuple(indices[start:start+SQLiteTaskStore.MAX_QUERY_INDICES])
+			rows.extend(conn.execute(query % ",".join(["?"] * len(chunk)), params + chunk).fetchall())
+		return rows
+
+	def get_unlabeled_mask(self, task_id, labeler_name, indices):
+		labeled = set(idx for (idx,) in self.query_indices(self.get_connection(),
+			"SELECT idx FROM labels WHERE task_id=? AND labeler_name=? AND label!=? AND idx IN (%s)",
+			(task_id, labeler_name, LabelingTask.UNLABELED), indices))
+		return [idx not in labeled for idx in indices]
+
+	def get_window(self, task_id, labeler_name, indices):
+		conn = self.get_connection()
+		conn.execute("BEGIN")
+		try:
+			(description, categories, num_datapoints) = conn.execute(
+				"SELECT description, categories, num_datapoints FROM tasks WHERE task_id=?", (task_id,)).fetchone()
+			datapoints = dict((idx, (url, box)) for (idx, url, box) in self.query_indices(conn,
+				"SELECT idx, url, box FROM datapoints WHERE task_id=? AND idx IN (%s)", (task_id,), indices))
+			results = dict((idx, (label, labeling_time)) for (idx, label, labeling_time) in self.query_indices(conn,
+				"SELECT idx, label, labeling_time FROM labels WHERE task_id=? AND labeler_name=? AND idx IN (%s)",
+				(task_id, labeler_name), indices))
+			update_seq = self.get_update_seq(task_id, labeler_name)
+		finally:
+			conn.execute("COMMIT")
+
+		unlabeled = (LabelingTask.UNLABELED, 0.0)
+		window = {
+			"task_id" : task_id,
+			"description" : description,
+			"categories" : json.loads(categories),
+			"num_datapoints" : num_datapoints,
+			"indices" : list(indices),
+			"datapoint_urls" : [datapoints[idx][0] for idx in indices],
+			"labels" : [results.get(idx, unlabeled)[0] for idx in indices],
+			"labeling_times" : [results.get(idx, unlabeled)[1] for idx in indices],
+			"update_seq" : update_seq
+		}
+		boxes = [datapoints[idx][1] for idx in indices]
+		if any(box is not None for box in boxes):
+			window["datapoint_boxes"] = [None if box is None else json.loads(box) for box in boxes]
+		return window
+
+	def get_datapoint_urls(self, task_id, indices):
+		urls = dict(self.query_indices(self.get_connection(),
+			"SELECT idx, url FROM datapoints WHERE task_id=? AND idx IN (%s)", (task_id,), indices))
+		return [urls[idx] for idx in indices]
+
+	# json import/export (the json files are in the format of LabelingTask.save())
+
+	def import_json(self, filename):
+		task = LabelingTask()
+		task.load(filename)
+		self.save_task(task)
+		return task.task_id
+
+	def export_json(self, task_id, filename):
+		self.get_task(task_id).save(filename)
+
+
+# usage: python taskstore.py <labeling results dir> <sqlite db filename>
+# imports all the json labeling tasks in a directory into an sqlite task store
+if __name__ == "__main__":
+	results_dir = sys.argv[1]
+	store = SQLiteTaskStore(sys.argv[2])
+	for filename in sorted(glob.glob(os.path.join(results_dir, "*.json"))):
+		print("Importing task: %s" % store.import_json(filename))
@@ -0,0 +1,86 @@
+import numpy
+
+
+# Windows of labeling tasks: a labeler works through a large task a window of datapoints
+# at a time, rather than downloading the whole task (every datapoint, and every labeler's
+# results) up front. A window holds a few datapoints of the task, selected for one labeler
+# in one of these ways:
+#
+#   -- WINDOW_SELECT_RANGE: datapoints [start, start + count)
+#   -- WINDOW_SELECT_UNLABELED: the next count datapoints, from datapoint start on, that the
+#      labeler hasn't labeled
+#   -- WINDOW_SELECT_UNCERTAINTY: the next count datapoints the labeler hasn't labeled, in
+#      order of the uncertainty of the label model's output for them (prob labels closest
+#      to 0.5 first), from position start of that order on. The prob labels come from a
+#      WeakDB dump whose datapoints are the task's datapoints.
+#
+# along with only that labeler's results for those datapoints. Each window also carries a
+# hint of the following window (its start, and the urls of its datapoints), so clients can
+# prefetch its images while the labeler works on the current one.
+#
+# Task stores provide the per-datapoint accessors windows are built from (see taskstore.py):
+#   -- get_unlabeled_mask(task_id, labeler_name, indices)
+#   -- get_window(task_id, labeler_name, indices)
+#   -- get_datapoint_urls(task_id, indices)
+
+WINDOW_SELECT_RANGE = "range"
+WINDOW_SELECT_UNLABELED = "unlabeled"
+WINDOW_SELECT_UNCERTAINTY = "uncertainty"
+
+WINDOW_SELECTIONS = [WINDOW_SELECT_UNLABELED, WINDOW_SELECT_UNCERTAINTY, WINDOW_SELECT_RANGE]
+
+DEFAULT_WINDOW_SIZE = 100
+MAX_WINDOW_SIZE = 5000
+
+# number of datapoints checked for labels at once when looking for unlabeled ones
+WINDOW_SCAN_CHUNK = 4096
+
+
+# the datapoints in order of decreasing uncertainty of their prob labels (stable, so ties
+# are in datapoint order)
+def get_uncertainty_order(prob_labels):
+	return numpy.argsort(numpy.abs(numpy.asarray(prob_labels, dtype=numpy.float32) - 0.5), kind="stable")
+
+# Selects the datapoints of a window. order is the uncertainty order (for WINDOW_SELECT_UNCERTAINTY).
+# Returns (datapoint indices, start of the following window, or None if there are no more)
+def select_window(task_store, task_id, labeler_name, select, start, count, order=None):
+	num_datapoints = task_store.get_num_datapoints(task_id)
+	if select == WINDOW_SELECT_RANGE:
+		end = min(start + count, num_datapoints)
+		return (list(range(start, end)), end if end < num_datapoints else None)
+
+	pos = start
+	indices = []
+	while pos < num_datapoints and len(indices) < count:
+		if select == WINDOW_SELECT_UNCERTAINTY:
+			candidates = order[pos:pos+WINDOW_SCAN_CHUNK].tolist()
+		else:
+			candidates = list(range(pos, min(pos + WINDOW_SCAN_CHUNK, num_datapoints)))
+		mask = task_store.get_unlabeled_mask(task_id, labeler_name, candidates)
+		for (i, unlabeled) in enumerate(mask):
+			if unlabeled:
+				indices.append(candidates[i])
+				if len(indices) == count:
+					pos = pos + i + 1
+					return (indices, pos if pos < num_datapoints else None)
+		pos = pos + len(candidates)
+	return (indices, None)
+
+# the window of a task selected for a labeler (see select_window()): the datapoints'
+# indices, urls (and boxes) and the labeler's labels and labeling times for them, along
+# with the task's description and categories. "next" is the hint of the following window
+# ({ select, start, count, indices, datapoint_urls }), or None if there are no more datapoints
+def get_window(task_store, task_id, labeler_name, select, start, count, order=None):
+	(indices, next_start) = select_window(task_store, task_id, labeler_name, select, start, count, order)
+	window = task_store.get_window(task_id, labeler_name, indices)
+	window["labeler_name"] = labeler_name
+	window["select"] = select
+	window["start"] = start
+
+	window["next"] = None
+	if next_start is not None:
+		(next_indices, _) = select_window(task_store, task_id, labeler_name, select, next_start, count, order)
+		if len(next_indices) > 0:
+			window["next"] = { "select" : select, "start" : next_start, "count" : count, "indices" : next_indices,
+				"datapoint_urls" : task_store.get_datapoint_urls(task_id, next_indices) }
+	return window
@@ -0,0 +1,168 @@
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import threading
+
+from PIL import Image, ImageOps
+
+
+# Thumbnails of datapoint images, used by the server's /thumbnail endpoint so that
+# grid views don't have to download (and decode) full resolution images.
+#
+# Thumbnails are rendered at a few fixed sizes (the size is the max of the width
+# and height) and stored in a content-addressed disk cache: the thumbnail of an
+# image lives at <cache_dir>/<xx>/<sha1 of image>_<size>.jpg, so identical images
+# share thumbnails, and editing an image naturally gives it new ones.
+#
+# The cache can be pre-warmed when a task or dump is created by running this file:
+#
+#    python weakdb/thumbnails.py --task labeling_results/<TASK_ID>.json
+#    python weakdb/thumbnails.py --dump lfviz_assets/<DUMPNAME>.json
+
+THUMBNAIL_SIZES = [64, 128, 256]
+THUMBNAIL_QUALITY = 85
+THUMBNAIL_CACHE_DIR = "thumbnail_cache"
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+# returns the smallest thumbnail size that is at least size (or the largest size)
+def get_thumbnail_size(size):
+	for thumbnail_size in THUMBNAIL_SIZES:
+		if thumbnail_size >= size:
+			return thumbnail_size
+	return THUMBNAIL_SIZES[-1]
+
+def is_local_url(url):
+	return "://" not in url and not url.startswith("data:")
+
+
+class ThumbnailCache:
+
+	def __init__(self, cache_dir=THUMBNAIL_CACHE_DIR):
+		self.cache_dir = cache_dir
+
+		# sha1 of images, keyed by (filename, mtime, size), so an image is only hashed
+		# once as long as it doesn't change
+		self.digests = {}
+		self.lock = threading.Lock()
+
+	def get_image_digest(self, filename):
+		st = os.stat(filename)
+		key = (filename, st.st_mtime_ns, st.st_size)
+		with self.lock:
+			digest = self.digests.get(key)
+		if digest is not None:
+			return digest
+
+		sha1 = hashlib.sha1()
+		with open(filename, "rb") as f:
+			for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+				sha1.update(chunk)
+		digest = sha1.hexdigest()
+		with self.lock:
+			self.digests[key] = digest
+		return digest
+
+	def get_thumbnail_filename(self, digest, size):
+		return os.path.join(self.cache_dir, digest[:2], "%s_%d.jpg" % (digest, size))
+
+	# returns (thumbnail filename, image digest) for image filename at the given
+	# thumbnail size, rendering the thumbnail if it isn't cached yet
+	def get_thumbnail(self, filename, size):
+		digest = self.get_image_digest(filename)
+		thumbnail_filename = self.get_thumbnail_filename(digest, size)
+		if not os.path.exists(thumbnail_filename):
+			self.render_thumbnails(filename, digest, [size])
+		return (thumbnail_filename, digest)
+
+	# renders the thumbnails of an image at several sizes (decoding the image once)
+	def render_thumbnails(self, filename, digest, sizes):
+		with Image.open(filename) as img:
+			# let the jpeg decoder downscale while decoding, which is much faster
+			# than decoding the full image
+			img.draft("RGB", (max(sizes), max(sizes)))
+			img = ImageOps.exif_transpose(img).convert("RGB")
+
+			for size in sorted(sizes, reverse=True):
+				img.thumbnail((size, size), Image.LANCZOS)
+
+				# write to a temporary file first, so a concurrent request never sees a partial thumbnail
+				thumbnail_filename = self.get_thumbnail_filename(digest, size)
+				os.makedirs(os.path.dirname(thumbnail_filename), exist_ok=True)
+				tmp_filename = "%s.%d.tmp" % (thumbnail_filename, os.getpid())
+				img.save(tmp_filename, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+				os.replace(tmp_filename, thumbnail_filename)
+
+	# renders any missing thumbnails of an image, returns the number rendered
+	def prewarm(self, filename, sizes=THUMBNAIL_SIZES):
+		digest = self.get_image_digest(filename)
+		missing = [size for size in sizes if not os.path.exists(self.get_thumbnail_filename(digest, size))]
+		if len(missing) > 0:
+			self.render_thumbnails(filename, digest, missing)
+		return len(missing)
+
+
+def prewarm_thumbnails_worker(cache_dir, filenames, sizes):
+	cache = ThumbnailCache(cache_dir)
+	num_rendered = 0
+	for filename in filenames:
+		try:
+			num_rendered = num_rendered + cache.prewarm(filename, sizes)
+		except (OSError, ValueError) as e:
+			print("Failed to render thumbnails of %s: %s" % (filename, e))
+	return num_rendered
+
+# renders the thumbnails of all the given (local) image files across a pool of
+# processes. Returns the number of thumbnails rendered
+def prewarm_thumbnails(filenames, cache_dir=THUMBNAIL_CACHE_DIR, sizes=THUMBNAIL_SIZES, num_processes=None, batch_size=64):
+	filenames = sorted(set(filenames))
+	batches = [filenames[i:i+batch_size] for i in range(0, len(filenames), batch_size)]
+	with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+		futures = [executor.submit(prewarm_thumbnails_worker, cache_dir, batch, sizes) for batch in batches]
+		return sum(future.result() for future in futures)
+
+
+# image files of a labeling task (a task json file)
+def get_task_images(task_filename):
+	with open(task_filename, "rt") as f:
+		task = json.load(f)
+	return [url for url in task["datapoint_urls"] if is_local_url(url)]
+
+# image files of a WeakDB json dump (the path of the dump's info file). Like lfviz,
+# relative datapoint urls are relative to the directory of the dump
+def get_dump_images(dump_info_filename):
+	with open(dump_info_filename, "rt") as f:
+		dump_info = json.load(f)
+	if dump_info["datatype"] not in ["image_url", "image_url_seq"]:
+		return []
+
+	dump_dir = os.path.dirname(dump_info_filename)
+	with open(os.path.join(dump_dir, "%s_datapoints.json" % dump_info["name"]), "rt") as f:
+		datapoints = json.load(f)
+
+	urls = []
+	for datapoint in datapoints:
+		urls.extend(datapoint if isinstance(datapoint, list) else [datapoint])
+	return [os.path.join(dump_dir, url) for url in urls if is_local_url(url)]
+
+
+if __name__ == "__main__":
+
+	parser = argparse.ArgumentParser(description="Pre-renders the thumbnails of the images of labeling tasks and WeakDB dumps")
+	parser.add_argument("--task", action="append", default=[], help="labeling task json file")
+	parser.add_argument("--dump", action="append", default=[], help="WeakDB dump info json file")
+	parser.add_argument("--cache-dir", default=THUMBNAIL_CACHE_DIR)
+	parser.add_argument("--processes", type=int, default=None)
+	args = parser.parse_args()
+
+	filenames = []
+	for task_filename in args.task:
+		filenames.extend(get_task_images(task_filename))
+	for dump_filename in args.dump:
+		filenames.extend(get_dump_images(dump_filename))
+
+	num_rendered = prewarm_thumbnails(filenames, args.cache_dir, num_processes=args.processes)
+	print("Rendered %d thumbnails of %d images" % (num_rendered, len(set(filenames))))
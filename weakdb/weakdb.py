@@ -1,9 +1,23 @@
+import concurrent.futures
+import hashlib
 import json
 import pickle
 import os
 import sys
 import numpy
 
+# HACK: weakdb.py is imported both as part of the weakdb package and as a top-level
+# module by the scripts in this directory (e.g., dummy.py), so support both
+try:
+	from . import compression, jsonstream, knn, lfextension, lfmatrix, lfstats, metrics
+except ImportError:
+	import compression
+	import jsonstream
+	import knn
+	import lfextension
+	import lfmatrix
+	import lfstats
+	import metrics
 
 
 # TODO:
@@ -17,11 +31,6 @@ import numpy
 #   functionality for creating a slice manually?  (location of inaccuracies? location of disagreements?)
 
 
-# HACK(kayvonf): convert from fp32 to fp64 in order to serialize to JSON
-# JSON library doesn't serialize float32 values.
-def float32_to_float64(x):			
-	return [ numpy.float64(item) for item in x]
-
 # HACK(danfu): If the inputs are Numpy arrays, need to turn them into flat lists
 np_arr = numpy.zeros(1)
 def is_numpy(arr):
@@ -33,6 +42,47 @@ def listify_numpy(arr):
 	else:
 		return arr
 
+# WeakDB stores its numeric columns as flat, compactly typed numpy arrays.
+# Python lists (or arrays of any shape/dtype) are converted on the way in,
+# and only turned back into lists when serializing to json.
+def typed_column(arr, dtype):
+	return numpy.ascontiguousarray(arr, dtype=dtype).reshape(-1)
+
+def empty_column(dtype):
+	return numpy.zeros(0, dtype=dtype)
+
+def empty_rankings(dtype=numpy.int32):
+	return numpy.zeros((0, 0), dtype=dtype)
+
+# convert a column to a JSON-serializable value (columns loaded from a
+# columnar dump are numpy arrays, possibly memory-mapped)
+def jsonify_column(arr):
+	if is_numpy(arr):
+		return arr.tolist()
+	else:
+		return arr
+
+# turn a (possibly ragged) list of ranking lists into a rectangular int32
+# array. Short rows are padded at the end with -1.
+def pad_rankings(rankings):
+	if is_numpy(rankings):
+		return rankings.astype(numpy.int32, copy=False)
+	width = max([len(row) for row in rankings], default=0)
+	padded = numpy.full((len(rankings), width), -1, dtype=numpy.int32)
+	for i, row in enumerate(rankings):
+		padded[i, :len(row)] = row
+	return padded
+
+# inverse of pad_rankings(): strip the -1 padding off of each row. If given,
+# the padding is determined by the (int) rankings in mask_rankings instead (used
+# for the similarity scores that go with a ranking)
+def unpad_rankings(rankings, mask_rankings=None):
+	if not is_numpy(rankings):
+		return rankings
+	if mask_rankings is None:
+		mask_rankings = rankings
+	return [row[mask_row >= 0].tolist() for (row, mask_row) in zip(rankings, mask_rankings)]
+
 class WeakDB:
 
 	DATAPOINT_TYPE_UNKNOWN = "unknown"
@@ -43,6 +93,26 @@ class WeakDB:
 	CLOSEST_LIST_SIZE = 20
 	SAMPLE_LIST_SIZE =  50
 
+	COLUMNAR_FORMAT_VERSION = 1
+	COLUMNAR_MANIFEST_FILENAME = "manifest.json"
+
+	# numeric columns of the columnar dump format and the dtype each is stored as
+	COLUMN_DTYPES = {
+		"lf_matrix" : numpy.int8,
+		"extended_lf_matrix" : numpy.int8,
+		"prob_labels" : numpy.float32,
+		"extended_prob_labels" : numpy.float32,
+		"ground_truth_labels" : numpy.int8,
+		"sorted_dists" : numpy.int32,
+		"sorted_sims" : numpy.float32,
+	}
+
+	# columns that are (num_train+num_val) x k matrices rather than flat arrays
+	RANKING_COLUMNS = ["sorted_dists", "sorted_sims"]
+
+	# columns that are flattened (num_train+num_val) x num_lf matrices
+	LF_MATRIX_COLUMNS = ["lf_matrix", "extended_lf_matrix"]
+
 	def __init__(self, num_train=0, num_val=0, num_lf=0):
 
 		self.dump_name = ""					# name of the debug dump
@@ -54,19 +124,30 @@ class WeakDB:
 		self.num_train = num_train			# number of datapoints in the training set
 		self.num_val = num_val				# number of datapoints in the val set
 
-		self.lf_matrix = []					# (num_train+num_val) x num_lf matrix (LF results before extension)
-		self.prob_labels = []				# label model output (before extension)
+		# numeric columns are flat numpy arrays (see WeakDB.COLUMN_DTYPES for their types)
+		self.lf_matrix = empty_column(numpy.int8)				# (num_train+num_val) x num_lf matrix (LF results before extension)
+		self.prob_labels = empty_column(numpy.float32)			# label model output (before extension)
 
-		self.extended_lf_matrix = []		# (num_train+num_val) x num_lf matrix (LF results after extension)
-		self.extended_prob_labels = []		# label model output (after extension)
+		self.extended_lf_matrix = empty_column(numpy.int8)		# (num_train+num_val) x num_lf matrix (LF results after extension)
+		self.extended_prob_labels = empty_column(numpy.float32)	# label model output (after extension)
 
 		# description of the datapoints (for introspection during debugging)
 		self.datapoint_type = WeakDB.DATAPOINT_TYPE_UNKNOWN
 		self.datapoints = []				# holds either a text string or an image URL (for preview in viz)
 
-		self.ground_truth_labels = []		# ground truth labels
+		self.ground_truth_labels = empty_column(numpy.int8)		# ground truth labels
 
-		self.sorted_dists = []				# list of lists of k-nn indices (in closest to farthest order)
+		# (num_train+num_val) x k int32 array of k-nn indices (in closest to farthest order).
+		# Rows with fewer than k neighbors are padded at the end with -1.
+		self.sorted_dists = empty_rankings()
+		self.sorted_sims = empty_rankings(numpy.float32)		# optional: similarity scores matching sorted_dists
+
+		# per-LF similarity thresholds of the last LF extension (see extend_lfs()), or None
+		self.lf_thresholds = None
+		# incremental LF extension state: the LFExtender, and the (lf_matrix, sorted_dists,
+		# sorted_sims) columns it was created from
+		self.lf_extender = None
+		self.lf_extender_columns = None
 
 		# set default LF names
 		for i in range(self.num_lf):
@@ -84,28 +165,34 @@ class WeakDB:
 		assert len(lf_names) == self.num_lf
 		self.lf_names = lf_names
 
+	@metrics.timed_stage("set_lf_matrix")
 	def set_lf_matrix(self, lf_matrix):
-		lf_matrix = listify_numpy(lf_matrix)
+		if isinstance(lf_matrix, lfmatrix.CompactLFMatrix):
+			lf_matrix = lf_matrix.to_dense()
+		lf_matrix = typed_column(lf_matrix, WeakDB.COLUMN_DTYPES["lf_matrix"])
 		assert len(lf_matrix) == (self.num_train + self.num_val) * self.num_lf
 		self.lf_matrix = lf_matrix
 
+	@metrics.timed_stage("set_extended_lf_matrix")
 	def set_extended_lf_matrix(self, extended_lf_matrix):
-		extended_lf_matrix = listify_numpy(extended_lf_matrix)
+		if isinstance(extended_lf_matrix, lfmatrix.CompactLFMatrix):
+			extended_lf_matrix = extended_lf_matrix.to_dense()
+		extended_lf_matrix = typed_column(extended_lf_matrix, WeakDB.COLUMN_DTYPES["extended_lf_matrix"])
 		assert len(extended_lf_matrix) == (self.num_train + self.num_val) * self.num_lf
 		self.extended_lf_matrix = extended_lf_matrix
 
 	def set_prob_labels(self, prob_labels):
-		prob_labels = listify_numpy(prob_labels)
+		prob_labels = typed_column(prob_labels, WeakDB.COLUMN_DTYPES["prob_labels"])
 		assert len(prob_labels) == (self.num_train + self.num_val)
 		self.prob_labels = prob_labels
 
 	def set_extended_prob_labels(self, extended_prob_labels):
-		extended_prob_labels = listify_numpy(extended_prob_labels)
+		extended_prob_labels = typed_column(extended_prob_labels, WeakDB.COLUMN_DTYPES["extended_prob_labels"])
 		assert len(extended_prob_labels) == (self.num_train + self.num_val)
 		self.extended_prob_labels = extended_prob_labels
 
 	def set_ground_truth(self, ground_truth_labels):
-		ground_truth_labels = listify_numpy(ground_truth_labels)
+		ground_truth_labels = typed_column(ground_truth_labels, WeakDB.COLUMN_DTYPES["ground_truth_labels"])
 		assert len(ground_truth_labels) == (self.num_train + self.num_val)
 		self.ground_truth_labels = ground_truth_labels
 
@@ -124,8 +211,17 @@ class WeakDB:
 	# higher number is more similar
 	# if set_closest is True, set rankings to N closest; if set_sampled is True, set rankings to
 	#   sample of items; only one of (set_closest, set_sampled) can be True at a time
-	def set_similarity_matrix(self, similarity_matrix, set_closest = False, set_sampled = False):
-		assert(not (set_closest and set_sampled))
+	# if k is given, set rankings to the k closest items. Unlike a full ranking, this only
+	#   requires a partial selection per row, so prefer it for large datasets
+	# if keep_scores is True, the similarity scores of the ranked items are kept in sorted_sims
+	#
+	# similarity_matrix can be a list, a numpy array (including a numpy.memmap), or the
+	# filename of a .npy file. .npy files are memory mapped, so (like a memmap) only a block of
+	# rows is ever resident at once. See set_similarity_blocks() for the details of the ranking.
+	def set_similarity_matrix(self, similarity_matrix, set_closest = False, set_sampled = False, k = None, keep_scores = False):
+		if isinstance(similarity_matrix, str):
+			similarity_matrix = numpy.load(similarity_matrix, mmap_mode="r")
+
 		if is_numpy(similarity_matrix):
 			# this is already in matrix form
 			if len(similarity_matrix.shape) == 2:
@@ -137,21 +233,199 @@ class WeakDB:
 		else:
 			assert len(similarity_matrix) == ((self.num_train + self.num_val) * self.num_train)
 		
-			sim_matrix_numpy = numpy.array(sim_matrix_numpy).reshape(
+			sim_matrix_numpy = numpy.array(similarity_matrix).reshape(
 				(self.num_train + self.num_val, self.num_train))
-		
-		numpy.fill_diagonal(sim_matrix_numpy, numpy.min(sim_matrix_numpy))
-		
-		# get the ranking
-		ranking = numpy.flip(numpy.argsort(sim_matrix_numpy, axis = 1), axis = 1)
-		
+
+		self.set_similarity_blocks([sim_matrix_numpy], set_closest=set_closest, set_sampled=set_sampled, k=k, keep_scores=keep_scores)
+
+	# Builds the rankings from a similarity matrix that is provided as a sequence of blocks of rows.
+	# blocks is any iterable (e.g., a generator reading from disk) of 2D arrays with num_train
+	# columns. Taken together, the blocks must provide all (num_train + num_val) rows of the
+	# similarity matrix, in order. Blocks are consumed one at a time (and large blocks are
+	# further split up), so only the rankings themselves grow with the size of the dataset.
+	# Use k, set_closest, or set_sampled to keep those bounded as well.
+	#
+	# The options are the same as set_similarity_matrix(). A datapoint is never ranked as its
+	# own nearest neighbor (it is ranked last in a full ranking). Blocks are not modified.
+	@metrics.timed_stage("set_similarity_blocks")
+	def set_similarity_blocks(self, blocks, set_closest = False, set_sampled = False, k = None, keep_scores = False):
+		assert(not (set_closest and set_sampled))
+		assert(not (set_sampled and k is not None))
+
 		if set_closest:
-			self.sorted_dists = ranking[:, :WeakDB.CLOSEST_LIST_SIZE].tolist()
-		elif set_sampled:
-			sample_skip = max(1, int(len(self.num_train) / WeakDB.SAMPLE_LIST_SIZE))
-			self.sorted_dists = ranking[:, ::sample_skip].tolist()
+			k = WeakDB.CLOSEST_LIST_SIZE
+		elif k is None:
+			k = self.num_train
+		k = min(k, self.num_train)
+
+		columns = slice(None)
+		if set_sampled:
+			sample_skip = max(1, int(self.num_train / WeakDB.SAMPLE_LIST_SIZE))
+			columns = slice(None, None, sample_skip)
+
+		num_rows = self.num_train + self.num_val
+		width = len(range(k)[columns])
+		sorted_dists = numpy.zeros((num_rows, width), dtype=numpy.int32)
+		sorted_sims = numpy.zeros((num_rows, width), dtype=numpy.float32) if keep_scores else empty_rankings(numpy.float32)
+
+		# get the ranking, one block of rows at a time
+		row_start = 0
+		for chunk in blocks:
+			if not is_numpy(chunk):
+				chunk = numpy.array(chunk)
+			if len(chunk.shape) == 1:
+				chunk = chunk.reshape((-1, self.num_train))
+			assert chunk.shape[1] == self.num_train
+			assert row_start + len(chunk) <= num_rows
+
+			dtype = knn.score_dtype(chunk.dtype)
+			block_rows = knn.rows_per_block(self.num_train, numpy.dtype(dtype).itemsize)
+			for chunk_row in range(0, len(chunk), block_rows):
+				block = numpy.array(chunk[chunk_row:chunk_row+block_rows], dtype=dtype)
+				knn.mask_self_similarity(block, row_start, self.num_train)
+				(indices, scores) = knn.topk_rows(block, k)
+				sorted_dists[row_start:row_start+len(block)] = indices[:, columns]
+				if keep_scores:
+					sorted_sims[row_start:row_start+len(block)] = scores[:, columns]
+				row_start = row_start + len(block)
+
+		assert row_start == num_rows, "similarity blocks provided %d rows, expected %d" % (row_start, num_rows)
+
+		self.sorted_dists = sorted_dists
+		self.sorted_sims = sorted_sims
+
+	# Builds the rankings directly from datapoint embeddings, rather than from a precomputed
+	# similarity matrix. train_embeddings is num_train x d and val_embeddings is num_val x d.
+	# metric is "cosine" (cosine similarity) or "l2" (euclidean distance).
+	#
+	# Each datapoint is ranked against the training set, keeping the k (default:
+	# CLOSEST_LIST_SIZE) closest items. Scores are computed with blocked matrix multiplies
+	# spread over num_threads threads, so the full similarity matrix is never materialized.
+	# If keep_scores is True the scores are kept in sorted_sims (cosine similarity, or the
+	# negated squared L2 distance).
+	#
+	# If index is "ivf", search is approximate, using an IVF index over the training set (see
+	# knn.IVFIndex, index_options are passed to its constructor). Use this for very large datasets.
+	@metrics.timed_stage("set_embeddings")
+	def set_embeddings(self, train_embeddings, val_embeddings, metric = knn.METRIC_COSINE, k = None, keep_scores = False, index = None, num_threads = None, **index_options):
+		assert len(train_embeddings) == self.num_train
+		assert len(val_embeddings) == self.num_val
+
+		if k is None:
+			k = WeakDB.CLOSEST_LIST_SIZE
+
+		# the training set datapoints are the first queries, so they are not ranked against themselves
+		queries = numpy.concatenate([train_embeddings, val_embeddings])
+		if index is None:
+			(sorted_dists, sorted_sims) = knn.embedding_topk(queries, train_embeddings, k, metric=metric, num_self=self.num_train, num_threads=num_threads)
+		elif index == "ivf":
+			ivf = knn.IVFIndex(train_embeddings, metric=metric, **index_options)
+			(sorted_dists, sorted_sims) = ivf.search(queries, k, num_self=self.num_train, num_threads=num_threads)
 		else:
-			self.sorted_dists = ranking.tolist()
+			raise ValueError("Unknown nearest neighbor index type: %s" % index)
+
+		self.sorted_dists = sorted_dists
+		self.sorted_sims = sorted_sims if keep_scores else empty_rankings(numpy.float32)
+
+	# Computes the extended LF matrix from the LF matrix, the nearest neighbor rankings and
+	# one similarity threshold per LF (default: the thresholds of the last extension, e.g.,
+	# the ones loaded by load_linden()). An LF's abstains are filled in with its vote on the
+	# closest ranked training set datapoint it votes on, if that datapoint's similarity is at
+	# least the LF's threshold (see lfextension.py). Needs similarity scores (keep_scores=True).
+	#
+	# If incremental is True (and the LF matrix and rankings haven't been replaced since the
+	# last call), only the LFs whose threshold changed are recomputed. Returns those LFs.
+	@metrics.timed_stage("extend_lfs")
+	def extend_lfs(self, thresholds=None, incremental=True, num_threads=None):
+		if thresholds is None:
+			thresholds = self.lf_thresholds
+		assert thresholds is not None and len(thresholds) == self.num_lf
+		if len(self.sorted_sims) == 0:
+			raise ValueError("LF extension needs the similarity scores of the rankings (set them with keep_scores=True)")
+
+		columns = (self.lf_matrix, self.sorted_dists, self.sorted_sims)
+		if not incremental or self.lf_extender_columns is None or \
+			any(a is not b for (a, b) in zip(columns, self.lf_extender_columns)):
+			self.lf_extender = lfextension.LFExtender(numpy.asarray(self.lf_matrix).reshape((-1, self.num_lf)),
+				self.sorted_dists, self.sorted_sims, self.num_train, num_threads=num_threads)
+			self.lf_extender_columns = columns
+
+		lfs = self.lf_extender.extend(thresholds)
+		self.lf_thresholds = self.lf_extender.thresholds.tolist()
+		self.extended_lf_matrix = typed_column(self.lf_extender.extended_lf_matrix, WeakDB.COLUMN_DTYPES["extended_lf_matrix"]).copy()
+		return lfs
+
+	# accessors for ranges of datapoints [start, start + count). These only touch the requested
+	# rows, so they are cheap on dumps opened with load(path, mmap=True)
+
+	def clamp_range(self, start, count):
+		num_total = self.num_train + self.num_val
+		start = max(0, min(start, num_total))
+		return (start, max(0, min(count, num_total - start)))
+
+	# rows of the LF matrix as a count x num_lf array (count x len(lfs) if a list of LF
+	# indices is given)
+	def get_lf_matrix_rows(self, start, count, extended=False, lfs=None):
+		(start, count) = self.clamp_range(start, count)
+		lf_matrix = self.extended_lf_matrix if extended else self.lf_matrix
+		rows = numpy.asarray(lf_matrix).reshape((-1, self.num_lf))[start:start+count]
+		if lfs is not None:
+			rows = rows[:, lfs]
+		return rows
+
+	# a WeakDB holding datapoints [start, end) of this one. Its numeric columns are views of
+	# this one's, and neighbor indices (in sorted_dists) still refer to datapoints of this one
+	def get_row_range(self, start, end):
+		(start, count) = self.clamp_range(start, end - start)
+		end = start + count
+		num_train = max(0, min(end, self.num_train) - start)
+
+		db = WeakDB(num_train, count - num_train, self.num_lf)
+		db.dump_name = self.dump_name
+		db.description = self.description
+		db.lf_names = list(self.lf_names)
+		db.datapoint_type = self.datapoint_type
+		db.datapoints = self.datapoints[start:end]
+		for column in WeakDB.COLUMN_DTYPES:
+			values = getattr(self, column)
+			if len(values) == 0:
+				continue
+			if column in WeakDB.LF_MATRIX_COLUMNS:
+				setattr(db, column, values[start*self.num_lf:end*self.num_lf])
+			else:
+				setattr(db, column, values[start:end])
+		return db
+
+	# the LF matrix (or extended LF matrix) in a compact format (see lfmatrix.py), by
+	# default whichever is smaller
+	def get_compact_lf_matrix(self, extended=False, format=None):
+		lf_matrix = self.extended_lf_matrix if extended else self.lf_matrix
+		return lfmatrix.compact_lf_matrix(numpy.asarray(lf_matrix).reshape((-1, self.num_lf)), format)
+
+	def get_prob_labels_rows(self, start, count, extended=False):
+		(start, count) = self.clamp_range(start, count)
+		prob_labels = self.extended_prob_labels if extended else self.prob_labels
+		return prob_labels[start:start+count]
+
+	def get_ground_truth_rows(self, start, count):
+		(start, count) = self.clamp_range(start, count)
+		return self.ground_truth_labels[start:start+count]
+
+	def get_datapoints_rows(self, start, count):
+		(start, count) = self.clamp_range(start, count)
+		return self.datapoints[start:start+count]
+
+	# the (up to count) closest datapoints to datapoint idx, closest first. Returns
+	# (indices, scores), where scores is None if the dump has no similarity scores.
+	def get_neighbors(self, idx, count=None):
+		assert 0 <= idx < len(self.sorted_dists)
+		indices = self.sorted_dists[idx]
+		valid = indices >= 0
+		indices = indices[valid][:count]
+		scores = None
+		if len(self.sorted_sims) != 0:
+			scores = self.sorted_sims[idx][valid][:count]
+		return (indices, scores)
 
 	# path generation for output json files (these are the files lfviz expects to load)
 
@@ -179,6 +453,33 @@ class WeakDB:
 		filename = "%s_sorted_dists.json" % self.dump_name
 		return os.path.join(target_dir, filename)
 
+	def get_similarity_scores_json_filename(self, target_dir):
+		filename = "%s_sorted_sims.json" % self.dump_name
+		return os.path.join(target_dir, filename)
+
+	def get_lf_stats_json_filename(self, target_dir):
+		filename = "%s_lf_stats.json" % self.dump_name
+		return os.path.join(target_dir, filename)
+
+	# path generation for the columnar (binary) dump format. Each column is a
+	# .npy file in the dump directory, described by a json manifest
+
+	# directory holding the atlases of thumbnails of the dump's datapoints (see atlases.py)
+	def get_atlas_dir(self, target_dir):
+		dirname = "%s_atlas" % self.dump_name
+		return os.path.join(target_dir, dirname)
+
+	def get_columnar_dir(self, target_dir):
+		dirname = "%s_columns" % self.dump_name
+		return os.path.join(target_dir, dirname)
+
+	def get_columnar_manifest_filename(self, columnar_dir):
+		return os.path.join(columnar_dir, WeakDB.COLUMNAR_MANIFEST_FILENAME)
+
+	def get_column_filename(self, columnar_dir, column):
+		filename = "%s.npy" % column
+		return os.path.join(columnar_dir, filename)
+
 	# FIXME(kayvonf): remove these once we sync with Linden
 	# input pickle files (from Linden)
 
@@ -194,61 +495,85 @@ class WeakDB:
 		filename = "%s_%s_dists.pkl" % (self.dump_name, split)
 		return os.path.join(linden_src_dir, filename)
 
-	def get_linden_image_paths_pkl_filename(self, linden_src_dir, split):
-		filename = "%s_%s_paths.pkl" % (self.dump_name, split)
+	def get_linden_similarity_matrix_npy_filename(self, linden_src_dir, split):
+		filename = "%s_%s_dists.npy" % (self.dump_name, split)
 		return os.path.join(linden_src_dir, filename)
 
-	# helper: this method does the heavy lifting of turning a row in an input
-	# distance matrix into a row of sorted (by distance) datapoint indices
-	def process_dists_row(self, dists_row, query_idx=-1):
-
-		pairs = [(x, dists_row[x]) for x in range(len(dists_row))]
-		pairs.sort(reverse=True, key=(lambda x : x[1]))
-		
-		if query_idx >= 0 and query_idx != pairs[0][0]:
-			print("WARNING: closest datapoint to datapoint %d is datapoint %d (expected %d). Often a sign of duplicate data." % (query_idx, pairs[0][0], query_idx))
-
-		# Build three lists:
-		# The first is a list of the top N closest items to the query.
-		# The second is a sampling of SAMPLE_LIST_SIZE elements 
-		# The third is a rank ordering of the datapoints (closest to farthest)
-
-		closest_n = []
-		sampled_n = []
-		ranking = []
-
-		sample_skip = max(1, int(len(dists_row) / WeakDB.SAMPLE_LIST_SIZE))
-		num_processed = 0
-
-		for (idx,dist) in pairs:
-
-			# throw out the nearest neighbor datapoint if it is the same as the query datapoint
-			if query_idx >= 0 and query_idx == idx:
-				continue
-
-			ranking.append(idx)
-
-			# store in closest-N list
-			if len(closest_n) < WeakDB.CLOSEST_LIST_SIZE:
-				closest_n.append((idx, dist))
+	# Linden's distance matrices are pickled, so they have to be read into memory in full.
+	# If a .npy version of a matrix sits next to the pkl file, memory map that instead.
+	def load_linden_similarity_matrix(self, linden_src_dir, split):
+		npy_filename = self.get_linden_similarity_matrix_npy_filename(linden_src_dir, split)
+		if os.path.exists(npy_filename):
+			return numpy.load(npy_filename, mmap_mode="r")
+		with open(self.get_linden_similarity_matrix_pkl_filename(linden_src_dir, split), "rb") as f:
+			return pickle.load(f)
 
-			# store in sorted samples list
-			if len(sampled_n) < WeakDB.SAMPLE_LIST_SIZE and num_processed % sample_skip == 0:
-				sampled_n.append((idx, dist))
-
-			num_processed = num_processed + 1
+	def get_linden_image_paths_pkl_filename(self, linden_src_dir, split):
+		filename = "%s_%s_paths.pkl" % (self.dump_name, split)
+		return os.path.join(linden_src_dir, filename)
 
-		# FIXME(kayvonf): right now just returing the rank ordering until I figure out what
-		# I'd do with the additional information in the visualizer
+	# helper: this method does the heavy lifting of turning rows of an input distance matrix
+	# into rows of sorted (by distance) datapoint indices. dists holds the rows
+	# [row_start, row_start + len(dists)) of the matrix. The first num_self rows of the matrix
+	# are the training set ranked against itself, so a datapoint is removed from its own
+	# ranking (these rows are padded with -1 at the end).
+	#
+	# Rows are ranked a block at a time. If num_processes > 1 the blocks are ranked
+	# in parallel by a pool of worker processes.
+	def process_dists_rows(self, dists, row_start=0, num_self=0, num_processes=None):
+		dists = numpy.asarray(dists)
+		num_rows = len(dists)
+		block_rows = knn.rows_per_block(dists.shape[1], 8)
+		block_starts = range(0, num_rows, block_rows)
+
+		ranking = numpy.zeros(dists.shape, dtype=numpy.int32)
+
+		def rank_block(block_start, result):
+			(block_ranking, mismatched) = result
+			ranking[block_start:block_start+len(block_ranking)] = block_ranking
+			for query_idx in mismatched:
+				closest_idx = block_ranking[query_idx - row_start - block_start][0]
+				print("WARNING: closest datapoint to datapoint %d is datapoint %d (expected %d). Often a sign of duplicate data." % (query_idx, closest_idx, query_idx))
+
+		if num_processes is not None and num_processes > 1 and len(block_starts) > 1:
+			with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as pool:
+				results = pool.map(knn.rank_rows_excluding_self,
+					[dists[b:b+block_rows] for b in block_starts],
+					[row_start + b for b in block_starts],
+					[num_self] * len(block_starts))
+				for (block_start, result) in zip(block_starts, results):
+					rank_block(block_start, result)
+		else:
+			for block_start in block_starts:
+				rank_block(block_start, knn.rank_rows_excluding_self(dists[block_start:block_start+block_rows], row_start + block_start, num_self))
 
-		#return {"ranking" : ranking, "closest" : closest_n, "sampling" : sampled_n}
 		return ranking
 
+	# similarity scores that go with a ranking of the rows of dists (from process_dists_rows()),
+	# gathered a block of rows at a time. Padding entries of the ranking get a score of 0
+	def get_ranking_scores(self, dists, ranking):
+		sims = numpy.zeros(ranking.shape, dtype=numpy.float32)
+		block_rows = knn.rows_per_block(dists.shape[1], 8)
+		for start in range(0, len(ranking), block_rows):
+			block_ranking = ranking[start:start+block_rows]
+			block_sims = numpy.take_along_axis(numpy.asarray(dists[start:start+block_rows]), numpy.maximum(block_ranking, 0), axis=1)
+			sims[start:start+block_rows] = numpy.where(block_ranking >= 0, block_sims, 0)
+		return sims
+
+	# single row version of process_dists_rows(). If query_idx >= 0 the row is the
+	# training set datapoint query_idx, which is removed from the ranking.
+	def process_dists_row(self, dists_row, query_idx=-1):
+		dists = numpy.asarray(dists_row)[numpy.newaxis, :]
+		ranking = self.process_dists_rows(dists, row_start=max(query_idx, 0), num_self=query_idx+1)[0]
+		return ranking[ranking >= 0].tolist()
+
 
 	# FIXME(kayvonf): This is a function that I expect to go away soon
 	# It loads Linden's pkl files for the tennis task.  It should be deprecated and Liden should just
 	# directly call WeakDB methods to initialize a WeakDB structure
-	def load_linden(self, linden_src_dir, dump_name):
+	# If num_processes > 1, the distance matrices are ranked by a pool of worker processes
+	@metrics.timed_stage("load_linden")
+	def load_linden(self, linden_src_dir, dump_name, num_processes=None):
 
 		LINDEN_TRAINING_SET = "train"
 		LINDEN_VAL_SET = "val"
@@ -283,38 +608,14 @@ class WeakDB:
 		print("   Num train:        %d" % self.num_train)
 		print("   Num val:          %d" % self.num_val)
 
-		# convert pre-extension results
-		self.lf_matrix = []
-		self.prob_labels = []
-		for row in lf_train_data:
-			for lf in range(self.num_lf):
-				self.lf_matrix.append(row[lf])
-			self.prob_labels.append(row[2*self.num_lf])
-
-		for row in lf_val_data:
-			for lf in range(self.num_lf):
-				self.lf_matrix.append(row[lf])
-			self.prob_labels.append(row[2*self.num_lf])
-
-		# convert post-extension results
-		self.extended_lf_matrix = []
-		self.extended_prob_labels = []
-		for row in lf_train_data:
-			for lf in range(self.num_lf):
-				self.extended_lf_matrix.append(row[self.num_lf + lf])
-			self.extended_prob_labels.append(row[2*self.num_lf+1])
-
-		for row in lf_val_data:
-			for lf in range(self.num_lf):
-				self.extended_lf_matrix.append(row[self.num_lf + lf])
-			self.extended_prob_labels.append(row[2*self.num_lf+1])
-
-		# process the ground truth labels
-		self.ground_truth_labels = []
-		for row in lf_train_data:
-			self.ground_truth_labels.append(row[2*self.num_lf+2])
-		for row in lf_val_data:
-			self.ground_truth_labels.append(row[2*self.num_lf+2])
+		# convert pre-extension results, post-extension results and ground truth labels
+		# into typed columns by slicing the columns out of the (train + val) table
+		lf_data = numpy.concatenate([numpy.asarray(lf_train_data), numpy.asarray(lf_val_data)])
+		self.lf_matrix = typed_column(lf_data[:, 0:self.num_lf], WeakDB.COLUMN_DTYPES["lf_matrix"])
+		self.extended_lf_matrix = typed_column(lf_data[:, self.num_lf:2*self.num_lf], WeakDB.COLUMN_DTYPES["extended_lf_matrix"])
+		self.prob_labels = typed_column(lf_data[:, 2*self.num_lf], WeakDB.COLUMN_DTYPES["prob_labels"])
+		self.extended_prob_labels = typed_column(lf_data[:, 2*self.num_lf+1], WeakDB.COLUMN_DTYPES["extended_prob_labels"])
+		self.ground_truth_labels = typed_column(lf_data[:, 2*self.num_lf+2], WeakDB.COLUMN_DTYPES["ground_truth_labels"])
 
 		# now process the datapoint descriptors
 		self.datapoint_type = WeakDB.DATAPOINT_TYPE_IMAGE_URL_SEQ
@@ -334,24 +635,36 @@ class WeakDB:
 				urls.append("%s-%d.jpg" % (base_filename, i))
 			self.datapoints.append(urls)
 
+		# Linden's per-LF extension thresholds, if there are any. The similarity scores of the
+		# rankings are then kept too, so the LFs can be re-extended with extend_lfs()
+		threshold_filename = self.get_linden_lf_threshold_pkl_filename(linden_src_dir)
+		self.lf_thresholds = None
+		if os.path.exists(threshold_filename):
+			with open(threshold_filename, "rb") as f:
+				self.lf_thresholds = numpy.asarray(pickle.load(f), dtype=numpy.float64).reshape(-1).tolist()
+			assert len(self.lf_thresholds) == self.num_lf
+			print("   LF thresholds:    %s" % threshold_filename)
+
 		# process the distance matrices
-		self.sorted_dists = []
-		train_similarity_matrix = pickle.load(open(self.get_linden_similarity_matrix_pkl_filename(linden_src_dir, LINDEN_TRAINING_SET), "rb"))
-		val_similarity_matrix = pickle.load(open(self.get_linden_similarity_matrix_pkl_filename(linden_src_dir, LINDEN_VAL_SET), "rb"))
-		cur_row_idx = 0
-		for row in train_similarity_matrix:
-			self.sorted_dists.append(self.process_dists_row(float32_to_float64(row), query_idx=cur_row_idx))
-			cur_row_idx=cur_row_idx+1
-		for row in val_similarity_matrix:
-			self.sorted_dists.append(self.process_dists_row(float32_to_float64(row)))
+		sorted_dists = []
+		sorted_sims = []
+		for (split, row_start) in [(LINDEN_TRAINING_SET, 0), (LINDEN_VAL_SET, self.num_train)]:
+			similarity_matrix = self.load_linden_similarity_matrix(linden_src_dir, split)
+			sorted_dists.append(self.process_dists_rows(similarity_matrix, row_start=row_start, num_self=self.num_train, num_processes=num_processes))
+			if self.lf_thresholds is not None:
+				sorted_sims.append(self.get_ranking_scores(similarity_matrix, sorted_dists[-1]))
+			del similarity_matrix
+		self.sorted_dists = numpy.concatenate(sorted_dists)
+		self.sorted_sims = numpy.concatenate(sorted_sims) if len(sorted_sims) > 0 else empty_rankings(numpy.float32)
 
 
-	# writes the weakdb dump to a collection of json files that can be read by lfviz
-	def save_json(self, target_dir):
-		
+	# metadata describing the dump (this is the contents of the dump's info file)
+	def get_dump_info(self):
+
 		has_extended_data = (len(self.extended_lf_matrix) != 0)
 		has_similarity_data = (len(self.sorted_dists) != 0)
 		has_ground_truth  = (len(self.ground_truth_labels) != 0)
+		has_similarity_scores = (len(self.sorted_sims) != 0)
 
 		dump_info = { "name" : self.dump_name,
 					  "description" : self.description,
@@ -362,39 +675,286 @@ class WeakDB:
 					  "lf_names" : self.lf_names,
 					  "has_extended_data" : has_extended_data,
 					  "has_similarity_data" : has_similarity_data,
+					  "has_similarity_scores" : has_similarity_scores,
 					  "has_ground_truth"  : has_ground_truth
 					} 
+		return dump_info
+
+	# summary statistics of the LFs (see lfstats.py) for the LF matrix (noext) and the
+	# extended LF matrix (ext), each for all datapoints and the train and val splits.
+	# Accuracies are only computed if the dump has ground truth labels.
+	@metrics.timed_stage("compute_lf_stats")
+	def compute_lf_stats(self):
+		ground_truth = None
+		if len(self.ground_truth_labels) != 0:
+			ground_truth = numpy.asarray(self.ground_truth_labels)
+
+		stats = { "lf_names" : self.lf_names }
+		stats["noext"] = lfstats.compute_split_lf_stats(
+			numpy.asarray(self.lf_matrix).reshape((-1, self.num_lf)), self.num_train, ground_truth)
+		if len(self.extended_lf_matrix) != 0:
+			stats["ext"] = lfstats.compute_split_lf_stats(
+				numpy.asarray(self.extended_lf_matrix).reshape((-1, self.num_lf)), self.num_train, ground_truth)
+		return stats
+
+	# writes json file filename (atomically, via a temporary file), plus (if compress is
+	# set) its gzip/brotli compressed sidecars, which the server sends to clients that
+	# accept them. obj is serialized (and compressed) in chunks as it is written, so
+	# numpy columns go straight from their arrays to the files. Returns the os.stat()
+	# of the written file
+	def write_json_file(self, filename, obj, compress=True):
+		tmp_filename = "%s.tmp" % filename
+		sidecars = compression.SidecarWriter(filename) if compress else None
+		try:
+			with open(tmp_filename, "wb") as f:
+				for chunk in jsonstream.iter_json_bytes(obj):
+					f.write(chunk)
+					if sidecars is not None:
+						sidecars.write(chunk)
+		except:
+			if sidecars is not None:
+				sidecars.abort()
+			raise
+		if sidecars is not None:
+			sidecars.close()
+		os.replace(tmp_filename, filename)
+		if sidecars is not None:
+			sidecars.commit()
+		return os.stat(filename)
+
+	# contents of an LF matrix json file of a dump
+	def get_lf_matrix_json(self, extended, compact):
+		if compact:
+			return self.get_compact_lf_matrix(extended).to_json()
+		return self.extended_lf_matrix if extended else self.lf_matrix
+
+	# hash of the contents of the columns (numpy arrays or json serializable values)
+	# that a dump file is generated from
+	def hash_columns(self, columns):
+		sha1 = hashlib.sha1()
+		for column in columns:
+			if is_numpy(column):
+				arr = numpy.ascontiguousarray(column)
+				sha1.update(("%s%s" % (arr.dtype.str, arr.shape)).encode("utf-8"))
+				sha1.update(arr.data)
+			else:
+				for chunk in jsonstream.iter_json_bytes(column):
+					sha1.update(chunk)
+		return sha1.hexdigest()
+
+	# the "files" entry of the dump info previously saved to target_dir, and its version
+	def load_json_file_versions(self, target_dir):
+		try:
+			with open(self.get_dump_info_json_filename(target_dir), "rt") as f:
+				prev_dump_info = json.load(f)
+		except (OSError, ValueError):
+			return ({}, {}, 0)
+		files = prev_dump_info.pop("files", {})
+		version = prev_dump_info.pop("version", 0)
+		return (prev_dump_info, files, version)
+
+	# true if a dump file written by a previous save is still intact: it hasn't been
+	# modified since, and has compressed sidecars if they are needed
+	def json_file_is_current(self, filename, file_info, compress):
+		try:
+			st = os.stat(filename)
+		except OSError:
+			return False
+		if st.st_size != file_info["size"] or st.st_mtime_ns != file_info["mtime_ns"]:
+			return False
+		return not compress or compression.find_sidecar(filename, "gzip") is not None
 
-		with open(self.get_dump_info_json_filename(target_dir), "wt") as f:
-			f.write(json.dumps(dump_info))
+	# writes the weakdb dump to a collection of json files that can be read by lfviz
+	#
+	# Saves are incremental: the dump info file records a content hash of the columns
+	# each file was generated from, so saving a dump over a previous save of the same
+	# dump only rewrites the files whose columns changed (e.g., just the extended LF
+	# matrix and label model output after an LF extension iteration). The dump info
+	# also holds a dump version, bumped by every save that changes something, and the
+	# version of each file (the dump version that last changed it), so readers can
+	# tell which files they need to fetch again.
+	#
+	# LF matrices are written in a compact format (packed 2 bit votes, or CSR for sparse
+	# ones, see lfmatrix.py) that lfviz decodes. Pass compact_lf_matrix=False to write
+	# them as flat lists of votes instead.
+	@metrics.timed_stage("save_json")
+	def save_json(self, target_dir, compress=True, atlases=False, compact_lf_matrix=True):
+
+		dump_info = self.get_dump_info()
+		if atlases:
+			dump_info["has_atlases"] = self.save_atlases(target_dir)
+		dump_info["has_lf_stats"] = True
+		has_extended_data = dump_info["has_extended_data"]
+		has_similarity_data = dump_info["has_similarity_data"]
+		has_ground_truth = dump_info["has_ground_truth"]
+		has_similarity_scores = dump_info["has_similarity_scores"]
 
 		assert len(self.lf_matrix) > 0
-		with open(self.get_lf_matrix_json_filename(target_dir, "noext"), "wt") as f:
-			f.write(json.dumps(self.lf_matrix))
-
 		assert len(self.prob_labels) > 0
-		with open(self.get_prob_labels_json_filename(target_dir, "noext"), "wt") as f:
-			f.write(json.dumps(self.prob_labels))
-
 		assert len(self.datapoints) > 0
 		assert self.datapoint_type != WeakDB.DATAPOINT_TYPE_UNKNOWN
-		with open(self.get_datapoints_json_filename(target_dir), "wt") as f:
-			f.write(json.dumps(self.datapoints))
+
+		# the files of the dump: (key, filename, the columns the file is generated from,
+		# function generating the file contents)
+		dump_files = [
+			("lf_matrix_noext", self.get_lf_matrix_json_filename(target_dir, "noext"),
+				[self.lf_matrix, compact_lf_matrix], lambda: self.get_lf_matrix_json(False, compact_lf_matrix)),
+			("prob_labels_noext", self.get_prob_labels_json_filename(target_dir, "noext"),
+				[self.prob_labels], lambda: self.prob_labels),
+			("datapoints", self.get_datapoints_json_filename(target_dir),
+				[self.datapoints], lambda: self.datapoints),
+			("lf_stats", self.get_lf_stats_json_filename(target_dir),
+				[self.lf_names, self.num_train, self.lf_matrix, self.extended_lf_matrix, self.ground_truth_labels],
+				self.compute_lf_stats),
+		]
 
 		if has_extended_data:
 			assert len(self.extended_lf_matrix) > 0
-			with open(self.get_lf_matrix_json_filename(target_dir, "ext"), "wt") as f:
-				f.write(json.dumps(self.extended_lf_matrix))
-
 			assert len(self.extended_prob_labels) > 0
-			with open(self.get_prob_labels_json_filename(target_dir, "ext"), "wt") as f:
-				f.write(json.dumps(self.extended_prob_labels))
+			dump_files.append(("lf_matrix_ext", self.get_lf_matrix_json_filename(target_dir, "ext"),
+				[self.extended_lf_matrix, compact_lf_matrix], lambda: self.get_lf_matrix_json(True, compact_lf_matrix)))
+			dump_files.append(("prob_labels_ext", self.get_prob_labels_json_filename(target_dir, "ext"),
+				[self.extended_prob_labels], lambda: self.extended_prob_labels))
 
 		if has_ground_truth:
-			with open(self.get_ground_truth_labels_json_filename(target_dir), "wt") as f:
-				f.write(json.dumps(self.ground_truth_labels))
+			dump_files.append(("ground_truth_labels", self.get_ground_truth_labels_json_filename(target_dir),
+				[self.ground_truth_labels], lambda: self.ground_truth_labels))
 
 		if has_similarity_data:
-			with open(self.get_similarity_json_filename(target_dir), "wt") as f:
-				f.write(json.dumps(self.sorted_dists))	
+			dump_files.append(("sorted_dists", self.get_similarity_json_filename(target_dir),
+				[self.sorted_dists], lambda: jsonstream.UnpaddedRows(self.sorted_dists)))
+
+		if has_similarity_scores:
+			dump_files.append(("sorted_sims", self.get_similarity_scores_json_filename(target_dir),
+				[self.sorted_sims, self.sorted_dists], lambda: jsonstream.UnpaddedRows(self.sorted_sims, self.sorted_dists)))
+
+		(prev_dump_info, prev_files, prev_version) = self.load_json_file_versions(target_dir)
+		version = prev_version + 1
+
+		files = {}
+		for (key, filename, columns, generate) in dump_files:
+			content_hash = self.hash_columns(columns)
+			prev = prev_files.get(key)
+			if prev is not None and prev["hash"] == content_hash and self.json_file_is_current(filename, prev, compress):
+				files[key] = prev
+				continue
+
+			st = self.write_json_file(filename, generate(), compress)
+			files[key] = { "filename" : os.path.basename(filename), "hash" : content_hash, "version" : version,
+				"size" : st.st_size, "mtime_ns" : st.st_mtime_ns }
+
+		# remove files of the previous save that this dump no longer has
+		for (key, prev) in prev_files.items():
+			if key not in files:
+				filename = os.path.join(target_dir, prev["filename"])
+				for stale_filename in [filename] + [compression.get_sidecar_filename(filename, e) for e in compression.ENCODING_EXTENSIONS]:
+					if os.path.exists(stale_filename):
+						os.remove(stale_filename)
+
+		changed = (files != prev_files or dump_info != prev_dump_info)
+		dump_info["version"] = version if changed else prev_version
+		dump_info["files"] = files
+
+		# the dump info is written last, so readers never see a version whose files aren't in place yet
+		dump_info_filename = self.get_dump_info_json_filename(target_dir)
+		if changed or (compress and compression.find_sidecar(dump_info_filename, "gzip") is None):
+			self.write_json_file(dump_info_filename, dump_info, compress)
+
+	# packs thumbnails of the dump's images into atlases (see atlases.py), which lfviz
+	# uses to draw its grids. Returns False if the datapoints aren't images.
+	@metrics.timed_stage("save_atlases")
+	def save_atlases(self, target_dir, num_processes=None):
+		if self.datapoint_type not in [WeakDB.DATAPOINT_TYPE_IMAGE_URL, WeakDB.DATAPOINT_TYPE_IMAGE_URL_SEQ]:
+			return False
+
+		# imported here so that Pillow is only required when building atlases
+		try:
+			from . import atlases
+		except ImportError:
+			import atlases
+
+		# like lfviz, relative datapoint urls are relative to the dump directory
+		filenames = atlases.get_atlas_filenames(self.datapoints, target_dir)
+		atlases.build_atlases(filenames, self.get_atlas_dir(target_dir), num_processes=num_processes)
+		return True
+
+	# writes the weakdb dump in the columnar format: one typed .npy file per
+	# numeric column plus a json manifest holding the dump info. Unlike the json
+	# dump, this format can be read back (and memory mapped) via load()
+	@metrics.timed_stage("save_columnar")
+	def save_columnar(self, target_dir):
+		self.write_columnar(self.get_columnar_dir(target_dir))
+
+	# writes the columnar dump to columnar_dir. The entries of manifest_info (if given)
+	# are added to the manifest (e.g., the datapoint range of a shard, see shards.py)
+	def write_columnar(self, columnar_dir, manifest_info=None):
+
+		assert len(self.lf_matrix) > 0
+		assert len(self.datapoints) > 0
+		assert self.datapoint_type != WeakDB.DATAPOINT_TYPE_UNKNOWN
+
+		os.makedirs(columnar_dir, exist_ok=True)
+
+		columns = {}
+		for column, dtype in WeakDB.COLUMN_DTYPES.items():
+			values = getattr(self, column)
+			if len(values) == 0:
+				continue
+			if column == "sorted_dists":
+				arr = pad_rankings(values)
+			elif column in WeakDB.RANKING_COLUMNS:
+				arr = numpy.ascontiguousarray(values, dtype=dtype)
+			else:
+				arr = typed_column(values, dtype)
+			numpy.save(self.get_column_filename(columnar_dir, column), arr)
+			columns[column] = { "dtype" : arr.dtype.str, "shape" : list(arr.shape) }
+
+		# datapoints are strings (or lists of strings), not a typed column
+		with open(os.path.join(columnar_dir, "datapoints.json"), "wb") as f:
+			jsonstream.write_json(f, self.datapoints)
+
+		manifest = { "format_version" : WeakDB.COLUMNAR_FORMAT_VERSION,
+					 "dump_info" : self.get_dump_info(),
+					 "columns" : columns }
+		if manifest_info is not None:
+			manifest.update(manifest_info)
+
+		# write the manifest last, so a dump is not considered complete until all columns exist
+		with open(self.get_columnar_manifest_filename(columnar_dir), "wt") as f:
+			f.write(json.dumps(manifest))
+
+	# loads a dump written by save_columnar(). path is the dump's columnar directory.
+	# If mmap is True, numeric columns are memory mapped (read-only) rather than
+	# read into memory.
+	@metrics.timed_stage("load")
+	def load(self, path, mmap=True):
+
+		with open(self.get_columnar_manifest_filename(path), "rt") as f:
+			manifest = json.load(f)
+
+		if manifest["format_version"] != WeakDB.COLUMNAR_FORMAT_VERSION:
+			raise ValueError("Unsupported columnar dump version %d in %s" % (manifest["format_version"], path))
+
+		dump_info = manifest["dump_info"]
+		self.dump_name = dump_info["name"]
+		self.description = dump_info["description"]
+		self.num_lf = dump_info["num_lf"]
+		self.num_train = dump_info["num_train"]
+		self.num_val = dump_info["num_val"]
+		self.datapoint_type = dump_info["datatype"]
+		self.lf_names = dump_info["lf_names"]
+
+		mmap_mode = "r" if mmap else None
+		for column in WeakDB.COLUMN_DTYPES:
+			if column in manifest["columns"]:
+				arr = numpy.load(self.get_column_filename(path, column), mmap_mode=mmap_mode)
+				assert list(arr.shape) == manifest["columns"][column]["shape"]
+				setattr(self, column, arr)
+			elif column in WeakDB.RANKING_COLUMNS:
+				setattr(self, column, empty_rankings(WeakDB.COLUMN_DTYPES[column]))
+			else:
+				setattr(self, column, empty_column(WeakDB.COLUMN_DTYPES[column]))
+
+		with open(os.path.join(path, "datapoints.json"), "rt") as f:
+			self.datapoints = json.load(f)
 